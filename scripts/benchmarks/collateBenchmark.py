@@ -0,0 +1,104 @@
+"""Micro-benchmark the batch collation in :code:`terminator.data.data._package`.
+
+Collation runs on every training step, so its cost per batch adds directly to the time
+the GPU waits on the data loader. This script times :code:`_package` on synthetic proteins
+for a range of batch sizes.
+
+Usage:
+    .. code-block::
+
+        python collateBenchmark.py \\
+            [--batch_sizes <batch_size> ...] \\
+            [--seq_len <protein_length>] \\
+            [--num_matches <matches_per_term>] \\
+            [--repeats <num_repeats>] \\
+            [--featurize <featurizer> ...]
+
+    :code:`--batch_sizes` are the numbers of proteins per batch to time. Defaults to 1 4 16 32.
+
+    :code:`--seq_len` is the average protein length. Protein lengths are drawn uniformly
+    within 50% of this value. Defaults to 300.
+
+    :code:`--num_matches` is the number of TERM matches per TERM. Defaults to 30.
+
+    :code:`--repeats` is the number of times each batch is collated. Defaults to 20.
+
+    :code:`--featurize` adds graph featurizers to time (see :code:`terminator.data.data.FEATURIZERS`).
+
+See :code:`python collateBenchmark.py --help` for more info.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from terminator.data.data import _package
+
+
+def fake_protein(pdb, seq_len, num_matches, rng, term_len=9, num_features=9):
+    """Generate a feature dictionary in the format of :code:`scripts/data/preprocessing/packageTensors.py`
+
+    Args
+    ----
+    pdb : str
+        Name of the fake protein
+    seq_len : int
+        Length of the protein
+    num_matches : int
+        Number of TERM matches per TERM
+    rng : np.random.Generator
+        Random number generator
+    term_len : int, default=9
+        Length of each TERM
+    num_features : int, default=9
+        Number of features per TERM match residue
+
+    Returns
+    -------
+    dict
+        Fake feature dictionary
+    """
+    term_lens = np.full(max(seq_len // term_len, 1), term_len)
+    n_term_res = term_lens.sum()
+    ca = np.cumsum(rng.normal(size=(seq_len, 3)) + np.array([3.8, 0, 0]), axis=0)
+    return {
+        'pdb': pdb,
+        'coords': np.stack([ca - 1, ca, ca + 1, ca + np.array([1, 1, 0])], axis=1),
+        'ppoe': rng.normal(size=(seq_len, 7)),
+        'features': rng.normal(size=(num_matches, n_term_res, num_features)),
+        'msas': rng.integers(0, 21, size=(num_matches, n_term_res)),
+        'focuses': rng.integers(0, seq_len, size=n_term_res),
+        'contact_idxs': rng.integers(-2, 3, size=n_term_res),
+        'term_lens': term_lens,
+        'sequence': rng.integers(0, 20, size=seq_len),
+        'seq_len': seq_len,
+        'chain_lens': [seq_len]
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Time batch collation per batch')
+    parser.add_argument('--batch_sizes',
+                        help='numbers of proteins per batch',
+                        nargs='+',
+                        default=[1, 4, 16, 32],
+                        type=int)
+    parser.add_argument('--seq_len', help='average protein length', default=300, type=int)
+    parser.add_argument('--num_matches', help='number of TERM matches per TERM', default=30, type=int)
+    parser.add_argument('--repeats', help='number of times each batch is collated', default=20, type=int)
+    parser.add_argument('--featurize', help='graph featurizers to run during collation', nargs='*', default=[])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'batch size':>10} {'ms / batch':>12} {'ms / protein':>14}")
+    for batch_size in args.batch_sizes:
+        seq_lens = rng.integers(args.seq_len // 2, args.seq_len * 3 // 2, size=batch_size)
+        proteins = [fake_protein(f"P{i:03d}", int(l), args.num_matches, rng) for i, l in enumerate(seq_lens)]
+        b_idx = [(p, int(p['term_lens'].sum()), p['seq_len']) for p in proteins]
+
+        _package(b_idx, featurize=args.featurize)  # warm up
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            _package(b_idx, featurize=args.featurize)
+        per_batch = (time.perf_counter() - start) / args.repeats * 1000
+        print(f"{batch_size:>10} {per_batch:>12.2f} {per_batch / batch_size:>14.2f}")
@@ -0,0 +1,129 @@
+"""Benchmark parsing of :code:`.dat` TERM data dumps with :code:`terminator.utils.dat.parse_term_data`.
+
+Parsing :code:`.dat` files dominates the runtime of :code:`scripts/data/preprocessing/generateDataset.py`, and
+the files of large proteins reach several hundred MB as every TERM can have thousands of matches. This script
+times the parse of each :code:`.dat` file with all matches and with only the top matches of each TERM,
+which is what :code:`dumpTrainingTensors` parses.
+
+Usage:
+    .. code-block::
+
+        python parseBenchmark.py \\
+            [--dat <dat_file> ...] \\
+            [--synthetic_mb <size_in_mb> ...] \\
+            [--cutoffs <cutoff> ...] \\
+            [--num_processes <num_processes> ...] \\
+            [--repeats <num_repeats>]
+
+    :code:`--dat` are :code:`.dat` files to parse.
+
+    :code:`--synthetic_mb` are sizes of synthetic :code:`.dat` files to generate and parse, written to a temporary
+    directory. Defaults to 100 and 300 if no :code:`--dat` is given.
+
+    :code:`--cutoffs` are the numbers of top matches per TERM to parse, in addition to all matches.
+    Defaults to 50, the default :code:`--cutoff` of :code:`generateDataset.py`.
+
+    :code:`--num_processes` are the numbers of processes to parse each file with (see :code:`index_terms`).
+    Process pools are started ahead of timing. Defaults to 1.
+
+    :code:`--repeats` is the number of times each file is parsed. The fastest time is reported. Defaults to 3.
+
+See :code:`python parseBenchmark.py --help` for more info.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from terminator.utils.dat import parse_term_data
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def write_synthetic_dat(path, size_mb, rng, seq_len=300, term_len=9, num_matches=2000):
+    """Write a synthetic :code:`.dat` file of about :code:`size_mb` MB.
+
+    The target has one chain of :code:`seq_len` residues, and every TERM is a first order TERM of
+    :code:`term_len` residues with :code:`num_matches` matches. TERMs are added until the file reaches its size.
+
+    Args
+    ----
+    path : str
+        Path to write the file to
+    size_mb : float
+        Approximate size of the file, in MB
+    rng : np.random.Generator
+        Random number generator
+    seq_len : int, default=300
+        Length of the target
+    term_len : int, default=9
+        Number of residues in each TERM
+    num_matches : int, default=2000
+        Number of matches of each TERM
+    """
+    residues = np.array(list(AMINO_ACIDS))
+    with open(path, 'w') as fp:  # pylint: disable=unspecified-encoding
+        fp.write(''.join(rng.choice(residues, seq_len)) + '\n')
+        fp.write(' '.join(str(i) for i in range(seq_len)) + '\n')
+        for i in range(seq_len):
+            phi = 999 if i == 0 else round(rng.uniform(-180, 180), 3)
+            fp.write(f"{phi} {rng.uniform(-180, 180):.3f} {rng.uniform(-180, 180):.3f} {rng.uniform(0, 1):.3f}\n")
+        term_idx = 0
+        while fp.tell() < size_mb * 1024**2:
+            start = rng.integers(seq_len - term_len)
+            fp.write(f"* TERM {term_idx}\n")
+            fp.write(' '.join(str(i) for i in range(start, start + term_len)) + '\n')
+            labels = rng.choice(residues, (num_matches, term_len))
+            rmsds = np.sort(rng.uniform(0, 2, num_matches))
+            values = rng.uniform(-180, 180, (num_matches, 4 * term_len))
+            fp.writelines(f"{''.join(label)} {rmsd:.3f} {' '.join(f'{v:.3f}' for v in row)}\n"
+                          for label, rmsd, row in zip(labels, rmsds, values))
+            term_idx += 1
+
+
+def time_parse(path, max_matches=None, repeats=3, pool=None):
+    """Fastest time out of :code:`repeats` parses of :code:`path`, in seconds"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        parse_term_data(path, max_matches=max_matches, pool=pool)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Benchmark parsing of .dat files')
+    parser.add_argument('--dat', help='.dat files to parse', nargs='*', default=[])
+    parser.add_argument('--synthetic_mb', help='sizes of synthetic .dat files to parse, in MB', nargs='*', type=float)
+    parser.add_argument('--cutoffs', help='numbers of top matches per TERM to parse', nargs='*', default=[50], type=int)
+    parser.add_argument('--num_processes', help='numbers of processes to parse with', nargs='*', default=[1], type=int)
+    parser.add_argument('--repeats', help='number of parses per file', default=3, type=int)
+    parser.add_argument('--seed', help='random seed for synthetic files', default=0, type=int)
+    args = parser.parse_args()
+    if args.synthetic_mb is None:
+        args.synthetic_mb = [] if args.dat else [100, 300]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = list(args.dat)
+        rng = np.random.default_rng(args.seed)
+        for size_mb in args.synthetic_mb:
+            path = os.path.join(tmp_dir, f"synthetic_{size_mb:g}MB.dat")
+            write_synthetic_dat(path, size_mb, rng)
+            paths.append(path)
+
+        print(f"{'file':>40} {'MB':>8} {'matches':>8} {'procs':>6} {'s':>8} {'MB/s':>8}")
+        for num_processes in args.num_processes:
+            pool = mp.Pool(num_processes) if num_processes > 1 else None
+            for path in paths:
+                size_mb = os.path.getsize(path) / 1024**2
+                for max_matches in [None] + args.cutoffs:
+                    seconds = time_parse(path, max_matches=max_matches, repeats=args.repeats, pool=pool)
+                    matches = 'all' if max_matches is None else max_matches
+                    print(f"{os.path.basename(path)[-40:]:>40} {size_mb:>8.1f} {matches:>8} {num_processes:>6} "
+                          f"{seconds:>8.2f} {size_mb / seconds:>8.1f}")
+            if pool is not None:
+                pool.close()
+                pool.join()
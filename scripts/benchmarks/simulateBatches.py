@@ -0,0 +1,200 @@
+"""Simulate batching of a dataset to tune sampler settings before a training run.
+
+The padded size of a batch decides both how much compute is spent on padding and how large the
+quadratic intermediates of the model get, so a :code:`max_term_res` that is too large only shows up
+as an out-of-memory error partway through an epoch. This script builds the batches each sampler
+configuration would produce, using the clustering of :code:`TERMLazyBatchSampler` on the lengths stored in
+the dataset manifest (or :code:`.length` files), without loading any features. For each configuration
+it reports
+
+- the number of batches,
+- the padding efficiency, i.e. the fraction of padded TERM residues and sequence tokens holding real data,
+- the largest padded sequence-pair tensor over all batches, :code:`n_batch x L x L`, as built by
+  :code:`aggregate_edges` and the Potts model layers,
+- the largest padded TERM edge tensor over all batches, estimated as
+  :code:`n_batch x n_term_res x max_term_len` for :code:`n_term_res` TERM residues per protein,
+  as built by the TERM graph layers.
+
+Tensor sizes are given in entries per hidden channel and in GB for :code:`--hidden_dim` float32 channels.
+
+Usage:
+    .. code-block::
+
+        python simulateBatches.py \\
+            --dataset <dataset_dir> \\
+            [--split <split_file>] \\
+            [--modes [shuffle, semi_shuffle, sort] ...] \\
+            [--max_term_res <max_term_res> ...] \\
+            [--max_seq_tokens <max_seq_tokens> ...] \\
+            [--batch_sizes <batch_size> ...] \\
+            [--max_seq_pairs <max_seq_pairs>] \\
+            [--bin_pack] \\
+            [--semi_shuffle_cluster_size <cluster_size>] \\
+            [--min_protein_len <min_protein_len>] \\
+            [--max_term_len <max_term_len>] \\
+            [--hidden_dim <hidden_dim>] \\
+            [--seed <seed>]
+
+    :code:`<dataset_dir>` should be a dataset folder generated by :code:`scripts/data/preprocessing/generateDataset.py`.
+    If :code:`--split <split_file>` is given, only the proteins listed in it are batched.
+
+    Every combination of :code:`--modes` with one batching budget is simulated. Budgets are each value of
+    :code:`--max_term_res` (defaults to 55000), each value of :code:`--max_seq_tokens`, and each fixed
+    batch size in :code:`--batch_sizes`. :code:`--max_seq_pairs` and :code:`--bin_pack` are passed
+    through to the sampler for variable-size batches.
+
+    :code:`--max_term_len` is the padded TERM length used to estimate TERM edge tensors, since TERM
+    lengths are not stored in the manifest. Defaults to 20.
+
+    :code:`--hidden_dim` is the number of hidden channels used to convert tensor entries to GB.
+    Defaults to the default :code:`energies_hidden_dim`.
+
+See :code:`python simulateBatches.py --help` for more info.
+"""
+import argparse
+
+import numpy as np
+
+from terminator.data.data import TERMLazyBatchSampler, TERMLazyDataset
+from terminator.utils.model.default_hparams import DEFAULT_MODEL_HPARAMS
+
+
+def batch_stats(clusters, term_lengths, seq_lengths, max_term_len=20):
+    """Summarize the padded shapes of a set of batches.
+
+    Args
+    ----
+    clusters : list of list of int
+        Batches of datapoint indices
+    term_lengths : list of int
+        Sum of the lengths of all TERMs of each datapoint
+    seq_lengths : list of int
+        Sequence length of each datapoint
+    max_term_len : int, default=20
+        Padded TERM length, used to estimate the size of TERM edge tensors
+
+    Returns
+    -------
+    dict
+        :code:`num_batches`, the padding efficiency over TERM residues (:code:`term_eff`) and sequence tokens
+        (:code:`seq_eff`), and the largest :code:`n_batch x L x L` (:code:`peak_pairs`) and
+        :code:`n_batch x n_term_res x max_term_len` (:code:`peak_term_edges`) tensor sizes over all batches
+    """
+    term_lengths = np.asarray(term_lengths, dtype=np.int64)
+    seq_lengths = np.asarray(seq_lengths, dtype=np.int64)
+    sizes = np.array([len(batch) for batch in clusters], dtype=np.int64)
+    max_terms = np.array([term_lengths[batch].max() for batch in clusters], dtype=np.int64)
+    max_seqs = np.array([seq_lengths[batch].max() for batch in clusters], dtype=np.int64)
+    real_terms = sum(term_lengths[batch].sum() for batch in clusters)
+    real_seqs = sum(seq_lengths[batch].sum() for batch in clusters)
+    return {
+        'num_batches': len(clusters),
+        'term_eff': real_terms / max((sizes * max_terms).sum(), 1),
+        'seq_eff': real_seqs / max((sizes * max_seqs).sum(), 1),
+        'peak_pairs': int((sizes * max_seqs**2).max(initial=0)),
+        'peak_term_edges': int((sizes * max_terms * max_term_len).max(initial=0)),
+    }
+
+
+def simulate(dataset, mode, batch_size=None, max_term_res=None, max_seq_tokens=None, **sampler_kwargs):
+    """Build the batches of one sampler configuration with :code:`TERMLazyBatchSampler`.
+
+    Args
+    ----
+    dataset : TERMLazyDataset
+        Dataset to batch. Only the lengths are used.
+    mode : str
+        One of :code:`'shuffle'`, :code:`'semi_shuffle'` or :code:`'sort'`
+    batch_size : int or None, default=None
+        Fixed batch size. If :code:`None`, batch by the :code:`max_term_res` or :code:`max_seq_tokens` budget.
+    max_term_res : int or None, default=None
+        Budget of padded TERM residues per batch
+    max_seq_tokens : int or None, default=None
+        Budget of padded sequence tokens per batch
+    **sampler_kwargs
+        Further arguments to :code:`TERMLazyBatchSampler`
+
+    Returns
+    -------
+    TERMLazyBatchSampler
+        Sampler holding the simulated batches in :code:`clusters`
+    """
+    return TERMLazyBatchSampler(dataset,
+                                batch_size=batch_size,
+                                sort_data=mode == 'sort',
+                                shuffle=mode == 'shuffle',
+                                semi_shuffle=mode == 'semi_shuffle',
+                                max_term_res=max_term_res,
+                                max_seq_tokens=max_seq_tokens,
+                                **sampler_kwargs)
+
+
+def _configs(args):
+    """Sampler configurations to simulate, as keyword arguments to :code:`simulate`"""
+    configs = []
+    for mode in args.modes:
+        for max_term_res in args.max_term_res:
+            configs.append({'mode': mode, 'max_term_res': max_term_res})
+        for max_seq_tokens in args.max_seq_tokens:
+            configs.append({'mode': mode, 'max_seq_tokens': max_seq_tokens})
+        for batch_size in args.batch_sizes:
+            # the sampler requires a budget to be set even when it is unused
+            configs.append({'mode': mode, 'batch_size': batch_size, 'max_term_res': 55000})
+    return configs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Simulate batching of a dataset under different sampler configurations')
+    parser.add_argument('--dataset', help='dataset folder generated by generateDataset.py', required=True)
+    parser.add_argument('--split', help='file listing the PDB ids to batch. If not set, batch the whole dataset')
+    parser.add_argument('--modes',
+                        help='batch orderings to simulate',
+                        nargs='+',
+                        default=['shuffle', 'semi_shuffle', 'sort'],
+                        choices=['shuffle', 'semi_shuffle', 'sort'])
+    parser.add_argument('--max_term_res', help='TERM residue budgets to simulate', nargs='*', default=[55000], type=int)
+    parser.add_argument('--max_seq_tokens', help='sequence token budgets to simulate', nargs='*', default=[], type=int)
+    parser.add_argument('--batch_sizes', help='fixed batch sizes to simulate', nargs='*', default=[], type=int)
+    parser.add_argument('--max_seq_pairs', help='residue pair budget, used with --bin_pack', default=None, type=int)
+    parser.add_argument('--bin_pack', help='pack variable-size batches against all budgets', action='store_true')
+    parser.add_argument('--semi_shuffle_cluster_size', help='partition size for semi_shuffle', default=500, type=int)
+    parser.add_argument('--min_protein_len', help='minimum length of included proteins', default=30, type=int)
+    parser.add_argument('--max_term_len', help='padded TERM length used in estimates', default=20, type=int)
+    parser.add_argument('--hidden_dim',
+                        help='hidden channels used to convert tensor sizes to GB',
+                        default=DEFAULT_MODEL_HPARAMS['energies_hidden_dim'],
+                        type=int)
+    parser.add_argument('--num_processes', help='processes used to read lengths', default=32, type=int)
+    parser.add_argument('--seed', help='random seed for shuffling', default=0, type=int)
+    args = parser.parse_args()
+
+    pdb_ids = None
+    if args.split:
+        with open(args.split) as fp:  # pylint: disable=unspecified-encoding
+            pdb_ids = [line.strip() for line in fp if line.strip()]
+    dataset = TERMLazyDataset(args.dataset,
+                              pdb_ids=pdb_ids,
+                              min_protein_len=args.min_protein_len,
+                              num_processes=args.num_processes)
+    print(f"{len(dataset)} proteins")
+
+    gb_per_entry = args.hidden_dim * 4 / 1024**3
+    print(f"{'mode':>12} {'budget':>22} {'batches':>8} {'term eff':>9} {'seq eff':>8} "
+          f"{'peak B*L^2':>12} {'GB':>7} {'peak B*T*k':>12} {'GB':>7}")
+    for config in _configs(args):
+        np.random.seed(args.seed)
+        sampler = simulate(dataset,
+                           max_seq_pairs=args.max_seq_pairs,
+                           bin_pack=args.bin_pack,
+                           semi_shuffle_cluster_size=args.semi_shuffle_cluster_size,
+                           **config)
+        stats = batch_stats(sampler.clusters, sampler.total_term_lengths, sampler.seq_lengths, args.max_term_len)
+        if config.get('batch_size'):
+            budget = f"batch_size={config['batch_size']}"
+        elif config.get('max_seq_tokens'):
+            budget = f"max_seq_tokens={config['max_seq_tokens']}"
+        else:
+            budget = f"max_term_res={config['max_term_res']}"
+        print(f"{config['mode']:>12} {budget:>22} {stats['num_batches']:>8} {stats['term_eff']:>9.3f} "
+              f"{stats['seq_eff']:>8.3f} {stats['peak_pairs']:>12} {stats['peak_pairs'] * gb_per_entry:>7.2f} "
+              f"{stats['peak_term_edges']:>12} {stats['peak_term_edges'] * gb_per_entry:>7.2f}")
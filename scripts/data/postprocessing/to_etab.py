@@ -23,6 +23,7 @@ import numpy as np
 from tqdm import tqdm
 
 from terminator.utils.common import int_to_3lt_AA
+from terminator.utils.pdb import read_backbone
 
 # pylint: disable=wrong-import-position,wrong-import-order,redefined-outer-name,unspecified-encoding
 
@@ -146,33 +147,10 @@ def get_idx_dict(pdb, chain_filter=None):
         Dictionary mapping indices used within TERMinator
         to indices used by the :code:`.red.pdb` file.
     """
-    idx_dict = {}
-    with open(pdb, 'r') as fp:
-        current_idx = 0
-        for line in fp:
-            data = line.strip()
-            if data == 'TER' or data == 'END':
-                continue
-            try:
-                chain = data[21]
-                # residx = int(data[22:26].strip())
-                # icode = data[26]
-                # if icode != ' ':
-                #     residx = str(residx) + icode
-                residx = data[22:27].strip()  # rip i didn't know about icodes
-
-            except Exception as e:
-                print(data)
-                raise e
-
-            if chain_filter:
-                if chain not in chain_filter:
-                    continue
-
-            if (chain, residx) not in idx_dict.values():
-                idx_dict[current_idx] = (chain, residx)
-                current_idx += 1
-
+    residue_ids = read_backbone(pdb)['residue_ids']
+    if chain_filter:
+        residue_ids = [residue_id for residue_id in residue_ids if residue_id[0] in chain_filter]
+    idx_dict = dict(enumerate(residue_ids))
     return idx_dict
 
 
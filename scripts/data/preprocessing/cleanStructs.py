@@ -6,25 +6,39 @@ Usage:
         python cleanStructs.py \\
             --in_list_path <pdb_paths_file> \\
             --out_folder <output_folder> \\
-            [-n <num_processes>]
+            [-n <num_processes>] \\
+            [--max_retries <max_retries>] \\
+            [--retry_failed]
 
     :code:`<pdb_paths_file>` should be a file of paths to .pdb files, with one path per line
 
     :code:`<output_folder>` will be where the outputted .red.pdb files are dumped, and will
     be structured as :code:`<output_folder>/<pdb_id>/<pdb_id>.red.pdb`
 
+    The state of every file is recorded in the job manifest :code:`<output_folder>/jobs.jsonl`
+    (see :code:`scripts/data/preprocessing/taskRunner.py`), so that rerunning the same command resumes an
+    interrupted run. :code:`--max_retries` sets how many times a failed file is retried within a run (defaults to 0),
+    and :code:`--retry_failed` also retries files that failed in previous runs.
+
 See :code:`python cleanStructs.py --help` for more info.
 """
 import argparse
 import multiprocessing as mp
 import os
 import sys
-import traceback
 
 import numpy as np
 
+from terminator.utils.pdb import ATOM_RECORDS, read_pdb_records, residue_index
+
+# for autosummary import purposes
+sys.path.insert(0, os.path.dirname(__file__))
+from taskRunner import run_tasks
+
 # pylint: disable=unspecified-encoding
 
+JOBS_FILE = "jobs.jsonl"
+
 
 def extractBackbone(filename, outpath):
     """Given a PDB structure, extract the protein backbone atoms and dump it in a redesigned PDB file.
@@ -37,55 +51,34 @@ def extractBackbone(filename, outpath):
         Prefix to place the output file (.red.pdb will be appended)
     """
     VALID_ELEMENTS = ['N', 'CA', 'C', 'O']
-    VALID_RECORD_TYPES = ['ATOM', 'HETATM']
-    struct_dict = {}
-    valid_entry_lines = []
-    with open(filename, 'r') as fp:
-        entry_lines = [l for l in fp]
-
-    for line_num, line in enumerate(entry_lines):
-        data = line.strip()
-        if data[:3] == 'TER' or data[:3] == 'END':
-            valid_entry_lines.append(line_num)
-            continue
-        record_type = data[0:6].strip()
-        if record_type not in VALID_RECORD_TYPES:
-            print(f"Skipping line: {data}")
-            continue
-
-        try:
-            element = data[13:16].strip()
-            residx = data[22:27].strip()
-            chain = data[21]
-        except Exception as e:
-            print(data)
-            raise e
-
-
-        if (chain, residx) not in struct_dict.keys():
-            struct_dict[(chain, residx)] = {"elements": np.array([False for _ in range(5)]), "line_numbers": []}
-
-        if element in VALID_ELEMENTS:
-            struct_dict[(chain, residx)]["elements"][VALID_ELEMENTS.index(element)] = True
-            struct_dict[(chain, residx)]["line_numbers"].append(line_num)
-        elif element == 'OXT':
-            struct_dict[(chain, residx)]["elements"][-1] = True
-            struct_dict[(chain, residx)]["oxt_num"] = line_num
-
-    for struct_vals in struct_dict.values():
-        elem_arr = struct_vals["elements"]
-        if elem_arr[:4].all():
-            # if we have N, CA, C, O, we take those lines
-            # and ignore OXT even if present
-            valid_entry_lines += struct_vals["line_numbers"]
-        elif elem_arr[[0, 1, 2, 4]].all() and not elem_arr[3]:
-            # if we have N, CA, C, OXT, but no O
-            # we take OXT as O
-            assert len(struct_vals["line_numbers"]) == 3, struct_vals["line_numbers"]
-            valid_entry_lines += struct_vals["line_numbers"]
-            valid_entry_lines.append(struct_vals["oxt_num"])
-
-    valid_entry_lines.sort()
+    records = read_pdb_records(filename)
+    # normalize line endings as reading in text mode does
+    entry_lines = [line.decode().replace('\r\n', '\n').replace('\r', '\n') for line in records['lines']]
+    record_type = records['record']
+    is_ter = np.char.startswith(record_type, 'TER') | np.char.startswith(record_type, 'END')
+    is_atom = np.isin(record_type, ATOM_RECORDS)
+    for line_num in np.flatnonzero(~is_ter & ~is_atom):
+        print(f"Skipping line: {entry_lines[line_num].strip()}")
+
+    # find which of N, CA, C, O, OXT each residue has
+    atom_lines = np.flatnonzero(is_atom)
+    element = records['name'][atom_lines]
+    _, residue_of_atom = residue_index(records['chain'][atom_lines], records['res_id'][atom_lines])
+    elem_arr = np.zeros((residue_of_atom.max(initial=-1) + 1, 5), dtype=bool)
+    for i, valid_element in enumerate(VALID_ELEMENTS + ['OXT']):
+        elem_arr[residue_of_atom[element == valid_element], i] = True
+    # if we have N, CA, C, O, we take those lines and ignore OXT even if present
+    has_o = elem_arr[:, :4].all(axis=1)
+    # if we have N, CA, C, OXT, but no O, we take OXT as O
+    has_oxt = elem_arr[:, [0, 1, 2, 4]].all(axis=1) & ~elem_arr[:, 3]
+    is_backbone = np.isin(element, VALID_ELEMENTS[:3]) & (has_o | has_oxt)[residue_of_atom]
+    is_backbone |= (element == 'O') & has_o[residue_of_atom]
+    # keep the last OXT of each residue
+    oxt_num = np.full(len(elem_arr), -1)
+    is_oxt = element == 'OXT'
+    np.maximum.at(oxt_num, residue_of_atom[is_oxt], atom_lines[is_oxt])
+    valid_entry_lines = np.concatenate([np.flatnonzero(is_ter), atom_lines[is_backbone], oxt_num[has_oxt]])
+    valid_entry_lines = np.sort(valid_entry_lines).tolist()
 
     with open(outpath, 'w') as fp:
         for idx, _ in enumerate(valid_entry_lines):
@@ -99,11 +92,6 @@ def extractBackbone(filename, outpath):
             fp.write(cur_line)
 
 
-def _raise_error(error):
-    """Wrapper for error handling without crashing"""
-    traceback.print_exception(Exception, error, None)
-
-
 # inner loop we wanna parallize
 def dataGen(in_path, out_folder):
     """Wrapper for :code:`extractBackbone` for path manipuation and error catching.
@@ -129,20 +117,26 @@ def dataGen(in_path, out_folder):
         raise e
 
 
-# when subprocesses fail you usually don't get an error...
-def generateCoordsDir(in_list, out_folder, num_cores=1):
+def generateCoordsDir(in_list, out_folder, num_cores=1, max_retries=0, retry_failed=False):
     """Parallelize :code:`dataGen` over a list of files.
 
+    Progress is recorded in the job manifest :code:`<out_folder>/jobs.jsonl` (see :code:`taskRunner.py`),
+    so that an interrupted run resumes where it stopped.
+
     Args
     ----
     in_list : list of paths
         List of input paths to :code:`dataGen`.
     out_folder : str
         Path to the output folder
+    num_cores : int, default=1
+        Number of processes to parallelize with
+    max_retries : int, default=0
+        Number of times a failed file is retried
+    retry_failed : bool, default=False
+        Whether to retry files that failed in previous runs
     """
     print('num cores', num_cores)
-    print(('warning! it seems that if subprocesses fail right now you don\'t get an error message. '
-           'be wary of this if the number of files you\'re getting seems off'))
     # make folder where the dataset files are gonna be placed
     if not os.path.exists(out_folder):
         os.mkdir(out_folder)
@@ -150,13 +144,16 @@ def generateCoordsDir(in_list, out_folder, num_cores=1):
     # generate absolute paths so i dont have to think about relative references
     out_folder = os.path.abspath(out_folder)
 
-    pool = mp.Pool(num_cores, maxtasksperchild=10)
+    tasks = {}
     for in_file in in_list:
         in_file = os.path.abspath(in_file)
-        pool.apply_async(dataGen, args=(in_file, out_folder), error_callback=_raise_error)
-
-    pool.close()
-    pool.join()
+        tasks[in_file] = (in_file, out_folder)
+    run_tasks(dataGen,
+              tasks,
+              os.path.join(out_folder, JOBS_FILE),
+              num_processes=num_cores,
+              max_retries=max_retries,
+              retry_failed=retry_failed)
     print("Done")
 
 
@@ -172,8 +169,17 @@ if __name__ == '__main__':
                               'folder organization is <out_folder>/<pdb_id>/<pdb_id>.red.pdb'),
                         required=True)
     parser.add_argument('-n', dest='num_cores', help='number of cores to use', default=1, type=int)
+    parser.add_argument('--max_retries', help='number of times to retry a failed file', default=0, type=int)
+    parser.add_argument('--retry_failed',
+                        help='if added, retry files that failed in previous runs',
+                        default=False,
+                        action='store_true')
     args = parser.parse_args()
     with open(args.in_list_path) as fp:
-        in_list = [l.strip() for l in fp]
+        in_list = [l.strip() for l in fp if l.strip()]
 
-    generateCoordsDir(in_list, args.out_folder, num_cores=args.num_cores)
+    generateCoordsDir(in_list,
+                      args.out_folder,
+                      num_cores=args.num_cores,
+                      max_retries=args.max_retries,
+                      retry_failed=args.retry_failed)
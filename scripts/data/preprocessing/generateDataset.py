@@ -8,9 +8,16 @@ Usage:
             --out_folder <output_folder> \\
             [--cutoff <matches_cutoff>] \\
             [-n <num_processes>] \\
+            [--split_dat_mb <size_in_mb>] \\
+            [--max_retries <max_retries>] \\
+            [--retry_failed] \\
             [-u] \\ # update existing files
             [--coords_only] \\
-            [--dummy_terms [None, 'replace', 'include']]
+            [--dummy_terms [None, 'replace', 'include']] \\
+            [--compact [float32, float16]] \\
+            [--subset <pdb_id_file>] \\
+            [--remove <pdb_id_file>] \\
+            [--manifest_only]
 
     :code:`--in_folder <input_folder>` should be structured as :code:`<input_folder>/<pdb_id>/<pdb_id>.<ext>`.
     For full feature generation, :code:`ext` must include :code:`.dat` and :code:`.red.pdb`, while
@@ -21,12 +28,25 @@ Usage:
     where :code:`<ext>` includes :code:`.features`, which specifies protein and TERM features, and
     :code:`.length`, which contains two integerss. The first integer specifies the number of TERM residues
     in the protein, while the second integer specifies the sequence length of the protein.
+    A dataset manifest :code:`<output_folder>/manifest.tsv` summarizing all feature files is also written
+    (see :code:`terminator/data/manifest.py`), which lets the dataset classes start up without reading every file.
 
     :code:`--cutoff <matches_cutoff>` restricts the number of matches featurized to the top :code:`<matches_cutoff>`,
     ranked by increasing RMSD. Defaults to 50.
 
     :code:`-n <num_processes>` specifies how many processes to use while processing. Defaults to 1.
 
+    :code:`--split_dat_mb <size_in_mb>` sets the size above which a :code:`.dat` file is parsed by all processes
+    at once, rather than by a single one, so that one huge complex doesn't hold up the end of the run.
+    These proteins are featurized once all others have been queued. Defaults to 1024.
+
+    The state of every protein is recorded in the job manifest :code:`<output_folder>/jobs.jsonl`
+    (see :code:`scripts/data/preprocessing/taskRunner.py`), together with the error, time and peak memory of its
+    last attempt, and a report is printed at the end of the run. Rerunning the same command resumes an
+    interrupted run: proteins that are done are skipped and the rest are featurized. :code:`--max_retries` sets
+    how many times a failed protein is retried within a run (defaults to 0), and :code:`--retry_failed` also
+    retries proteins that failed in previous runs.
+
     :code:`[-u]` is an optional flag which, if specified, forces rewriting of existing feature files.
 
     :code:`--coords_only` is an option flag which, if specified, generated only backbone-derived features.
@@ -39,6 +59,22 @@ Usage:
     only the dummy TERM is included. If set to :code:`'include'`, the first match is set to the dummy TERM match
     and the remaining TERMs are those parsed from the :code:`.dat` file.
 
+    :code:`--compact` stores feature arrays in compact dtypes (see :code:`terminator/data/compact.py`):
+    residue codes as uint8, indices as int16/int32, and real-valued features as float32, or float16 if
+    :code:`--compact float16` is given. Batches are cast back during collation, so compact and default
+    feature files can be mixed. This shrinks feature files several-fold.
+
+    :code:`--subset <pdb_id_file>` featurizes only the proteins listed in the file, found at
+    :code:`<input_folder>/<pdb_id>/<pdb_id>.red.pdb`, and registers them in the manifest without scanning the rest
+    of :code:`<output_folder>`. Use this to add new structures to an existing dataset: training jobs reading the
+    dataset lazily pick them up at their next epoch.
+
+    :code:`--remove <pdb_id_file>` deletes the feature files of the proteins listed in the file from
+    :code:`<output_folder>` and removes them from the manifest, skipping feature generation.
+
+    :code:`--manifest_only` is an optional flag which, if specified, skips feature generation and only
+    builds or updates the manifest of :code:`<output_folder>`, e.g. for datasets generated before manifests existed.
+
 See :code:`python generateDataset.py --help` for more info.
 """
 import argparse
@@ -47,23 +83,35 @@ import glob
 import multiprocessing as mp
 import os
 import sys
-import traceback
 
 # for autosummary import purposes
 sys.path.insert(0, os.path.dirname(__file__))
 from packageTensors import dumpCoordsTensors, dumpTrainingTensors
+from taskRunner import read_jobs, run_tasks
+
+from terminator.data.manifest import build_manifest, features_path, register_proteins, unregister_proteins
+
+
+JOBS_FILE = "jobs.jsonl"
 
 
-# when subprocesses fail you usually don't get an error...
 def generateDatasetParallel(in_folder,
                             out_folder,
                             cutoff=50,
                             num_cores=1,
                             update=True,
                             coords_only=False,
-                            dummy_terms=None):
+                            dummy_terms=None,
+                            compact=None,
+                            pdb_ids=None,
+                            split_dat_mb=1024,
+                            max_retries=0,
+                            retry_failed=False):
     """Parallelize :code:`dataGen` over a list of files.
 
+    Progress is recorded in the job manifest :code:`<out_folder>/jobs.jsonl` (see :code:`taskRunner.py`),
+    so that an interrupted run resumes where it stopped.
+
     Args
     ----
     in_folder : str
@@ -75,17 +123,27 @@ def generateDatasetParallel(in_folder,
     num_cores : int
         Number of processes to parallelize with
     update : bool
-        Whether or not to overwrite existing files
+        Whether or not to overwrite existing files, including those of proteins done in previous runs
     coords_only : bool
         Whether to use only backbone-derived features
     dummy_terms : str or None
         Method by which to incorperate dummy TERMs. Options include :code:`'replace'`,
         which means replacing TERM features with those derived from a dummy TERM, or
         :code:`'include'`, which includes the dummy TERM into the mined TERM matches.
+    compact : str or None
+        If set, store arrays in compact dtypes, with real-valued features as :code:`'float32'` or :code:`'float16'`
+    pdb_ids : list of str or None
+        If set, only featurize these proteins and register them in the existing manifest,
+        instead of processing every folder in :code:`in_folder` and rebuilding the manifest
+    split_dat_mb : float, default=1024
+        Size in MB above which the :code:`.dat` file of a protein is parsed in parallel over the pool.
+        These proteins are featurized in the main process, after all others have been queued.
+    max_retries : int, default=0
+        Number of times the featurization of a protein is retried after failing
+    retry_failed : bool, default=False
+        Whether to retry proteins that failed in previous runs
     """
     print('num cores', num_cores)
-    print(('warning! it seems that if subprocesses fail right now you don\'t get an error message. '
-           'be wary of this if the number of files you\'re getting seems off'))
     # make folder where the dataset files are gonna be placed
     if not os.path.exists(out_folder):
         os.mkdir(out_folder)
@@ -93,42 +151,71 @@ def generateDatasetParallel(in_folder,
     # generate absolute paths so i dont have to think about relative references
     in_folder = os.path.abspath(in_folder)
     out_folder = os.path.abspath(out_folder)
+    jobs_path = os.path.join(out_folder, JOBS_FILE)
+    known_jobs = read_jobs(jobs_path)
 
     os.chdir(in_folder)
 
-    process_func = functools.partial(dataGen, cutoff=cutoff, coords_only=coords_only, dummy_terms=dummy_terms)
+    process_func = functools.partial(dataGen,
+                                     cutoff=cutoff,
+                                     coords_only=coords_only,
+                                     dummy_terms=dummy_terms,
+                                     compact=compact)
 
-    pool = mp.Pool(num_cores, maxtasksperchild=10)
+    tasks = {}
+    large = []
+    if pdb_ids is not None:
+        # only visit the requested proteins, without listing the whole input folder
+        folder_files = [(pdb_id, [f"{pdb_id}/{pdb_id}.red.pdb"]) for pdb_id in pdb_ids]
+    else:
+        folder_files = ((folder, glob.glob(folder + '/*.red.pdb')) for folder in glob.glob("*"))
     # process folder by folder
-    for folder in glob.glob("*"):
+    for folder, files in folder_files:
         # folders that aren't directories aren't folders!
         if not os.path.isdir(folder):
+            if pdb_ids is not None:
+                print(f"{folder} not found in {in_folder}, skipping", file=sys.stderr)
             continue
 
         full_folder_path = os.path.join(out_folder, folder)
         if not os.path.exists(full_folder_path):
             os.mkdir(full_folder_path)
 
-        for _, file in enumerate(glob.glob(folder + '/*.red.pdb')):
+        for _, file in enumerate(files):
             name = file[:-len(".red.pdb")]
-            if not update:
+            # proteins in the job manifest are resumed from their recorded state, since their feature files
+            # may have been left incomplete. others are skipped if generated before job manifests existed
+            if not update and name not in known_jobs:
                 out_file = os.path.join(out_folder, name)
                 if os.path.exists(out_file + '.features'):
                     continue
 
-            pool.apply_async(process_func, args=(file, out_folder), error_callback=_raise_error)
+            tasks[name] = (file, out_folder)
+            dat_file = name + '.dat'
+            if not coords_only and os.path.exists(dat_file) and os.path.getsize(dat_file) > split_dat_mb * 1024**2:
+                # parse huge .dat files over the whole pool, once the other proteins are queued
+                large.append(name)
 
-    pool.close()
-    pool.join()
+    records = run_tasks(process_func,
+                        tasks,
+                        jobs_path,
+                        num_processes=num_cores,
+                        max_retries=max_retries,
+                        retry_failed=retry_failed,
+                        rerun=update,
+                        main_process_tasks=large)
+    generated = [os.path.basename(name) for name, record in records.items() if record['status'] == 'done']
 
-
-def _raise_error(error):
-    """Wrapper for error handling without crashing"""
-    traceback.print_exception(Exception, error, None)
+    # summarize the dataset so that datasets don't have to open every file on startup
+    if pdb_ids is not None:
+        generated = [pdb_id for pdb_id in generated if os.path.exists(features_path(out_folder, pdb_id))]
+        register_proteins(out_folder, generated, num_processes=num_cores)
+    else:
+        build_manifest(out_folder, pdb_ids=generated, num_processes=num_cores)
 
 
 # inner loop we wanna parallize
-def dataGen(file, out_folder, cutoff, coords_only, dummy_terms):
+def dataGen(file, out_folder, cutoff, coords_only, dummy_terms, compact=None, pool=None):
     """Wrapper function for parallelization which deals with paths and other args.
 
     Args
@@ -145,19 +232,25 @@ def dataGen(file, out_folder, cutoff, coords_only, dummy_terms):
         Method by which to incorperate dummy TERMs. Options include :code:`'replace'`,
         which means replacing TERM features with those derived from a dummy TERM, or
         :code:`'include'`, which includes the dummy TERM into the mined TERM matches.
+    compact : str or None, default=None
+        If set, store arrays in compact dtypes, with real-valued features as :code:`'float32'` or :code:`'float16'`
+    pool : concurrent.futures.Executor or None, default=None
+        If set, parse the TERMs of the :code:`.dat` file in parallel over this process pool
     """
     name = file[:-len(".red.pdb")]
     out_file = os.path.join(out_folder, name)
     print('out file', out_file)
     try:
         if coords_only:
-            dumpCoordsTensors(name, out_path=out_file)
+            dumpCoordsTensors(name, out_path=out_file, compact=compact)
         else:
             dumpTrainingTensors(name,
                                 out_path=out_file,
                                 cutoff=cutoff,
                                 coords_only=coords_only,
-                                dummy_terms=dummy_terms)
+                                dummy_terms=dummy_terms,
+                                compact=compact,
+                                pool=pool)
     except Exception as e:
         print(out_file, file=sys.stderr)
         raise e
@@ -173,6 +266,15 @@ if __name__ == '__main__':
     parser.add_argument('--out_folder', help='folder where features will be placed', required=True)
     parser.add_argument('--cutoff', dest='cutoff', help='max number of match entries per TERM', default=50, type=int)
     parser.add_argument('-n', dest='num_cores', help='number of processes to use', default=1, type=int)
+    parser.add_argument('--split_dat_mb',
+                        help='size in MB above which a .dat file is parsed by all processes at once',
+                        default=1024,
+                        type=float)
+    parser.add_argument('--max_retries', help='number of times to retry a failed protein', default=0, type=int)
+    parser.add_argument('--retry_failed',
+                        help='if added, retry proteins that failed in previous runs',
+                        default=False,
+                        action='store_true')
     parser.add_argument('-u',
                         dest='update',
                         help='if added, update existing files. else, files that already exist will not be overwritten',
@@ -184,11 +286,45 @@ if __name__ == '__main__':
                         default=False,
                         action='store_true')
     parser.add_argument('--dummy_terms', help='option for how to use dummy TERMs in the feature files', default=None)
+    parser.add_argument('--compact',
+                        help='store features in compact dtypes, with real values as float32 (default) or float16',
+                        nargs='?',
+                        const='float32',
+                        default=None,
+                        choices=['float32', 'float16'])
+    parser.add_argument('--subset', help='file listing the PDB ids to featurize and add to the dataset')
+    parser.add_argument('--remove', help='file listing the PDB ids to delete from the dataset')
+    parser.add_argument('--manifest_only',
+                        help='if added, only build the manifest of the existing feature files in out_folder',
+                        default=False,
+                        action='store_true')
     args = parser.parse_args()
+    if args.manifest_only:
+        build_manifest(args.out_folder, num_processes=args.num_cores)
+        sys.exit(0)
+    if args.remove:
+        with open(args.remove) as fp:  # pylint: disable=unspecified-encoding
+            removed = [line.strip() for line in fp if line.strip()]
+        unregister_proteins(args.out_folder, removed)
+        for pdb_id in removed:
+            for ext in ['.features', '.length']:
+                path = os.path.join(args.out_folder, pdb_id, pdb_id + ext)
+                if os.path.exists(path):
+                    os.remove(path)
+        sys.exit(0)
+    subset = None
+    if args.subset:
+        with open(args.subset) as fp:  # pylint: disable=unspecified-encoding
+            subset = [line.strip() for line in fp if line.strip()]
     generateDatasetParallel(args.in_folder,
                             args.out_folder,
                             cutoff=args.cutoff,
                             num_cores=args.num_cores,
                             update=args.update,
                             coords_only=args.coords_only,
-                            dummy_terms=args.dummy_terms)
+                            dummy_terms=args.dummy_terms,
+                            compact=args.compact,
+                            pdb_ids=subset,
+                            split_dat_mb=args.split_dat_mb,
+                            max_retries=args.max_retries,
+                            retry_failed=args.retry_failed)
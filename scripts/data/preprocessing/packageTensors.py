@@ -5,6 +5,7 @@ import sys
 
 import numpy as np
 
+from terminator.data.compact import compact_features
 from terminator.utils.common import seq_to_ints
 
 # for autosummary import purposes
@@ -16,7 +17,14 @@ NUM_AA = 21  # including X
 ZERO = 1e-10  # 0 is used for padding
 
 
-def dumpTrainingTensors(in_path, out_path=None, cutoff=1000, save=True, coords_only=False, dummy_terms=None):
+def dumpTrainingTensors(in_path,
+                        out_path=None,
+                        cutoff=1000,
+                        save=True,
+                        coords_only=False,
+                        dummy_terms=None,
+                        compact=None,
+                        pool=None):
     """Generate features from dTERMen :code:`.dat` and :code:`.red.pdb`, and
     dump the output into a file if requested.
 
@@ -36,6 +44,11 @@ def dumpTrainingTensors(in_path, out_path=None, cutoff=1000, save=True, coords_o
         Method by which to incorperate dummy TERMs. Options include :code:`'replace'`,
         which means replacing TERM features with those derived from a dummy TERM, or
         :code:`'include'`, which includes the dummy TERM into the mined TERM matches.
+    compact : str or None, default=None
+        If set, store arrays in compact dtypes (see :code:`terminator.data.compact`), with real-valued
+        features stored as :code:`'float32'` or :code:`'float16'`. If :code:`None`, keep numpy's default dtypes.
+    pool : multiprocessing.pool.Pool, concurrent.futures.Executor or None, default=None
+        If set, parse the TERMs of the :code:`.dat` file in parallel over this process pool
 
     Returns
     -------
@@ -49,7 +62,8 @@ def dumpTrainingTensors(in_path, out_path=None, cutoff=1000, save=True, coords_o
         cutoff = 1
 
     coords, _ = parseCoords(in_path + '.red.pdb', save=False)
-    data = parseTERMdata(in_path + '.dat')
+    # only the top matches are featurized, so skip parsing the rest. 'include' prepends the dummy TERM to them
+    data = parseTERMdata(in_path + '.dat', cutoff=cutoff - 1 if dummy_terms == 'include' else cutoff, pool=pool)
     # etab, self_etab, _ = parseEtab(in_path + '.etab', save=False)
 
     selection = data['selection']
@@ -67,101 +81,57 @@ def dumpTrainingTensors(in_path, out_path=None, cutoff=1000, save=True, coords_o
     struct_cos_ppo[struct_is_999] = 0
     struct_embedded_ppoe = np.concatenate([struct_sin_ppo, struct_cos_ppo, struct_env], axis=1)
 
-    term_msas = []
-    term_features = []
-    term_focuses = []
-    term_contact_idxs = []
-    term_lens = []
-    # compute TERM features
-    for term_data in data['terms']:
-        focus = term_data['focus']
-        # only take data for residues that are in the selection
-        take = [i for i in range(len(focus)) if focus[i] in selection]
-
-        msa = term_data['labels']
-        # apply take
-        msa = np.take(msa, take, axis=-1)
-        if dummy_terms is None:
-            # cutoff MSAs at top N
-            term_msas.append(msa[:cutoff])
-        elif dummy_terms == 'replace':
-            # replace the whole TERM with one sequence of only X
-            term_msas.append(np.ones_like(msa[:1]).astype(int) * 20)
-        elif dummy_terms == "include":
-            dummy_seq = np.ones_like(msa[:1]).astype(int) * 20
-            term_msas.append(np.concatenate([dummy_seq, msa[:cutoff - 1]]))
-
-        # add focus
-        focus_take = [item for item in focus if item in selection]
-        term_focuses += focus_take
-        # add contact idx
-        contact_idx = term_data['contact_idx']
-        contact_idx_take = [contact_idx[i] for i in range(len(contact_idx)) if focus[i] in selection]
-        term_contact_idxs += contact_idx_take
-        # append term len, the len of the focus
-        term_lens.append(len(focus_take))
-
-        # process ppoe
-        if dummy_terms is None:
-            ppoe = term_data['ppoe']
-        elif dummy_terms == "replace":
-            ppoe = np.expand_dims(struct_ppoe[focus].transpose(1, 0), 0)
-        elif dummy_terms == "include":
-            dummy_ppoe = np.expand_dims(struct_ppoe[focus].transpose(1, 0), 0)
-            ppoe = np.concatenate([dummy_ppoe, term_data['ppoe']], axis=0)
-        term_len = ppoe.shape[2]
-        num_alignments = ppoe.shape[0]
-        # project to sin, cos
-        ppo_rads = ppoe[:, :3] / 180 * np.pi
-        is_999 = (ppoe[:, :3] == 999)
-        sin_ppo = np.sin(ppo_rads)
-        cos_ppo = np.cos(ppo_rads)
-        # zero out dihedrals where there is no dihedral angle
-        sin_ppo[is_999] = 0
-        cos_ppo[is_999] = 0
-        env = ppoe[:, 3:]
-
-        # apply take
-        ppoe = np.take(ppoe, take, axis=-1)
-
-        # place rmsds into np array
-        if dummy_terms is None:
-            rmsd = np.expand_dims(term_data['rmsds'], 1)
-        elif dummy_terms == "include":
-            rmsd = np.concatenate([
-                np.array([ZERO]),
-                term_data['rmsds'],
-            ], axis=0)
-            rmsd = np.expand_dims(rmsd, 1)
-        rmsd_arr = np.concatenate([rmsd for _ in range(term_len)], axis=1)
-        rmsd_arr = np.expand_dims(rmsd_arr, 1)
-        if dummy_terms == 'replace':
-            # we set the RMSD of the true match to be 0
-            rmsd_arr = np.ones_like(rmsd_arr) * ZERO
-        term_len_arr = np.zeros((cutoff, 1, term_len))
-        term_len_arr += term_len
-        num_alignments_arr = np.zeros((cutoff, 1, term_len))
-        num_alignments_arr += num_alignments
-
-        # select features, cutoff at top N
-        selected_features = [sin_ppo[:cutoff], cos_ppo[:cutoff], env[:cutoff], rmsd_arr[:cutoff], term_len_arr]
-
-        features = np.concatenate(selected_features, axis=1)
-
-        # pytorch does row vector computation
-        # swap rows and columns
-        features = features.transpose(0, 2, 1)
-        term_features.append(features)
-
-    msa_tensor = np.concatenate(term_msas, axis=-1)
-    features_tensor = np.concatenate(term_features, axis=1)
-    len_tensor = np.array(term_lens)
-    term_focuses = np.array(term_focuses)
-    term_contact_idxs = np.array(term_contact_idxs)
-
-    # package cov matrices into one tensor
-    max_term_len = max(term_lens)
-    num_terms = len(term_lens)
+    # featurize all TERMs at once, with the residues of all TERMs laid out along one axis
+    terms = data['terms']
+    focus_lens = np.array([len(term_data['focus']) for term_data in terms])
+    focuses = np.concatenate([term_data['focus'] for term_data in terms]).astype(int)
+    contact_idxs = np.concatenate([term_data['contact_idx'] for term_data in terms]).astype(int)
+    # only take data for residues that are in the selection
+    take = np.isin(focuses, selection)
+    num_residues = len(focuses)
+
+    # cutoff matches at top N. dummy TERMs take the place of the first match
+    num_matches = {None: cutoff, 'include': cutoff - 1, 'replace': 0}[dummy_terms]
+    short_terms = [term_data['idx'] for term_data in terms if len(term_data['rmsds']) < num_matches]
+    if short_terms:
+        raise ValueError(f"TERMs {short_terms} of {in_path}.dat have fewer than {num_matches} matches")
+    if num_matches > 0:
+        msa = np.concatenate([term_data['labels'][:num_matches] for term_data in terms], axis=1)
+        ppoe = np.concatenate([term_data['ppoe'][:num_matches] for term_data in terms], axis=2)
+        rmsd = np.repeat(np.stack([term_data['rmsds'][:num_matches] for term_data in terms], axis=1),
+                         focus_lens,
+                         axis=1)
+    else:
+        msa = np.zeros((0, num_residues), dtype=int)
+        ppoe = np.zeros((0, 4, num_residues))
+        rmsd = np.zeros((0, num_residues))
+    if dummy_terms is not None:
+        # the dummy TERM has one sequence of only X, the structural features of the target, and an RMSD of 0
+        msa = np.concatenate([np.full((1, num_residues), 20), msa])
+        ppoe = np.concatenate([np.expand_dims(struct_ppoe[focuses].transpose(1, 0), 0), ppoe])
+        rmsd = np.concatenate([np.full((1, num_residues), ZERO), rmsd])
+
+    # project to sin, cos
+    ppo_rads = ppoe[:, :3] / 180 * np.pi
+    is_999 = (ppoe[:, :3] == 999)
+    sin_ppo = np.sin(ppo_rads)
+    cos_ppo = np.cos(ppo_rads)
+    # zero out dihedrals where there is no dihedral angle
+    sin_ppo[is_999] = 0
+    cos_ppo[is_999] = 0
+    env = ppoe[:, 3:]
+    term_len_arr = np.broadcast_to(np.repeat(focus_lens, focus_lens).astype(float), env.shape)
+
+    features = np.concatenate([sin_ppo, cos_ppo, env, np.expand_dims(rmsd, 1), term_len_arr], axis=1)
+    # pytorch does row vector computation
+    # swap rows and columns
+    features_tensor = features.transpose(0, 2, 1)[:, take]
+    msa_tensor = msa[:, take]
+    term_focuses = focuses[take]
+    term_contact_idxs = contact_idxs[take]
+    # term len, the len of the focus in the selection
+    len_tensor = np.bincount(np.repeat(np.arange(len(terms)), focus_lens), weights=take, minlength=len(terms))
+    len_tensor = len_tensor.astype(int)
 
     # check that sum of term lens is as long as the feature tensor
     assert sum(len_tensor) == features_tensor.shape[1]
@@ -209,6 +179,9 @@ def dumpTrainingTensors(in_path, out_path=None, cutoff=1000, save=True, coords_o
             'chain_lens': data['chain_lens']
         }
 
+    if compact is not None:
+        output = compact_features(output, float_dtype=np.dtype(compact))
+
     if save:
         assert out_path, "out_path required if save=True"
 
@@ -222,7 +195,7 @@ def dumpTrainingTensors(in_path, out_path=None, cutoff=1000, save=True, coords_o
     return output
 
 
-def dumpCoordsTensors(in_path, out_path=None, save=True):
+def dumpCoordsTensors(in_path, out_path=None, save=True, compact=None):
     """Create a feature file based only on the coordinate information,
     placing dummy arrays for all TERM based items.
 
@@ -234,6 +207,9 @@ def dumpCoordsTensors(in_path, out_path=None, save=True):
         Prefix to the output :code:`.features` and :code:`.length`. Can be None if :code:`save=False`.
     save : bool, default=True
         Whether or not to save the training tensors
+    compact : str or None, default=None
+        If set, store arrays in compact dtypes (see :code:`terminator.data.compact`), with real-valued
+        features stored as :code:`'float32'` or :code:`'float16'`. If :code:`None`, keep numpy's default dtypes.
 
     Returns
     -------
@@ -270,6 +246,9 @@ def dumpCoordsTensors(in_path, out_path=None, save=True):
         'chain_lens': chain_lens
     }
 
+    if compact is not None:
+        output = compact_features(output, float_dtype=np.dtype(compact))
+
     if save:
         assert out_path, "out_path required if save=True"
         with open(out_path + '.features', 'wb') as fp:
@@ -0,0 +1,89 @@
+"""Convert a folder of feature files into a memory-mapped shard store, a tar store for streaming,
+or a match store with deduplicated TERM matches.
+
+Usage:
+    .. code-block::
+
+        python shardDataset.py \\
+            --in_folder <input_folder> \\
+            --out_folder <output_folder> \\
+            [--subset <data_subset_file>] \\
+            [--shard_size <proteins_per_shard>] \\
+            [--tar] \\
+            [--match_store] \\
+            [--compact [float32, float16]]
+
+    :code:`--in_folder <input_folder>` should be a dataset folder generated by
+    :code:`scripts/data/preprocessing/generateDataset.py`.
+
+    :code:`--out_folder <output_folder>` will contain the shard store, which can be loaded using
+    :code:`terminator.data.shards.TERMShardDataset` or by passing :code:`--shards` to
+    :code:`scripts/models/train/train.py` and :code:`scripts/models/eval/eval.py`.
+    Any split files (:code:`*.in`) in :code:`<input_folder>` are copied over.
+
+    :code:`--subset <data_subset_file>` restricts the store to the PDB ids listed in the file.
+    If not provided, every protein in :code:`<input_folder>` is included.
+
+    :code:`--shard_size <proteins_per_shard>` specifies how many proteins are stored per shard. Defaults to 1000.
+
+    If :code:`--tar` is set, the feature files are instead packed into tar shards, which are read sequentially
+    by :code:`terminator.data.stream.TERMStreamDataset` or by passing :code:`--stream` to
+    :code:`scripts/models/train/train.py`. This suits filesystems where opening many small files is slow.
+
+    If :code:`--match_store` is set, each unique TERM match is instead stored once in a match table shared across
+    proteins, and per-protein feature files only reference it (see :code:`terminator/data/match_store.py`).
+    The store is read by :code:`terminator.data.match_store.TERMMatchStoreDataset` or by passing
+    :code:`--match_store` to :code:`scripts/models/train/train.py` and :code:`scripts/models/eval/eval.py`.
+    :code:`--shard_size` and :code:`--compact` do not apply; match stores always use compact dtypes.
+
+    :code:`--compact` converts the arrays to compact dtypes while writing the store
+    (see :code:`scripts/data/preprocessing/generateDataset.py --compact`).
+
+See :code:`python shardDataset.py --help` for more info.
+"""
+import argparse
+import glob
+import os
+import shutil
+
+from terminator.data.match_store import write_match_store
+from terminator.data.shards import write_shard_store
+from terminator.data.stream import write_tar_store
+
+# pylint: disable=unspecified-encoding
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Convert feature files into a memory-mapped shard store')
+    parser.add_argument('--in_folder',
+                        help='input folder .features files in proper directory structure',
+                        required=True)
+    parser.add_argument('--out_folder', help='folder where the shard store will be placed', required=True)
+    parser.add_argument('--subset', help='file specifying subset of dataset to include')
+    parser.add_argument('--shard_size', help='number of proteins per shard', default=1000, type=int)
+    parser.add_argument('--tar', help='write tar shards for streaming instead', action='store_true')
+    parser.add_argument('--match_store',
+                        help='write a match store with deduplicated TERM matches instead',
+                        action='store_true')
+    parser.add_argument('--compact',
+                        help='store features in compact dtypes, with real values as float32 (default) or float16',
+                        nargs='?',
+                        const='float32',
+                        default=None,
+                        choices=['float32', 'float16'])
+    args = parser.parse_args()
+
+    pdb_ids = None
+    if args.subset:
+        with open(args.subset, 'r') as f:
+            pdb_ids = [line.strip() for line in f if line.strip()]
+
+    if args.match_store:
+        table = write_match_store(args.in_folder, args.out_folder, pdb_ids=pdb_ids)
+        print(f"Stored {table.num_unique} unique TERM matches out of {table.num_matches}")
+    else:
+        write_store = write_tar_store if args.tar else write_shard_store
+        write_store(args.in_folder, args.out_folder, pdb_ids=pdb_ids, shard_size=args.shard_size, compact=args.compact)
+
+    # carry over dataset splits so that train.py can find them in the store folder
+    for split_file in glob.glob(os.path.join(args.in_folder, '*.in')):
+        shutil.copy(split_file, args.out_folder)
@@ -0,0 +1,364 @@
+"""Resumable runner for preprocessing tasks, used by :code:`generateDataset.py` and :code:`cleanStructs.py`.
+
+The state of every task is kept in a job manifest, a JSON-lines file appended to on each state change,
+so that an interrupted run restarts exactly where it stopped: tasks that finished are skipped, and tasks that were
+running or never started are queued again. Each record holds
+
+- :code:`task` - the id of the task
+- :code:`status` - one of :code:`pending`, :code:`running`, :code:`done` or :code:`failed`
+- :code:`attempts` - the number of times the task has been started
+- :code:`error` - the traceback of the last failed attempt
+- :code:`seconds` - the wall time of the last attempt
+- :code:`max_rss_mb` - the peak resident memory of the process running the last attempt, while it ran
+
+Tasks are run on a process pool with a bounded number of tasks in flight, so that queuing 100k structures
+doesn't hold all of them in memory at once. Failed attempts are retried up to a given number of times, and
+a worker process dying (e.g. killed for running out of memory) fails the tasks in flight instead of hanging the run,
+as the pool can't tell which of them killed it.
+A report of the run is printed at the end.
+
+Usage:
+    .. code-block::
+
+        python taskRunner.py \\
+            --jobs <jobs_file> \\
+            [--reset [failed, running, all]]
+
+    Print the report of the job manifest :code:`<jobs_file>`, e.g. :code:`<output_folder>/jobs.jsonl` of
+    :code:`generateDataset.py`. :code:`--reset` marks failed, running or all tasks as pending, so that the next run
+    retries them.
+
+See :code:`python taskRunner.py --help` for more info.
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import resource
+import sys
+import time
+import traceback
+
+# pylint: disable=unspecified-encoding
+
+STATUSES = ('pending', 'running', 'done', 'failed')
+# whether process pools can replace their workers themselves
+_NATIVE_RECYCLING = sys.version_info >= (3, 11)
+
+
+def read_jobs(path):
+    """Read the latest record of each task from a job manifest.
+
+    Args
+    ----
+    path : str
+        Path to the job manifest
+
+    Returns
+    -------
+    dict
+        Latest record of each task, keyed by task id. Empty if the job manifest doesn't exist.
+    """
+    jobs = {}
+    if not os.path.exists(path):
+        return jobs
+    with open(path) as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a line cut short by an interruption
+                continue
+            jobs[record['task']] = record
+    return jobs
+
+
+class JobManifest:
+    """Persistent state of a set of tasks, backed by a JSON-lines file.
+
+    Records are appended as tasks change state, and the last record of each task wins. On load,
+    the file is compacted to one record per task.
+
+    Attributes
+    ----------
+    path : str
+        Path to the job manifest
+    jobs : dict
+        Latest record of each task, keyed by task id, in the order tasks were first added
+    """
+    def __init__(self, path):
+        """
+        Args
+        ----
+        path : str
+            Path to the job manifest. Created if it doesn't exist.
+        """
+        self.path = path
+        self.jobs = read_jobs(path)
+        if os.path.exists(path):
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as fp:
+                fp.writelines(json.dumps(record) + '\n' for record in self.jobs.values())
+            os.replace(tmp_path, path)
+        self._fp = open(path, 'a')  # pylint: disable=consider-using-with
+
+    def update(self, task, **fields):
+        """Update the record of :code:`task` and append it to the job manifest
+
+        Args
+        ----
+        task : str
+            Task id
+        **fields
+            Fields of the record to set, e.g. :code:`status`
+        """
+        record = self.jobs.setdefault(task, {'task': task, 'status': 'pending', 'attempts': 0})
+        record.update(fields, updated=time.time())
+        self._fp.write(json.dumps(record) + '\n')
+        self._fp.flush()
+
+    def reset(self, statuses):
+        """Mark tasks with any of :code:`statuses` as pending"""
+        for task, record in list(self.jobs.items()):
+            if record['status'] in statuses:
+                self.update(task, status='pending')
+
+    def close(self):
+        """Close the job manifest"""
+        self._fp.close()
+
+
+def _max_rss_mb():
+    """Peak resident memory of the current process, in MB"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return max_rss / 1024**2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def _reset_max_rss():
+    """Reset the peak resident memory of the current process to its current resident memory
+
+    Returns
+    -------
+    bool
+        Whether the peak could be reset, which is only supported on Linux
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def _run_task(func, args, kwargs=None):
+    """Run :code:`func(*args, **kwargs)`, catching any error
+
+    Returns
+    -------
+    error : str or None
+        Traceback of the error raised by :code:`func`, if any
+    seconds : float
+        Wall time of the call
+    max_rss_mb : float or None
+        Peak resident memory of the process during the call, in MB. :code:`None` if unknown, i.e. if the
+        peak of the process can't be reset and the call stayed under the peak of earlier tasks.
+    """
+    # workers outlive tasks, so start from the current memory rather than the peak of earlier tasks
+    reset = _reset_max_rss()
+    max_rss_before = _max_rss_mb()
+    start = time.perf_counter()
+    error = None
+    try:
+        func(*args, **(kwargs or {}))
+    except Exception:  # pylint: disable=broad-except
+        error = traceback.format_exc()
+    seconds = time.perf_counter() - start
+    max_rss = _max_rss_mb()
+    return error, seconds, max_rss if reset or max_rss > max_rss_before else None
+
+
+def _executor(num_processes, max_tasks_per_child):
+    """Process pool of :code:`num_processes` workers, replaced every :code:`max_tasks_per_child` tasks if supported"""
+    if _NATIVE_RECYCLING and max_tasks_per_child:
+        return concurrent.futures.ProcessPoolExecutor(num_processes, max_tasks_per_child=max_tasks_per_child)
+    return concurrent.futures.ProcessPoolExecutor(num_processes)
+
+
+def run_tasks(func,
+              tasks,
+              jobs_path,
+              num_processes=1,
+              max_in_flight=None,
+              max_retries=0,
+              retry_failed=False,
+              rerun=False,
+              main_process_tasks=(),
+              max_tasks_per_child=10):
+    """Run :code:`func` on every task not yet done in the job manifest.
+
+    Args
+    ----
+    func : callable
+        Function run on the arguments of each task. Must be picklable, i.e. defined at module level.
+    tasks : dict
+        Arguments tuple of each task, keyed by task id. Tasks are started in this order.
+    jobs_path : str
+        Path to the job manifest. Tasks recorded as done are skipped.
+    num_processes : int, default=1
+        Number of worker processes
+    max_in_flight : int or None, default=None
+        Max number of tasks submitted to the workers at once. Defaults to twice the number of processes.
+    max_retries : int, default=0
+        Number of times a failed task is retried within this run
+    retry_failed : bool, default=False
+        Whether to retry tasks recorded as failed by previous runs
+    rerun : bool, default=False
+        Whether to rerun tasks recorded as done by previous runs
+    main_process_tasks : collection of str, default=()
+        Ids of tasks to run in the main process rather than on a worker, with the worker pool passed as
+        :code:`func(*args, pool=pool)`, e.g. to spread a huge task over the pool. They are run once
+        every other task has been submitted.
+    max_tasks_per_child : int or None, default=10
+        Number of tasks after which a worker process is replaced, to release memory. Before Python 3.11,
+        the whole pool is replaced once it was given this many tasks per worker, and the old pool finishes
+        its tasks in the background.
+
+    Returns
+    -------
+    dict
+        Latest record of each task in :code:`tasks`
+    """
+    jobs = JobManifest(jobs_path)
+    skip = {'done'} if not rerun else set()
+    if not retry_failed:
+        skip.add('failed')
+    queue, main_queue = collections.deque(), collections.deque()
+    for task in tasks:
+        status = jobs.jobs.get(task, {}).get('status')
+        if status in skip:
+            continue
+        if status != 'pending':
+            jobs.update(task, status='pending')
+        (main_queue if task in main_process_tasks else queue).append(task)
+    max_in_flight = max_in_flight or 2 * num_processes
+    retries = collections.Counter()
+
+    def finish(task, error, seconds, max_rss_mb):
+        attempts = jobs.jobs[task]['attempts']
+        if error is None:
+            jobs.update(task, status='done', error=None, seconds=seconds, max_rss_mb=max_rss_mb)
+            return
+        print(f"task {task} failed (attempt {attempts}):\n{error}", file=sys.stderr)
+        jobs.update(task, status='failed', error=error, seconds=seconds, max_rss_mb=max_rss_mb)
+        if retries[task] < max_retries:
+            retries[task] += 1
+            jobs.update(task, status='pending')
+            (main_queue if task in main_process_tasks else queue).append(task)
+
+    print(f"{len(queue) + len(main_queue)} of {len(tasks)} tasks to run")
+    executor = _executor(num_processes, max_tasks_per_child)
+    # number of tasks after which the pool is replaced, if it can't replace its workers itself
+    recycle_after = num_processes * max_tasks_per_child if max_tasks_per_child and not _NATIVE_RECYCLING else None
+    num_submitted = 0
+    in_flight = {}
+    start = time.perf_counter()
+    try:
+        while queue or main_queue or in_flight:
+            while queue and len(in_flight) < max_in_flight:
+                if recycle_after and num_submitted >= recycle_after:
+                    # the old pool finishes its tasks in flight, then its workers exit
+                    executor.shutdown(wait=False)
+                    executor = _executor(num_processes, max_tasks_per_child)
+                    num_submitted = 0
+                task = queue.popleft()
+                jobs.update(task, status='running', attempts=jobs.jobs[task]['attempts'] + 1)
+                in_flight[executor.submit(_run_task, func, tasks[task])] = task, executor
+                num_submitted += 1
+            if not queue and main_queue:
+                # every other task is on the workers, so the pool is free to help with this one
+                task = main_queue.popleft()
+                jobs.update(task, status='running', attempts=jobs.jobs[task]['attempts'] + 1)
+                finish(task, *_run_task(func, tasks[task], {'pool': executor}))
+                continue
+
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                task, task_executor = in_flight.pop(future)
+                try:
+                    finish(task, *future.result())
+                except concurrent.futures.process.BrokenProcessPool:
+                    # futures of a pool already replaced keep failing, and mustn't replace the current one
+                    broken = broken or task_executor is executor
+                    finish(task, "worker process died while running this task or another one", None, None)
+            if broken:
+                # the pool can't run any more tasks, so start a new one
+                executor.shutdown(wait=False)
+                executor = _executor(num_processes, max_tasks_per_child)
+                num_submitted = 0
+    finally:
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown()
+        jobs.close()
+    print(f"ran for {time.perf_counter() - start:.1f} s")
+    records = {task: jobs.jobs[task] for task in tasks}
+    print(report(records))
+    return records
+
+
+def report(records, num_slowest=5):
+    """Summarize a set of task records.
+
+    Args
+    ----
+    records : dict
+        Record of each task, keyed by task id, as in :code:`JobManifest.jobs`
+    num_slowest : int, default=5
+        Number of slowest tasks to list
+
+    Returns
+    -------
+    str
+        Report listing the number of tasks per status, the time and peak memory over finished tasks,
+        the slowest tasks, and the last error of every failed task
+    """
+    counts = collections.Counter(record['status'] for record in records.values())
+    lines = ['  '.join(f"{status}: {counts[status]}" for status in STATUSES)]
+    timed = [record for record in records.values() if record['status'] == 'done' and 'seconds' in record]
+    if timed:
+        seconds = sorted(record['seconds'] for record in timed)
+        lines.append(f"task time: total {sum(seconds):.1f} s, median {seconds[len(seconds) // 2]:.2f} s, "
+                     f"max {seconds[-1]:.2f} s")
+        max_rss = [record['max_rss_mb'] for record in timed if record['max_rss_mb'] is not None]
+        if max_rss:
+            lines.append(f"peak memory: {max(max_rss):.0f} MB")
+        lines.append("slowest tasks:")
+        for record in sorted(timed, key=lambda record: -record['seconds'])[:num_slowest]:
+            memory = '?' if record['max_rss_mb'] is None else f"{record['max_rss_mb']:.0f}"
+            lines.append(f"  {record['task']}: {record['seconds']:.2f} s, {memory} MB")
+    failed = [record for record in records.values() if record['status'] == 'failed']
+    if failed:
+        lines.append("failed tasks:")
+        for record in failed:
+            error = (record.get('error') or '').strip().splitlines()
+            lines.append(f"  {record['task']} (attempts: {record['attempts']}): {error[-1] if error else ''}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Report on or reset the tasks of a job manifest')
+    parser.add_argument('--jobs', help='job manifest, e.g. <output_folder>/jobs.jsonl', required=True)
+    parser.add_argument('--reset',
+                        help='mark failed, running or all tasks as pending',
+                        nargs='*',
+                        default=[],
+                        choices=['failed', 'running', 'all'])
+    args = parser.parse_args()
+    manifest = JobManifest(args.jobs)
+    if args.reset:
+        manifest.reset(STATUSES if 'all' in args.reset else args.reset)
+    manifest.close()
+    print(report(manifest.jobs))
@@ -11,11 +11,19 @@ Usage:
             --model_dir <trained_model_dir> \\
             --output_dir <output_dir> \\
             [--subset <data_subset_file>] \\
-            [--dev <device>]
+            [--dev <device>] \\
+            [--shards] \\
+            [--match_store]
 
     If :code:`subset` is not provided, the entire dataset :code:`dataset` will
     be evaluated.
 
+    If :code:`--shards` is set, :code:`dataset` should be a shard store generated by
+    :code:`scripts/data/preprocessing/shardDataset.py`.
+
+    If :code:`--match_store` is set, :code:`dataset` should be a match store generated by
+    :code:`scripts/data/preprocessing/shardDataset.py --match_store`.
+
 See :code:`python eval.py --help` for more info.
 """
 
@@ -28,8 +36,11 @@ import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
 
-from terminator.data.data import TERMLazyDataset, TERMLazyBatchSampler
+from terminator.data.data import TERMLazyDataset, TERMLazyBatchSampler, featurization_plan
+from terminator.data.match_store import TERMMatchStoreDataset
+from terminator.data.shards import TERMShardDataset
 from terminator.models.TERMinator import TERMinator
+from terminator.utils.model.default_hparams import DEFAULT_TRAIN_HPARAMS
 from terminator.utils.model.loop_utils import run_epoch
 from terminator.utils.model.loss_fn import construct_loss_fn
 
@@ -44,6 +55,12 @@ if __name__ == '__main__':
                         help=('file specifiying subset of dataset to evaluate. '
                               'if none provided, the whole dataset folder will be evaluated'))
     parser.add_argument('--dev', help='device to train on', default='cuda:0')
+    parser.add_argument('--shards',
+                        help="read from a shard store generated by shardDataset.py",
+                        action='store_true')
+    parser.add_argument('--match_store',
+                        help="read from a match store generated by shardDataset.py --match_store",
+                        action='store_true')
     args = parser.parse_args()
 
     dev = args.dev
@@ -58,12 +75,6 @@ if __name__ == '__main__':
     else:
         test_ids = None
 
-    test_dataset = TERMLazyDataset(args.dataset, pdb_ids=test_ids)
-    test_batch_sampler = TERMLazyBatchSampler(test_dataset, batch_size=1, shuffle=False)
-    test_dataloader = DataLoader(test_dataset,
-                                 batch_sampler=test_batch_sampler,
-                                 collate_fn=test_batch_sampler.package)
-
     with open(os.path.join(args.model_dir, "model_hparams.json")) as fp:
         model_hparams = json.load(fp)
     with open(os.path.join(args.model_dir, "run_hparams.json")) as fp:
@@ -93,6 +104,20 @@ if __name__ == '__main__':
     if "cie_dropout" not in model_hparams.keys():
         model_hparams['cie_dropout'] = 0.1
 
+    if args.shards:
+        test_dataset = TERMShardDataset(args.dataset, pdb_ids=test_ids)
+    elif args.match_store:
+        test_dataset = TERMMatchStoreDataset(args.dataset, pdb_ids=test_ids)
+    else:
+        test_dataset = TERMLazyDataset(args.dataset, pdb_ids=test_ids)
+    test_batch_sampler = TERMLazyBatchSampler(test_dataset,
+                                              batch_size=1,
+                                              shuffle=False,
+                                              featurize=featurization_plan(model_hparams))
+    test_dataloader = DataLoader(test_dataset,
+                                 batch_sampler=test_batch_sampler,
+                                 collate_fn=test_batch_sampler.package)
+
     terminator = TERMinator(hparams=model_hparams, device=dev)
     terminator = nn.DataParallel(terminator)
 
@@ -105,7 +130,14 @@ if __name__ == '__main__':
     loss_fn = construct_loss_fn(run_hparams)
 
     # test
-    test_loss, test_ld, dump = run_epoch(terminator, test_dataloader, loss_fn, grad=False, test=True, dev=dev)
+    test_loss, test_ld, dump = run_epoch(terminator,
+                                        test_dataloader,
+                                        loss_fn,
+                                        grad=False,
+                                        test=True,
+                                        dev=dev,
+                                        prefetch_depth=run_hparams.get('prefetch_depth',
+                                                                       DEFAULT_TRAIN_HPARAMS['prefetch_depth']))
     print(f"test loss {test_loss} test_ld {test_ld}")
 
     # save etab outputs for dTERMen runs
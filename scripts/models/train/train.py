@@ -14,11 +14,31 @@ Usage:
             [--out_dir <out_dir>] \\
             [--dev <device>] \\
             [--epochs <num_epochs>]
-            [--lazy]
+            [--lazy] \\
+            [--shards] \\
+            [--match_store] \\
+            [--stream] \\
+            [--cache_gb <cache_size_gb>]
 
     If :code:`--out_dir <out_dir>` is not set, :code:`net.out` will be dumped
     into :code:`<run_dir>`.
 
+    If :code:`--shards` is set, :code:`<dataset_dir>` should be a shard store generated by
+    :code:`scripts/data/preprocessing/shardDataset.py`, which is read lazily from memory-mapped shards.
+
+    If :code:`--match_store` is set, :code:`<dataset_dir>` should be a match store generated by
+    :code:`scripts/data/preprocessing/shardDataset.py --match_store`, whose TERM matches are deduplicated
+    across proteins. It is read lazily.
+
+    If :code:`--stream` is set, :code:`<dataset_dir>` should be a tar store generated by
+    :code:`scripts/data/preprocessing/shardDataset.py --tar`, whose shards are streamed sequentially.
+    Training batches are formed on the fly within a shuffle buffer rather than by a batch sampler.
+
+    If :code:`--cache_gb <cache_size_gb>` is set along with :code:`--lazy`, :code:`--shards` or :code:`--match_store`,
+    up to :code:`<cache_size_gb>` GB of decoded training proteins are cached in shared memory across dataloader
+    workers.
+    Cache hit rates are printed every epoch.
+
     For any of the split files, if the option is not provided, :code:`train.py` will
     look for them within :code:`<dataset_dir>`.
 
@@ -37,7 +57,13 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
-from terminator.data.data import (TERMLazyDataset, TERMBatchSampler, TERMDataset, TERMLazyBatchSampler)
+from terminator.data.data import (DistributedBatchSampler, TERMLazyDataset, TERMBatchSampler, TERMDataset,
+                                  TERMLazyBatchSampler, featurization_plan)
+from terminator.data.batch import keep_batch
+from terminator.data.cache import TERMCachedDataset
+from terminator.data.match_store import TERMMatchStoreDataset
+from terminator.data.shards import TERMShardDataset
+from terminator.data.stream import TERMStreamDataset
 from terminator.models.TERMinator import TERMinator
 from terminator.utils.model.loop_utils import run_epoch
 from terminator.utils.model.loss_fn import construct_loss_fn
@@ -96,13 +122,15 @@ def _setup_hparams(args):
     return model_hparams, run_hparams
 
 
-def _setup_dataloaders(args, run_hparams):
+def _setup_dataloaders(args, model_hparams, run_hparams):
     """ Setup dataloaders needed for training
 
     Args
     ----
     args : argparse.Namespace
         Parsed arguments
+    model_hparams : dict
+        Fully configured model hparams dictionary (see :code:`terminator/utils/model/default_hparams.py`)
     run_hparams : dict
         Fully configured hparams dictionary (see :code:`terminator/utils/model/default_hparams.py`)
 
@@ -113,6 +141,9 @@ def _setup_dataloaders(args, run_hparams):
     """
     kwargs = {}
     kwargs['num_workers'] = 16
+    # only compute the optional graph features the model will consume
+    featurize = featurization_plan(model_hparams)
+    train_featurize = featurization_plan(model_hparams, training=True)
 
     # set up dataloaders
     train_ids = []
@@ -127,10 +158,59 @@ def _setup_dataloaders(args, run_hparams):
     with open(args.test, 'r') as f:
         for line in f:
             test_ids += [line[:-1]]
-    if args.lazy:
-        train_dataset = TERMLazyDataset(args.dataset, pdb_ids=train_ids)
-        val_dataset = TERMLazyDataset(args.dataset, pdb_ids=validation_ids)
-        test_dataset = TERMLazyDataset(args.dataset, pdb_ids=test_ids)
+    if 'test_term_matches_cutoff' in run_hparams:
+        test_term_matches_cutoff = run_hparams['test_term_matches_cutoff']
+    else:
+        test_term_matches_cutoff = run_hparams['term_matches_cutoff']
+
+    if args.stream:
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            raise ValueError("--stream does not support distributed training, as ranks would run different numbers "
+                             "of steps. Use --shards or --lazy instead")
+        if run_hparams['bin_pack']:
+            raise ValueError("--stream batches proteins greedily as they are streamed, "
+                             "so it does not support bin_pack or max_seq_pairs")
+        # streamed datasets batch themselves, so the dataloaders only collect the packaged batches
+        train_dataset = TERMStreamDataset(args.dataset,
+                                          pdb_ids=train_ids,
+                                          batch_size=run_hparams['train_batch_size'],
+                                          shuffle=run_hparams['shuffle'] or run_hparams['semi_shuffle'],
+                                          max_term_res=run_hparams['max_term_res'],
+                                          max_seq_tokens=run_hparams['max_seq_tokens'],
+                                          term_matches_cutoff=run_hparams['term_matches_cutoff'],
+                                          term_dropout=run_hparams['term_dropout'],
+                                          featurize=train_featurize,
+                                          seed=run_hparams['seed'])
+        val_dataset = TERMStreamDataset(args.dataset,
+                                        pdb_ids=validation_ids,
+                                        batch_size=1,
+                                        shuffle=False,
+                                        term_matches_cutoff=test_term_matches_cutoff,
+                                        featurize=featurize)
+        test_dataset = TERMStreamDataset(args.dataset,
+                                         pdb_ids=test_ids,
+                                         batch_size=1,
+                                         shuffle=False,
+                                         term_matches_cutoff=test_term_matches_cutoff,
+                                         featurize=featurize)
+        # batches are pinned when moved to the GPU (see terminator.data.batch)
+        train_dataloader = DataLoader(train_dataset, batch_size=None, collate_fn=keep_batch, **kwargs)
+        val_dataloader = DataLoader(val_dataset, batch_size=None, collate_fn=keep_batch, **kwargs)
+        test_dataloader = DataLoader(test_dataset, batch_size=None, collate_fn=keep_batch, **kwargs)
+        return train_dataloader, val_dataloader, test_dataloader
+
+    if args.lazy or args.shards or args.match_store:
+        if args.shards:
+            lazy_dataset = TERMShardDataset
+        elif args.match_store:
+            lazy_dataset = TERMMatchStoreDataset
+        else:
+            lazy_dataset = TERMLazyDataset
+        train_dataset = lazy_dataset(args.dataset, pdb_ids=train_ids)
+        val_dataset = lazy_dataset(args.dataset, pdb_ids=validation_ids)
+        test_dataset = lazy_dataset(args.dataset, pdb_ids=test_ids)
+        if args.cache_gb:
+            train_dataset = TERMCachedDataset(train_dataset, cache_bytes=int(args.cache_gb * 1024**3))
 
         train_batch_sampler = TERMLazyBatchSampler(train_dataset,
                                                    batch_size=run_hparams['train_batch_size'],
@@ -140,19 +220,20 @@ def _setup_dataloaders(args, run_hparams):
                                                    term_matches_cutoff=run_hparams['term_matches_cutoff'],
                                                    max_term_res=run_hparams['max_term_res'],
                                                    max_seq_tokens=run_hparams['max_seq_tokens'],
-                                                   term_dropout=run_hparams['term_dropout'])
-        if 'test_term_matches_cutoff' in run_hparams:
-            test_term_matches_cutoff = run_hparams['test_term_matches_cutoff']
-        else:
-            test_term_matches_cutoff = run_hparams['term_matches_cutoff']
+                                                   max_seq_pairs=run_hparams['max_seq_pairs'],
+                                                   bin_pack=run_hparams['bin_pack'],
+                                                   term_dropout=run_hparams['term_dropout'],
+                                                   featurize=train_featurize)
         val_batch_sampler = TERMLazyBatchSampler(val_dataset,
                                                  batch_size=1,
                                                  shuffle=False,
-                                                 term_matches_cutoff=test_term_matches_cutoff)
+                                                 term_matches_cutoff=test_term_matches_cutoff,
+                                                 featurize=featurize)
         test_batch_sampler = TERMLazyBatchSampler(test_dataset,
                                                   batch_size=1,
                                                   shuffle=False,
-                                                  term_matches_cutoff=test_term_matches_cutoff)
+                                                  term_matches_cutoff=test_term_matches_cutoff,
+                                                  featurize=featurize)
     else:
         train_dataset = TERMDataset(args.dataset, pdb_ids=train_ids)
         val_dataset = TERMDataset(args.dataset, pdb_ids=validation_ids)
@@ -164,19 +245,25 @@ def _setup_dataloaders(args, run_hparams):
                                                semi_shuffle=run_hparams['semi_shuffle'],
                                                sort_data=run_hparams['sort_data'],
                                                max_term_res=run_hparams['max_term_res'],
-                                               max_seq_tokens=run_hparams['max_seq_tokens'])
-        val_batch_sampler = TERMBatchSampler(val_dataset, batch_size=1, shuffle=False)
-        test_batch_sampler = TERMBatchSampler(test_dataset, batch_size=1, shuffle=False)
-
+                                               max_seq_tokens=run_hparams['max_seq_tokens'],
+                                               max_seq_pairs=run_hparams['max_seq_pairs'],
+                                               bin_pack=run_hparams['bin_pack'],
+                                               featurize=train_featurize)
+        val_batch_sampler = TERMBatchSampler(val_dataset, batch_size=1, shuffle=False, featurize=featurize)
+        test_batch_sampler = TERMBatchSampler(test_dataset, batch_size=1, shuffle=False, featurize=featurize)
+
+    # under multi-process training, give each rank its own disjoint, token-balanced share of the training batches
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        train_batch_sampler = DistributedBatchSampler(train_batch_sampler, seed=run_hparams['seed'])
+
+    # batches are pinned when moved to the GPU (see terminator.data.batch)
     train_dataloader = DataLoader(train_dataset,
                                   batch_sampler=train_batch_sampler,
                                   collate_fn=train_batch_sampler.package,
-                                  pin_memory=True,
                                   **kwargs)
     val_dataloader = DataLoader(val_dataset,
                                 batch_sampler=val_batch_sampler,
                                 collate_fn=val_batch_sampler.package,
-                                pin_memory=True,
                                 **kwargs)
     test_dataloader = DataLoader(test_dataset,
                                  batch_sampler=test_batch_sampler,
@@ -186,6 +273,34 @@ def _setup_dataloaders(args, run_hparams):
     return train_dataloader, val_dataloader, test_dataloader
 
 
+def _refresh_train_dataloader(args, train_dataloader):
+    """ Pick up proteins registered in or removed from the training dataset since the last epoch.
+
+    The training split file is re-read, so proteins appended to it and registered in the dataset manifest
+    (e.g. by :code:`generateDataset.py --subset`) join training without restarting the run.
+    Only lazily loaded datasets can be refreshed.
+
+    Args
+    ----
+    args : argparse.Namespace
+        Parsed arguments
+    train_dataloader : DataLoader
+        Training dataloader, as built by :code:`_setup_dataloaders`
+    """
+    train_dataset = train_dataloader.dataset
+    if not isinstance(train_dataset, (TERMLazyDataset, TERMCachedDataset)):
+        return
+    with open(args.train, 'r') as f:
+        train_ids = [line.strip() for line in f if line.strip()]
+    if not train_dataset.refresh(pdb_ids=train_ids):
+        return
+    batch_sampler = train_dataloader.batch_sampler
+    if isinstance(batch_sampler, DistributedBatchSampler):
+        batch_sampler = batch_sampler.batch_sampler
+    batch_sampler.refresh()
+    print(f"training set refreshed, now {len(train_dataset)} proteins")
+
+
 def _load_checkpoint(run_dir, dev, finetune=False):
     """ If a training checkpoint exists, load the checkpoint. Otherwise, setup checkpointing initial values.
 
@@ -266,7 +381,8 @@ def _setup_model(model_hparams, run_hparams, checkpoint, dev):
     print(terminator)
     print("terminator hparams", terminator.hparams)
 
-    if torch.cuda.device_count() > 1 and dev != "cpu":
+    # packed outputs hold a different number of residues on every GPU, so they can't be gathered
+    if torch.cuda.device_count() > 1 and dev != "cpu" and not model_hparams['energies_packed']:
         terminator = nn.DataParallel(terminator)
         terminator_module = terminator.module
     else:
@@ -285,7 +401,7 @@ def main(args):
 
     # setup dataloaders
     model_hparams, run_hparams = _setup_hparams(args)
-    train_dataloader, val_dataloader, test_dataloader = _setup_dataloaders(args, run_hparams)
+    train_dataloader, val_dataloader, test_dataloader = _setup_dataloaders(args, model_hparams, run_hparams)
     # load checkpoint
     checkpoint_dict = _load_checkpoint(run_dir, dev, run_hparams['finetune'])
     best_validation = checkpoint_dict["best_validation"]
@@ -295,11 +411,11 @@ def main(args):
     writer = checkpoint_dict["writer"]
     training_curves = checkpoint_dict["training_curves"]
 
-    isDataParallel = True if torch.cuda.device_count() > 1 and dev != "cpu" else False
     finetune = run_hparams["finetune"]
 
     # construct terminator, loss fn, and optimizer
     terminator, terminator_module = _setup_model(model_hparams, run_hparams, best_checkpoint, dev)
+    isDataParallel = isinstance(terminator, nn.DataParallel)
     loss_fn = construct_loss_fn(run_hparams)
     optimizer = get_std_opt(terminator.parameters(),
                             d_model=model_hparams['energies_hidden_dim'],
@@ -311,13 +427,20 @@ def main(args):
     try:
         for epoch in range(start_epoch, args.epochs):
             print('epoch', epoch)
+            _refresh_train_dataloader(args, train_dataloader)
+            if isinstance(train_dataloader.batch_sampler, DistributedBatchSampler):
+                train_dataloader.batch_sampler.set_epoch(epoch)
+            if isinstance(train_dataloader.dataset, TERMStreamDataset):
+                train_dataloader.dataset.set_epoch(epoch)
 
-            epoch_loss, epoch_ld, _ = run_epoch(terminator, train_dataloader, loss_fn, optimizer=optimizer, grad=True, dev=dev, finetune=finetune, isDataParallel=isDataParallel)
+            epoch_loss, epoch_ld, _ = run_epoch(terminator, train_dataloader, loss_fn, optimizer=optimizer, grad=True, dev=dev, finetune=finetune, isDataParallel=isDataParallel, prefetch_depth=run_hparams['prefetch_depth'])
             print('epoch loss', epoch_loss, 'epoch_ld', epoch_ld)
+            if isinstance(train_dataloader.dataset, TERMCachedDataset):
+                print('train cache', train_dataloader.dataset.cache_stats())
             writer.add_scalar('training loss', epoch_loss, epoch)
 
             # validate
-            val_loss, val_ld, _ = run_epoch(terminator, val_dataloader, loss_fn, grad=False, dev=dev)
+            val_loss, val_ld, _ = run_epoch(terminator, val_dataloader, loss_fn, grad=False, dev=dev, prefetch_depth=run_hparams['prefetch_depth'])
             print('val loss', val_loss, 'val ld', val_ld)
             writer.add_scalar('val loss', val_loss, epoch)
 
@@ -354,7 +477,7 @@ def main(args):
 
     # test
     terminator_module.load_state_dict(best_checkpoint)
-    test_loss, test_ld, dump = run_epoch(terminator, test_dataloader, loss_fn, grad=False, test=True, dev=dev)
+    test_loss, test_ld, dump = run_epoch(terminator, test_dataloader, loss_fn, grad=False, test=True, dev=dev, prefetch_depth=run_hparams['prefetch_depth'])
     print(f"test loss {test_loss} test loss dict {test_ld}")
     # dump outputs
     if args.out_dir:
@@ -384,6 +507,20 @@ if __name__ == '__main__':
     parser.add_argument('--dev', help='device to train on', default='cuda:0')
     parser.add_argument('--epochs', help='number of epochs to train for', default=100, type=int)
     parser.add_argument('--lazy', help="use lazy data loading", action='store_true')
+    parser.add_argument('--shards',
+                        help="read lazily from a shard store generated by shardDataset.py",
+                        action='store_true')
+    parser.add_argument('--match_store',
+                        help="read lazily from a match store generated by shardDataset.py --match_store",
+                        action='store_true')
+    parser.add_argument('--stream',
+                        help="stream from a tar store generated by shardDataset.py --tar",
+                        action='store_true')
+    parser.add_argument('--cache_gb',
+                        help=("with --lazy, --shards or --match_store, "
+                              "cache up to this many GB of decoded training data in RAM"),
+                        default=None,
+                        type=float)
     parsed_args = parser.parse_args()
 
     # by default, if no splits are provided, read the splits from the dataset folder
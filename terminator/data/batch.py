@@ -0,0 +1,217 @@
+"""Typed container for packaged batches.
+
+:code:`terminator.data.data._package` outputs a :code:`TERMBatch`, which holds the batch fields as slots and
+behaves as a dictionary of them, so that batches can be indexed like :code:`batch['X']` throughout.
+
+Placing a batch on a device moves every tensor of the batch, including the tensors of the per-protein graphs
+in :code:`gvp_data` and :code:`geometric_data`, in a single copy: the tensors are laid out in one contiguous byte
+buffer, which is copied at once and viewed back into tensors on the device. :code:`pin_memory` lays out that buffer
+in pinned memory, so that :code:`to(device, non_blocking=True)` is a single asynchronous host-to-device copy.
+Batches are pinned by :code:`terminator.utils.model.loop_utils._to_dev` rather than by
+:code:`torch.utils.data.DataLoader(pin_memory=True)`, which turns them into plain dictionaries before pytorch 2.
+For the same reason, DataLoaders without a batch sampler take :code:`collate_fn=keep_batch`.
+"""
+import copy
+from collections.abc import MutableMapping
+
+import torch
+
+# pylint: disable=no-member
+
+# alignment of every tensor in the batch buffer, in bytes, so that each can be viewed in its own dtype
+_ALIGNMENT = 16
+# fields holding one graph per protein, e.g. torch_geometric.data.Data
+GRAPH_FIELDS = ('gvp_data', 'geometric_data')
+# fields indexed by target residue in dim 1
+RESIDUE_FIELDS = ('ppoe', 'X', 'x_mask', 'seqs', 'chain_idx', 'E_idx', 'E_dist', 'E_reverse')
+# fields indexed by TERM residue in dim 1
+TERM_RESIDUE_FIELDS = ('msas', 'features', 'focuses', 'contact_idxs', 'src_key_mask')
+
+
+class TERMBatch(MutableMapping):
+    """Packaged batch of proteins, as outputted by :code:`terminator.data.data._package`.
+
+    See :code:`_package` for the meaning of each field. Fields outside of :code:`FIELDS`,
+    e.g. the outputs of featurizers added with :code:`register_featurizer`, are held in a side dictionary.
+    """
+    FIELDS = ('msas', 'features', 'ppoe', 'seq_lens', 'focuses', 'contact_idxs', 'src_key_mask', 'term_lens', 'X',
+              'x_mask', 'seqs', 'ids', 'chain_idx', 'sortcery_seqs', 'sortcery_nrgs', 'scatter_idx', 'E_idx',
+              'E_dist', 'E_reverse') + GRAPH_FIELDS
+    __slots__ = FIELDS + ('_extra', '_buffer', '_layout')
+
+    def __init__(self, fields=None, **kwargs):
+        """
+        Args
+        ----
+        fields : dict or None, default=None
+            Initial fields of the batch
+        **kwargs
+            Further fields of the batch
+        """
+        self._extra = {}
+        self._buffer = None
+        self._layout = None
+        self.update(fields or {}, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        # the buffer no longer covers every tensor of the batch
+        self._buffer = None
+        self._layout = None
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        else:
+            del self._extra[key]
+        self._buffer = None
+        self._layout = None
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"TERMBatch(ids={self.get('ids')}, fields={list(self)})"
+
+    def _tensors(self):
+        """Every tensor of the batch, keyed by its path in the batch
+
+        Yields
+        ------
+        path : tuple
+            :code:`(field, )` for tensor fields, or :code:`(field, protein_idx, attr)` for graph attributes
+        tensor : torch.Tensor
+        """
+        for key, value in self.items():
+            if isinstance(value, torch.Tensor):
+                yield (key, ), value
+            elif key in GRAPH_FIELDS:
+                for i, graph in enumerate(value):
+                    for attr, attr_value in graph:
+                        if isinstance(attr_value, torch.Tensor):
+                            yield (key, i, attr), attr_value
+
+    def _from_buffer(self, buffer, layout):
+        """Copy of the batch with its tensors replaced by views into :code:`buffer`"""
+        batch = TERMBatch(self)
+        for key in GRAPH_FIELDS:
+            if key in batch:
+                batch[key] = [copy.copy(graph) for graph in batch[key]]
+        for path, dtype, shape, offset, nbytes in layout:
+            tensor = buffer[offset:offset + nbytes].view(dtype).view(shape)
+            if len(path) == 1:
+                batch[path[0]] = tensor
+            else:
+                key, i, attr = path
+                batch[key][i][attr] = tensor
+        batch._buffer = buffer
+        batch._layout = layout
+        return batch
+
+    def _flatten(self, pin=False):
+        """Lay out every tensor of the batch in one contiguous byte buffer
+
+        Args
+        ----
+        pin : bool, default=False
+            Allocate the buffer in pinned memory
+
+        Returns
+        -------
+        TERMBatch
+            Copy of the batch viewing into the buffer
+        """
+        layout, nbytes = [], 0
+        tensors = list(self._tensors())
+        devices = {tensor.device for _, tensor in tensors}
+        assert len(devices) <= 1, f"batch tensors are spread over several devices: {devices}"
+        for path, tensor in tensors:
+            tensor_nbytes = tensor.numel() * tensor.element_size()
+            layout.append((path, tensor.dtype, tuple(tensor.shape), nbytes, tensor_nbytes))
+            nbytes += -(-tensor_nbytes // _ALIGNMENT) * _ALIGNMENT
+        device = devices.pop() if devices else torch.device('cpu')
+        buffer = torch.empty(nbytes, dtype=torch.uint8, device=device, pin_memory=pin)
+        for (_, tensor), (_, dtype, shape, offset, tensor_nbytes) in zip(tensors, layout):
+            buffer[offset:offset + tensor_nbytes].view(dtype).view(shape).copy_(tensor)
+        return self._from_buffer(buffer, layout)
+
+    def pin_memory(self):
+        """Copy of the batch with all its tensors in one pinned buffer"""
+        if self._buffer is not None and self._buffer.is_pinned():
+            return self
+        return self._flatten(pin=True)
+
+    def to(self, device, non_blocking=False):
+        """Copy of the batch on :code:`device`, moved in a single copy.
+
+        Args
+        ----
+        device : str or torch.device
+            Device to place the batch on
+        non_blocking : bool, default=False
+            Copy asynchronously, if the batch is pinned (see :code:`pin_memory`)
+
+        Returns
+        -------
+        TERMBatch
+            Batch on :code:`device`
+        """
+        batch = self if self._buffer is not None else self._flatten()
+        if batch._buffer.device == torch.device(device):
+            return batch
+        return batch._from_buffer(batch._buffer.to(device, non_blocking=non_blocking), batch._layout)
+
+    def protein(self, idx):
+        """Views of the fields of one protein of the batch, without padding.
+
+        Args
+        ----
+        idx : int
+            Index of the protein in the batch
+
+        Returns
+        -------
+        dict
+            Fields of the protein. Per-residue fields are cut to the protein's length,
+            and the per-protein graphs and ids are unwrapped.
+        """
+        seq_len = int(self['seq_lens'][idx])
+        n_term_res = int((~self['src_key_mask'][idx]).sum()) if 'src_key_mask' in self else None
+        protein = {}
+        for key, value in self.items():
+            if key in RESIDUE_FIELDS:
+                protein[key] = value[idx, :seq_len]
+            elif key in TERM_RESIDUE_FIELDS and key != 'src_key_mask':
+                # TERM matches are batched in dim 1 and TERM residues in dim 2
+                protein[key] = value[idx, :, :n_term_res] if key in ('msas', 'features') else value[idx, :n_term_res]
+            elif key in GRAPH_FIELDS or key == 'ids':
+                protein[key] = value[idx]
+            elif key == 'seq_lens':
+                protein[key] = seq_len
+        return protein
+
+
+def keep_batch(batch):
+    """Collate function for :code:`torch.utils.data.DataLoader(batch_size=None)` over datasets yielding packaged
+    batches, e.g. :code:`TERMStreamDataset`, which keeps them as :code:`TERMBatch`"""
+    return batch
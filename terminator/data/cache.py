@@ -0,0 +1,266 @@
+"""Memory-budgeted LRU cache of decoded datapoints, shared across DataLoader workers.
+
+:code:`TERMCachedDataset` sits between :code:`TERMDataset`, which keeps every protein in RAM,
+and :code:`TERMLazyDataset`, which reads every protein from disk at every step. It wraps a lazy dataset
+(:code:`TERMLazyDataset` or :code:`TERMShardDataset`) and keeps recently used proteins decoded in a
+cache directory on a RAM-backed filesystem (:code:`/dev/shm` by default), with one :code:`.npy` file per field.
+Cached arrays are memory-mapped, so every worker reads the same physical pages. When the cache grows past its
+budget, the least recently used proteins are evicted. Hit and miss counts are kept in shared memory
+so they can be reported across all workers.
+"""
+import atexit
+import fcntl
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from terminator.data.data import _truncate_matches
+
+# order of the counters in TERMCachedDataset.stats
+_HITS, _MISSES, _BYTES, _EVICTIONS = range(4)
+META_FILE = "meta.pkl"
+
+
+def _default_cache_root():
+    """RAM-backed filesystem to place caches on, if available"""
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def _touch(entry_dir):
+    """Mark a cache entry as recently used.
+
+    Timestamps are set explicitly, since file system timestamps are too coarse to order rapid accesses.
+    """
+    now = time.time_ns()
+    os.utime(entry_dir, ns=(now, now))
+
+
+def _remove_cache_dir(cache_dir, owner_pid):
+    """Remove a cache directory at exit, but only from the process that created it"""
+    if os.getpid() == owner_pid:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+class TERMCachedDataset(Dataset):
+    """Lazy TERM dataset with an LRU cache of decoded datapoints held within a RAM budget.
+
+    This is a drop-in replacement for the wrapped dataset, to be used with TERMLazyBatchSampler.
+
+    Attributes
+    ----------
+    dataset : TERMLazyDataset or TERMShardDataset
+        Wrapped dataset, used to load datapoints missing from the cache
+    cache_bytes : int
+        RAM budget of the cache, in bytes
+    cache_dir : str
+        Directory holding the cache entries
+    stats : torch.Tensor
+        Shared-memory counters of hits, misses, cached bytes and evictions
+    """
+    def __init__(self, dataset, cache_bytes, cache_dir=None):
+        """
+        Args
+        ----
+        dataset : TERMLazyDataset or TERMShardDataset
+            Dataset to cache
+        cache_bytes : int
+            RAM budget of the cache, in bytes
+        cache_dir : str or None, default=None
+            Directory to hold the cache entries, which should be on a RAM-backed filesystem.
+            If :code:`None`, a fresh directory is created under :code:`/dev/shm` and removed at exit.
+        """
+        self.dataset = dataset
+        self.cache_bytes = cache_bytes
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix="terminator_cache_", dir=_default_cache_root())
+            atexit.register(_remove_cache_dir, cache_dir, os.getpid())
+        elif not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self._lock_path = os.path.join(cache_dir, ".lock")
+        self.stats = torch.zeros(4, dtype=torch.int64).share_memory_()
+        # account for entries left by a previous run in the same cache directory
+        self.stats[_BYTES] = sum(self._entry_size(entry.path) for entry in self._entries())
+
+    def _entries(self):
+        """List the cache entries"""
+        return [entry for entry in os.scandir(self.cache_dir) if entry.is_dir() and not entry.name.startswith('.')]
+
+    @staticmethod
+    def _entry_size(entry_dir):
+        """Number of bytes of array data held by a cache entry"""
+        with open(os.path.join(entry_dir, ".size"), 'r') as fp:  # pylint: disable=unspecified-encoding
+            return int(fp.read())
+
+    def _count(self, counter):
+        """Increment one of the shared counters in :code:`self.stats`"""
+        with self._locked() as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.stats[counter] += 1
+
+    def _entry_dir(self, key):
+        """Cache directory of the datapoint with dataset key :code:`key`"""
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def _locked(self):
+        """Open the lock file of the cache, to be used with :code:`fcntl.flock`"""
+        return open(self._lock_path, 'a')  # pylint: disable=consider-using-with,unspecified-encoding
+
+    def _read(self, entry_dir):
+        """Read a cached datapoint, memory-mapping its arrays. Returns :code:`None` if it was evicted.
+
+        A datapoint evicted once its arrays are mapped is still returned, as the mapped arrays stay valid.
+        """
+        try:
+            with open(os.path.join(entry_dir, META_FILE), 'rb') as fp:
+                data, fields = pickle.load(fp)
+            for field in fields:
+                data[field] = np.load(os.path.join(entry_dir, f"{field}.npy"), mmap_mode='c')
+        except FileNotFoundError:
+            return None
+        try:
+            _touch(entry_dir)
+        except FileNotFoundError:
+            # evicted by another worker after mapping
+            pass
+        return data
+
+    def _write(self, entry_dir, data):
+        """Insert a datapoint into the cache, evicting least recently used datapoints to stay within budget."""
+        fields = [field for field, value in data.items() if isinstance(value, np.ndarray)]
+        size = sum(data[field].nbytes for field in fields)
+        if size > self.cache_bytes:
+            return
+
+        with self._locked() as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isdir(entry_dir):
+                # another worker cached this datapoint in the meantime
+                return
+            if self.stats[_BYTES].item() + size > self.cache_bytes:
+                self._evict(self.stats[_BYTES].item() + size - self.cache_bytes)
+
+            tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp_")
+            for field in fields:
+                np.save(os.path.join(tmp_dir, f"{field}.npy"), data[field])
+            meta = {field: value for field, value in data.items() if field not in fields}
+            with open(os.path.join(tmp_dir, META_FILE), 'wb') as fp:
+                pickle.dump((meta, fields), fp)
+            with open(os.path.join(tmp_dir, ".size"), 'w') as fp:  # pylint: disable=unspecified-encoding
+                fp.write(str(size))
+            os.rename(tmp_dir, entry_dir)
+            _touch(entry_dir)
+            self.stats[_BYTES] += size
+
+    def _evict(self, num_bytes):
+        """Remove least recently used datapoints until at least :code:`num_bytes` are freed. Call with the lock held.
+
+        Readers which already mapped an evicted datapoint keep a valid view until they drop it.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime_ns)
+        freed = 0
+        for entry in entries:
+            if freed >= num_bytes:
+                break
+            size = self._entry_size(entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
+            freed += size
+            self.stats[_BYTES] -= size
+            self.stats[_EVICTIONS] += 1
+
+    def load(self, key, num_matches=None):
+        """Load the feature dictionary for a datapoint, from the cache if possible.
+
+        The whole datapoint is cached on a miss, so that later loads with a different
+        :code:`num_matches` can be served from the cache too.
+
+        Args
+        ----
+        key : object
+            Dataset key of the datapoint, as stored in the wrapped dataset
+        num_matches : int or None, default=None
+            Only keep the top :code:`num_matches` TERM matches. If :code:`None`, keep all matches.
+
+        Returns
+        -------
+        dict
+            Feature dictionary
+        """
+        entry_dir = self._entry_dir(key)
+        data = self._read(entry_dir) if os.path.isdir(entry_dir) else None
+        if data is not None:
+            self._count(_HITS)
+        else:
+            self._count(_MISSES)
+            data = self.dataset.load(key)
+            self._write(entry_dir, data)
+        return _truncate_matches(data, num_matches)
+
+    def num_matches(self, key):
+        """Number of TERM matches stored for a datapoint (see the wrapped dataset)."""
+        return self.dataset.num_matches(key)
+
+    def cache_stats(self):
+        """Summarize how well the cache performed, across all workers.
+
+        Returns
+        -------
+        dict
+            Number of :code:`hits`, :code:`misses` and :code:`evictions`, the :code:`hit_rate`,
+            and the number of :code:`cached_bytes` out of the :code:`budget_bytes`
+        """
+        hits, misses, cached_bytes, evictions = self.stats.tolist()
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / max(hits + misses, 1),
+            'evictions': evictions,
+            'cached_bytes': cached_bytes,
+            'budget_bytes': self.cache_bytes
+        }
+
+    def reset_stats(self):
+        """Reset the hit, miss and eviction counters."""
+        self.stats[_HITS] = 0
+        self.stats[_MISSES] = 0
+        self.stats[_EVICTIONS] = 0
+
+    def refresh(self, pdb_ids=None):
+        """Pick up proteins added to or removed from the wrapped dataset (see :code:`TERMLazyDataset.refresh`).
+
+        Cached datapoints are keyed by feature file path, so a protein whose feature file was rewritten
+        keeps being served from the cache until its entry is evicted or the cache is cleared.
+
+        Returns
+        -------
+        bool
+            Whether the wrapped dataset was reloaded. Always :code:`False` if it cannot refresh.
+        """
+        if not hasattr(self.dataset, 'refresh'):
+            return False
+        return self.dataset.refresh(pdb_ids=pdb_ids)
+
+    def shuffle(self):
+        """Shuffle the dataset"""
+        self.dataset.shuffle()
+
+    def __len__(self):
+        """Returns length of the given dataset.
+
+        Returns
+        -------
+        int
+            length of dataset
+        """
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        """Extract a given item with provided index (see the wrapped dataset)."""
+        return self.dataset[idx]
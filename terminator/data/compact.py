@@ -0,0 +1,67 @@
+"""Compact storage dtypes for feature dictionaries.
+
+Feature files written by :code:`scripts/data/preprocessing/packageTensors.py` hold numpy's default dtypes:
+float64 features and int64 indices. Batches are cast to the dtypes the model consumes during collation
+(see :code:`terminator.data.data._package`), so feature dictionaries can be stored in smaller dtypes instead,
+shrinking datasets on disk and in the page cache.
+"""
+import numpy as np
+
+# fields holding residue codes, which fit in a byte
+CODE_FIELDS = ['msas', 'sequence']
+# fields holding indices or lengths
+INDEX_FIELDS = ['focuses', 'contact_idxs', 'term_lens']
+# real-valued fields
+FLOAT_FIELDS = ['features', 'ppoe', 'coords']
+# coordinates are always kept in single precision
+COORD_DTYPE = np.float32
+# index of the RMSD in the last dimension of :code:`features`
+RMSD_FEATURE = 7
+
+
+def _smallest_int(arr):
+    """Smallest of int16 and int32 able to hold the values of :code:`arr`"""
+    info = np.iinfo(np.int16)
+    if arr.size == 0 or (arr.min() >= info.min and arr.max() <= info.max):
+        return np.int16
+    return np.int32
+
+
+def compact_features(data, float_dtype=np.float32):
+    """Cast the arrays of a feature dictionary to compact dtypes.
+
+    Residue codes are stored as uint8, indices as int16 or int32 (whichever holds them),
+    coordinates as float32 and the remaining real-valued features as :code:`float_dtype`.
+
+    Args
+    ----
+    data : dict
+        Feature dictionary, as outputted by :code:`scripts/data/preprocessing/packageTensors.py`
+    float_dtype : np.dtype, default=np.float32
+        Dtype of :code:`features` and :code:`ppoe`. With :code:`np.float16`, values are rounded to about
+        3 significant digits. Positive RMSDs too small for :code:`float_dtype`, such as the near-zero RMSD
+        given to dummy TERMs, are raised to its smallest normal value rather than rounded to 0,
+        which the model reads as padding.
+
+    Returns
+    -------
+    dict
+        Feature dictionary with compact arrays. Fields that are not arrays are left as is.
+    """
+    compact = dict(data)
+    for field in CODE_FIELDS:
+        if isinstance(data.get(field), np.ndarray):
+            assert data[field].min(initial=0) >= 0 and data[field].max(initial=0) < 256, \
+                f"{field} values do not fit in uint8"
+            compact[field] = data[field].astype(np.uint8)
+    for field in INDEX_FIELDS:
+        if isinstance(data.get(field), np.ndarray):
+            compact[field] = data[field].astype(_smallest_int(data[field]))
+    for field in FLOAT_FIELDS:
+        if isinstance(data.get(field), np.ndarray):
+            compact[field] = data[field].astype(COORD_DTYPE if field == 'coords' else float_dtype)
+    features = compact.get('features')
+    if isinstance(features, np.ndarray) and features.ndim == 3 and features.shape[-1] > RMSD_FEATURE:
+        rmsds = features[..., RMSD_FEATURE]
+        rmsds[(rmsds == 0) & (data['features'][..., RMSD_FEATURE] > 0)] = np.finfo(features.dtype).tiny
+    return compact
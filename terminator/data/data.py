@@ -9,16 +9,23 @@ import multiprocessing as mp
 import os
 import pickle
 import random
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 import torch_cluster
 import torch_geometric
-from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset, Sampler
 from tqdm import tqdm
 
+from terminator.data.batch import TERMBatch
+from terminator.data.manifest import DatasetManifest, features_path, manifest_mtime, read_manifest
+from terminator.data.shards import SharedShard
+
+# default number of neighbors per residue in the kNN graphs built during featurization
+KNN_NEIGHBORS = 30
+
 # pylint: disable=no-member, not-callable
 
 
@@ -47,7 +54,7 @@ def _rbf(D, D_min=0., D_max=20., D_count=16, device='cpu'):
     return rbf
 
 
-def _dihedrals(X, eps=1e-7):
+def _dihedrals(X, eps=1e-7, ptr=None):
     """ Compute dihedral angles between residues given atomic backbone coordinates
 
     Args
@@ -55,6 +62,10 @@ def _dihedrals(X, eps=1e-7):
     X : torch.FloatTensor
         Tensor specifying atomic backbone coordinates
         Shape: num_res x 4 x 3
+    ptr : torch.LongTensor or None, default=None
+        If :code:`X` concatenates several proteins, the index of the first residue of each protein,
+        followed by :code:`num_res`. Dihedrals spanning two proteins are zeroed, like those at the
+        ends of a single protein.
 
     Returns
     -------
@@ -83,6 +94,9 @@ def _dihedrals(X, eps=1e-7):
     # This scheme will remove phi[0], psi[-1], omega[-1]
     D = F.pad(D, [1, 2])
     D = torch.reshape(D, [-1, 3])
+    if ptr is not None:
+        D[ptr[1:-1], 0] = 0
+        D[ptr[1:-1] - 1, 1:] = 0
     # Lift angle representations to the circle
     D_features = torch.cat([torch.cos(D), torch.sin(D)], 1)
     return D_features
@@ -116,7 +130,7 @@ def _positional_embeddings(edge_index, num_embeddings=16, dev='cpu'):
     return E
 
 
-def _orientations(X_ca):
+def _orientations(X_ca, ptr=None):
     """ Compute forward and backward vectors per residue.
 
     Args
@@ -124,6 +138,9 @@ def _orientations(X_ca):
     X_ca : torch.FloatTensor
         Tensor specifying atomic backbone coordinates for CA atoms.
         Shape: num_res x 3
+    ptr : torch.LongTensor or None, default=None
+        If :code:`X_ca` concatenates several proteins, the index of the first residue of each protein,
+        followed by :code:`num_res`. Vectors spanning two proteins are zeroed.
 
     Returns
     -------
@@ -136,6 +153,9 @@ def _orientations(X_ca):
     backward = _normalize(X_ca[:-1] - X_ca[1:])
     forward = F.pad(forward, [0, 0, 0, 1])
     backward = F.pad(backward, [0, 0, 1, 0])
+    if ptr is not None:
+        forward[ptr[1:-1] - 1] = 0
+        backward[ptr[1:-1]] = 0
     return torch.cat([forward.unsqueeze(-2), backward.unsqueeze(-2)], -2)
 
 
@@ -163,49 +183,151 @@ def _sidechains(X):
     return vec
 
 
-def _jing_featurize(protein, dev='cpu'):
-    """ Featurize individual proteins for use in torch_geometric Data objects,
-    as done in https://github.com/drorlab/gvp-pytorch
+def _concat_proteins(proteins, dev='cpu'):
+    """ Concatenate the residues of several proteins for batched featurization.
 
     Args
     ----
-    protein : dict
-        Dictionary of protein features
+    proteins : list of dict
+        Protein dictionaries with keys :code:`coords`, :code:`seq` and :code:`chain_idx`
+        (see :code:`_jing_featurize`)
+    dev : str, default='cpu'
+        Device to place torch tensors
 
-        - :code:`name` - PDB ID of the protein
-        - :code:`coords` - list of dicts specifying backbone atom coordinates
-        in the format of that outputted by :code:`parseCoords.py`
-        - :code:`seq` - protein sequence
-        - :code:`chain_idx` - an integer per residue such that each unique integer represents a unique chain
+    Returns
+    -------
+    coords : torch.FloatTensor
+        Backbone coordinates, with incomplete residues set to inf
+        Shape: num_res x 4 x 3
+    seq : torch.LongTensor
+        Sequences
+        Shape: num_res
+    mask : torch.BoolTensor
+        Residues with complete coordinate sets
+        Shape: num_res
+    chain_idx : torch.Tensor
+        Chain index of each residue within its protein
+        Shape: num_res
+    batch : torch.LongTensor
+        Protein index of each residue
+        Shape: num_res
+    ptr : torch.LongTensor
+        Index of the first residue of each protein, followed by :code:`num_res`
+        Shape: num_proteins + 1
+    """
+    lengths = torch.tensor([len(protein['coords']) for protein in proteins], device=dev)
+    coords = torch.as_tensor(np.concatenate([protein['coords'] for protein in proteins]),
+                             device=dev,
+                             dtype=torch.float32)
+    seq = torch.as_tensor(np.concatenate([protein['seq'] for protein in proteins]), device=dev, dtype=torch.long)
+    chain_idx = torch.cat([torch.as_tensor(protein['chain_idx'], device=dev) for protein in proteins])
+    mask = torch.isfinite(coords.sum(dim=(1, 2)))
+    coords[~mask] = np.inf
+    batch = torch.repeat_interleave(torch.arange(len(proteins), device=dev), lengths)
+    ptr = F.pad(torch.cumsum(lengths, 0), [1, 0])
+    return coords, seq, mask, chain_idx, batch, ptr
+
+
+def _split_graphs(proteins, batch, ptr, node_attrs, edge_index, edge_attrs):
+    """ Split a graph of concatenated proteins into one torch_geometric Data object per protein.
+
+    Args
+    ----
+    proteins : list of dict
+        Protein dictionaries, in batch order
+    batch : torch.LongTensor
+        Protein index of each residue
+    ptr : torch.LongTensor
+        Index of the first residue of each protein, followed by the number of residues
+    node_attrs : dict of torch.Tensor
+        Node attributes, indexed by residue along the first dimension
+    edge_index : torch.LongTensor
+        Edges between residues of the same protein, grouped by protein
+        Shape: 2 x num_edges
+    edge_attrs : dict of torch.Tensor
+        Edge attributes, indexed by edge along the first dimension
 
     Returns
     -------
-    torch_geometric.data.Data
-        Data object containing
-        - :code:`x` - CA atomic coordinates
-        - :code:`seq` - sequence of protein
-        - :code:`name` - PDB ID of protein
-        - :code:`node_s` - Node scalar features
-        - :code:`node_v` - Node vector features
-        - :code:`edge_s` - Edge scalar features
-        - :code:`edge_v` - Edge vector features
-        - :code:`edge_index` - Sparse representation of edge
-        - :code:`mask` - Residue mask specifying residues with incomplete coordinate sets
+    list of torch_geometric.data.Data
+        Per-protein graphs, with residue indices local to the protein
     """
-    name = protein['name']
-    with torch.no_grad():
-        coords = torch.as_tensor(protein['coords'], device=dev, dtype=torch.float32)
-        seq = torch.as_tensor(protein['seq'], device=dev, dtype=torch.long)
+    node_sizes = (ptr[1:] - ptr[:-1]).tolist()
+    edge_sizes = torch.bincount(batch[edge_index[1]], minlength=len(proteins)).tolist()
+    node_splits = {key: value.split(node_sizes) for key, value in node_attrs.items()}
+    edge_splits = {key: value.split(edge_sizes) for key, value in edge_attrs.items()}
+    edge_index_splits = edge_index.split(edge_sizes, dim=1)
+    data_list = []
+    for i, protein in enumerate(proteins):
+        data = torch_geometric.data.Data(name=protein['name'], edge_index=edge_index_splits[i] - ptr[i])
+        for key, value in node_splits.items():
+            data[key] = value[i]
+        for key, value in edge_splits.items():
+            data[key] = value[i]
+        data_list.append(data)
+    return data_list
+
+
+def _edge_index(proteins, X_ca, batch, ptr):
+    """ kNN graph of concatenated proteins, in torch_geometric form.
+
+    If every protein carries the kNN graph built at collate time (see :code:`_knn_graph`) under :code:`E_idx`,
+    that graph is reused instead of searching for neighbors again. Otherwise, :code:`k_neighbors` neighbors
+    are searched for, as set on the proteins (:code:`KNN_NEIGHBORS` by default).
 
-        mask = torch.isfinite(coords.sum(dim=(1, 2)))
-        coords[~mask] = np.inf
+    Args
+    ----
+    proteins : list of dict
+        Protein dictionaries, in batch order
+    X_ca : torch.FloatTensor
+        CA coordinates of all residues
+        Shape: num_res x 3
+    batch : torch.LongTensor
+        Protein index of each residue
+    ptr : torch.LongTensor
+        Index of the first residue of each protein, followed by :code:`num_res`
+
+    Returns
+    -------
+    torch.LongTensor
+        Edges from neighbors to residues, grouped by residue
+        Shape: 2 x num_edges
+    """
+    if all('E_idx' in protein for protein in proteins):
+        E_idx = torch.cat([protein['E_idx'].to(X_ca.device) + ptr[i] for i, protein in enumerate(proteins)])
+        centers = torch.arange(E_idx.shape[0], device=X_ca.device).repeat_interleave(E_idx.shape[-1])
+        return torch.stack([E_idx.flatten(), centers])
+    k = proteins[0].get('k_neighbors', KNN_NEIGHBORS) if proteins else KNN_NEIGHBORS
+    return torch_cluster.knn_graph(X_ca, k=k, batch=batch, loop=True)
+
+
+def _jing_featurize_batch(proteins, dev='cpu'):
+    """ Featurize a batch of proteins for use in torch_geometric Data objects,
+    as done in https://github.com/drorlab/gvp-pytorch
+
+    All proteins are featurized at once as one graph with a batch vector, then split.
+
+    Args
+    ----
+    proteins : list of dict
+        Protein dictionaries (see :code:`_jing_featurize`)
+    dev : str, default='cpu'
+        Device to place torch tensors
+
+    Returns
+    -------
+    list of torch_geometric.data.Data
+        One Data object per protein (see :code:`_jing_featurize`)
+    """
+    with torch.no_grad():
+        coords, seq, mask, chain_idx, batch, ptr = _concat_proteins(proteins, dev)
 
         X_ca = coords[:, 1]
-        edge_index = torch_cluster.knn_graph(X_ca, k=30, loop=True)  # TODO: make param
+        edge_index = _edge_index(proteins, X_ca, batch, ptr)
 
         pos_embeddings = _positional_embeddings(edge_index)
         # generate mask for interchain interactions
-        pos_chain = (protein['chain_idx'][edge_index.view(-1)]).view(2, -1)
+        pos_chain = (chain_idx[edge_index.view(-1)]).view(2, -1)
         pos_mask = (pos_chain[0] != pos_chain[1])
         # zero out all interchain positional embeddings
         pos_embeddings = pos_mask.unsqueeze(-1) * pos_embeddings
@@ -213,8 +335,8 @@ def _jing_featurize(protein, dev='cpu'):
         E_vectors = X_ca[edge_index[0]] - X_ca[edge_index[1]]
         rbf = _rbf(E_vectors.norm(dim=-1), D_count=16, device=dev)  # TODO: make param
 
-        dihedrals = _dihedrals(coords)
-        orientations = _orientations(X_ca)
+        dihedrals = _dihedrals(coords, ptr=ptr)
+        orientations = _orientations(X_ca, ptr=ptr)
         sidechains = _sidechains(coords)
 
         node_s = dihedrals
@@ -224,16 +346,48 @@ def _jing_featurize(protein, dev='cpu'):
 
         node_s, node_v, edge_s, edge_v = map(torch.nan_to_num, (node_s, node_v, edge_s, edge_v))
 
-    data = torch_geometric.data.Data(x=X_ca,
-                                     seq=seq,
-                                     name=name,
-                                     node_s=node_s,
-                                     node_v=node_v,
-                                     edge_s=edge_s,
-                                     edge_v=edge_v,
-                                     edge_index=edge_index,
-                                     mask=mask)
-    return data
+    return _split_graphs(proteins,
+                         batch,
+                         ptr,
+                         node_attrs={'x': X_ca, 'seq': seq, 'node_s': node_s, 'node_v': node_v, 'mask': mask},
+                         edge_index=edge_index,
+                         edge_attrs={'edge_s': edge_s, 'edge_v': edge_v})
+
+
+def _jing_featurize(protein, dev='cpu'):
+    """ Featurize individual proteins for use in torch_geometric Data objects,
+    as done in https://github.com/drorlab/gvp-pytorch
+
+    Args
+    ----
+    protein : dict
+        Dictionary of protein features
+
+        - :code:`name` - PDB ID of the protein
+        - :code:`coords` - list of dicts specifying backbone atom coordinates
+        in the format of that outputted by :code:`parseCoords.py`
+        - :code:`seq` - protein sequence
+        - :code:`chain_idx` - an integer per residue such that each unique integer represents a unique chain
+        - :code:`E_idx` - optional, kNN graph to use instead of searching for neighbors
+          (see :code:`_knn_graph`)
+        - :code:`k_neighbors` - optional, number of neighbors to search for otherwise. Defaults to
+          :code:`KNN_NEIGHBORS`.
+
+    Returns
+    -------
+    torch_geometric.data.Data
+        Data object containing
+        - :code:`x` - CA atomic coordinates
+        - :code:`seq` - sequence of protein
+        - :code:`name` - PDB ID of protein
+        - :code:`node_s` - Node scalar features
+        - :code:`node_v` - Node vector features
+        - :code:`edge_s` - Edge scalar features
+        - :code:`edge_v` - Edge vector features
+        - :code:`edge_index` - Sparse representation of edge
+        - :code:`mask` - Residue mask specifying residues with incomplete coordinate sets
+    """
+    return _jing_featurize_batch([protein], dev=dev)[0]
 
 
 # Ingraham featurization functions
@@ -263,13 +417,11 @@ def _ingraham_featurize(batch, device="cpu"):
     B = len(batch)
     lengths = np.array([b.shape[0] for b in batch], dtype=np.int32)
     l_max = max(lengths)
-    X = np.zeros([B, l_max, 4, 3])
+    X = np.full([B, l_max, 4, 3], np.nan)
 
-    # Build the batch
+    # Build the batch, leaving padding as nan
     for i, x in enumerate(batch):
-        l = x.shape[0]
-        x_pad = np.pad(x, [[0, l_max - l], [0, 0], [0, 0]], 'constant', constant_values=(np.nan, ))
-        X[i, :, :, :] = x_pad
+        X[i, :x.shape[0]] = x
 
     # Mask
     isnan = np.isnan(X)
@@ -306,7 +458,13 @@ def _quaternions(R, eps=1e-10):
     return Q
 
 
-def _orientations_coarse(X, edge_index, eps=1e-6):
+def _orientations_coarse(X, edge_index, eps=1e-6, ptr=None):
+    """ Compute backbone angle features and the relative orientations of residue pairs.
+
+    If :code:`X` concatenates several proteins, :code:`ptr` holds the index of the first residue of each protein,
+    followed by the number of residues. Features spanning two proteins are zeroed, like those at the
+    ends of a single protein.
+    """
     # Pair features
 
     # Shifted slices of unit vectors
@@ -336,6 +494,11 @@ def _orientations_coarse(X, edge_index, eps=1e-6):
     O = torch.stack((o_1, n_2, torch.cross(o_1, n_2)), 2)
     O = O.view(list(O.shape[:1]) + [9])
     O = F.pad(O, (0, 0, 1, 2), 'constant', 0)
+    if ptr is not None:
+        starts = ptr[1:-1]
+        boundary = torch.cat([starts, starts - 1, starts - 2])
+        AD_features[boundary] = 0
+        O[boundary] = 0
 
     # DEBUG: Viz [dense] pairwise orientations
     # O = O.view(list(O.shape[:2]) + [3,3])
@@ -378,6 +541,56 @@ def _orientations_coarse(X, edge_index, eps=1e-6):
     # print(Q.sum(), dU.sum(), R.sum())
     return AD_features, O_features
 
+def _ingraham_geometric_featurize_batch(proteins, dev='cpu'):
+    """ Featurize a batch of proteins for use in torch_geometric Data objects,
+    with the edge features of https://github.com/jingraham/neurips19-graph-protein-design
+
+    All proteins are featurized at once as one graph with a batch vector, then split.
+
+    Args
+    ----
+    proteins : list of dict
+        Protein dictionaries (see :code:`_ingraham_geometric_featurize`)
+    dev : str, default='cpu'
+        Device to place torch tensors
+
+    Returns
+    -------
+    list of torch_geometric.data.Data
+        One Data object per protein (see :code:`_ingraham_geometric_featurize`)
+    """
+    with torch.no_grad():
+        coords, seq, mask, chain_idx, batch, ptr = _concat_proteins(proteins, dev)
+
+        X_ca = coords[:, 1]
+        edge_index = _edge_index(proteins, X_ca, batch, ptr)
+
+        pos_embeddings = _positional_embeddings(edge_index)
+        # generate mask for interchain interactions
+        pos_chain = (chain_idx[edge_index.view(-1)]).view(2, -1)
+        pos_mask = (pos_chain[0] != pos_chain[1])
+        # zero out all interchain positional embeddings
+        pos_embeddings = pos_mask.unsqueeze(-1) * pos_embeddings
+
+        E_vectors = X_ca[edge_index[0]] - X_ca[edge_index[1]]
+        rbf = _rbf(E_vectors.norm(dim=-1), D_count=16, device=dev)  # TODO: make param
+
+        dihedrals = _dihedrals(coords, ptr=ptr)
+        _, orientations = _orientations_coarse(X_ca, edge_index, ptr=ptr)
+
+        node_features = dihedrals
+        edge_features = torch.cat([pos_embeddings, rbf, orientations], dim=-1)
+
+        node_features, edge_features, = map(torch.nan_to_num, (node_features, edge_features))
+
+    return _split_graphs(proteins,
+                         batch,
+                         ptr,
+                         node_attrs={'x': X_ca, 'seq': seq, 'node_features': node_features, 'mask': mask},
+                         edge_index=edge_index,
+                         edge_attrs={'edge_features': edge_features})
+
+
 def _ingraham_geometric_featurize(protein, dev='cpu'):
     """ Featurize individual proteins for use in torch_geometric Data objects,
     as done in https://github.com/drorlab/gvp-pytorch
@@ -392,6 +605,10 @@ def _ingraham_geometric_featurize(protein, dev='cpu'):
         in the format of that outputted by :code:`parseCoords.py`
         - :code:`seq` - protein sequence
         - :code:`chain_idx` - an integer per residue such that each unique integer represents a unique chain
+        - :code:`E_idx` - optional, kNN graph to use instead of searching for neighbors
+          (see :code:`_knn_graph`)
+        - :code:`k_neighbors` - optional, number of neighbors to search for otherwise. Defaults to
+          :code:`KNN_NEIGHBORS`.
 
     Returns
     -------
@@ -400,50 +617,101 @@ def _ingraham_geometric_featurize(protein, dev='cpu'):
         - :code:`x` - CA atomic coordinates
         - :code:`seq` - sequence of protein
         - :code:`name` - PDB ID of protein
-        - :code:`node_s` - Node scalar features
-        - :code:`node_v` - Node vector features
-        - :code:`edge_s` - Edge scalar features
-        - :code:`edge_v` - Edge vector features
+        - :code:`node_features` - Node features
+        - :code:`edge_features` - Edge features
         - :code:`edge_index` - Sparse representation of edge
         - :code:`mask` - Residue mask specifying residues with incomplete coordinate sets
     """
-    name = protein['name']
-    with torch.no_grad():
-        coords = torch.as_tensor(protein['coords'], device=dev, dtype=torch.float32)
-        seq = torch.as_tensor(protein['seq'], device=dev, dtype=torch.long)
+    return _ingraham_geometric_featurize_batch([protein], dev=dev)[0]
 
-        mask = torch.isfinite(coords.sum(dim=(1, 2)))
-        coords[~mask] = np.inf
 
-        X_ca = coords[:, 1]
-        edge_index = torch_cluster.knn_graph(X_ca, k=30, loop=True)  # TODO: make param
+# Featurization plans
 
-        pos_embeddings = _positional_embeddings(edge_index)
-        # generate mask for interchain interactions
-        pos_chain = (protein['chain_idx'][edge_index.view(-1)]).view(2, -1)
-        pos_mask = (pos_chain[0] != pos_chain[1])
-        # zero out all interchain positional embeddings
-        pos_embeddings = pos_mask.unsqueeze(-1) * pos_embeddings
+# plan entry for the kNN graph built at collate time (see _knn_graph), which populates the batch entries
+# `E_idx`, `E_dist` and `E_reverse` and is reused by the graph featurizers below.
+# planned as `(KNN_GRAPH, k)` for a graph of k neighbors per residue, or as `KNN_GRAPH` for KNN_NEIGHBORS
+KNN_GRAPH = 'knn_graph'
+# registry of optional per-protein featurizers, keyed by the batch entry they populate.
+# each featurizer takes a protein dictionary with keys `name`, `coords`, `seq` and `chain_idx`
+FEATURIZERS = {
+    'gvp_data': _jing_featurize,
+    'geometric_data': _ingraham_geometric_featurize,
+}
+# batched versions of the featurizers above, which featurize all proteins of a batch at once.
+# each takes a list of protein dictionaries and returns a list of per-protein outputs
+BATCH_FEATURIZERS = {
+    'gvp_data': _jing_featurize_batch,
+    'geometric_data': _ingraham_geometric_featurize_batch,
+}
 
-        E_vectors = X_ca[edge_index[0]] - X_ca[edge_index[1]]
-        rbf = _rbf(E_vectors.norm(dim=-1), D_count=16, device=dev)  # TODO: make param
 
-        dihedrals = _dihedrals(coords)
-        _, orientations = _orientations_coarse(X_ca, edge_index)
+def register_featurizer(name, featurizer, batch_featurizer=None):
+    """Register an optional per-protein featurizer so that samplers can run it on demand.
 
-        node_features = dihedrals
-        edge_features = torch.cat([pos_embeddings, rbf, orientations], dim=-1)
+    Args
+    ----
+    name : str
+        Key under which the featurized outputs are placed in the packaged batch
+    featurizer : function
+        Function with signature :code:`featurizer(protein)`, where :code:`protein` is a dictionary with keys
+        :code:`name`, :code:`coords`, :code:`seq` and :code:`chain_idx`
+    batch_featurizer : function or None, default=None
+        Optional batched version of :code:`featurizer`, with signature :code:`batch_featurizer(proteins)`
+        returning the list of :code:`featurizer(protein)` outputs. If :code:`None`, :code:`featurizer`
+        is run on each protein in turn.
+    """
+    FEATURIZERS[name] = featurizer
+    if batch_featurizer is None:
+        BATCH_FEATURIZERS.pop(name, None)
+    else:
+        BATCH_FEATURIZERS[name] = batch_featurizer
 
-        node_features, edge_features, = map(torch.nan_to_num, (node_features, edge_features))
 
-    data = torch_geometric.data.Data(x=X_ca,
-                                     seq=seq,
-                                     name=name,
-                                     node_features=node_features,
-                                     edge_features=edge_features,
-                                     edge_index=edge_index,
-                                     mask=mask)
-    return data
+def featurization_plan(model_hparams, training=False):
+    """Determine which optional featurizations are consumed by a model built from :code:`model_hparams`.
+
+    Args
+    ----
+    model_hparams : dict
+        Fully configured model hparams dictionary (see :code:`terminator/utils/model/default_hparams.py`)
+    training : bool, default=False
+        Whether the plan is for the training samplers. Coordinates augmented by the model during training
+        have different neighbors, so the collate-time kNN graph is then only built where it is still reused.
+
+    Returns
+    -------
+    tuple
+        Names of the registered featurizers in :code:`FEATURIZERS` that the samplers should run,
+        preceded by :code:`(KNN_GRAPH, k_neighbors)` if the model can reuse the collate-time kNN graph
+    """
+    plan = []
+    # augmented coordinates are searched for neighbors again, unless batches are packed or GVP featurized
+    augmented = training and model_hparams.get('energies_augment_eps', 0) > 0
+    if not augmented or model_hparams.get('energies_packed', False) or model_hparams.get('energies_gvp', False):
+        plan.append((KNN_GRAPH, model_hparams.get('k_neighbors', KNN_NEIGHBORS)))
+    if model_hparams.get('energies_gvp', False):
+        plan.append('gvp_data')
+    return tuple(plan)
+
+
+def _knn_neighbors(name):
+    """Number of neighbors of the kNN graph planned by a plan entry, or :code:`None` if it doesn't plan one."""
+    if name == KNN_GRAPH:
+        return KNN_NEIGHBORS
+    if isinstance(name, tuple) and len(name) == 2 and name[0] == KNN_GRAPH:
+        return name[1]
+    return None
+
+
+def _check_featurization_plan(featurize):
+    """Validate a featurization plan and return it as a tuple."""
+    if featurize is None:
+        return ()
+    featurize = tuple(featurize)
+    for name in featurize:
+        if _knn_neighbors(name) is None and name not in FEATURIZERS:
+            raise ValueError(f"featurizer {name} is not registered, options are {list(FEATURIZERS.keys())}")
+    return featurize
 
 
 # Batching functions
@@ -454,7 +722,95 @@ def convert(tensor):
     return torch.from_numpy(tensor)
 
 
-def _package(b_idx):
+def _pad_buffer(batch, field, dtype):
+    """Allocate the padded batch buffer for one field of the feature dictionaries.
+
+    The buffer is large enough to hold the field of every datapoint in the batch,
+    with every dimension padded to the largest size in the batch.
+
+    Args
+    ----
+    batch : list of dict
+        Feature dictionaries in the batch
+    field : str
+        Field of the feature dictionaries to allocate a buffer for
+    dtype : np.dtype
+        Type of the buffer
+
+    Returns
+    -------
+    np.ndarray
+        Zero-filled buffer of shape :code:`(len(batch), max dim 0, max dim 1, ...)`
+    """
+    shapes = np.array([data[field].shape for data in batch])
+    return np.zeros((len(batch), ) + tuple(shapes.max(axis=0)), dtype=dtype)
+
+
+def _knn_graph(X, x_mask, k=KNN_NEIGHBORS, eps=1e-6):
+    """ Build the kNN graph of a padded batch, the same way :code:`ProteinFeatures._dist` does in the model.
+
+    Args
+    ----
+    X : torch.FloatTensor
+        Backbone coordinates, as outputted by :code:`_ingraham_featurize`
+        Shape: n_batch x n_res x 4 x 3
+    x_mask : torch.FloatTensor
+        Mask for X
+        Shape: n_batch x n_res
+    k : int, default=KNN_NEIGHBORS
+        Number of neighbors per residue, including itself. Capped at :code:`n_res`.
+
+    Returns
+    -------
+    E_idx : torch.LongTensor
+        Neighbors of each residue, nearest (i.e. the residue itself) first
+        Shape: n_batch x n_res x k
+    D_neighbors : torch.FloatTensor
+        CA distances to the neighbors
+        Shape: n_batch x n_res x k
+    """
+    X_ca = X[:, :, 1]
+    mask_2D = x_mask.unsqueeze(1) * x_mask.unsqueeze(2)
+    dX = X_ca.unsqueeze(1) - X_ca.unsqueeze(2)
+    D = mask_2D * torch.sqrt(torch.sum(dX**2, 3) + eps)
+    # push masked residues to the back of the neighbor lists
+    D_max, _ = torch.max(D, -1, keepdim=True)
+    D_adjust = D + (1. - mask_2D) * D_max
+    D_neighbors, E_idx = torch.topk(D_adjust, min(k, D.shape[-1]), dim=-1, largest=False)
+    return E_idx, D_neighbors
+
+
+def _reverse_edges(E_idx):
+    """ Locate the reverse of every edge of a kNN graph.
+
+    Args
+    ----
+    E_idx : torch.LongTensor
+        kNN graph, as outputted by :code:`_knn_graph`
+        Shape: n_batch x n_res x k
+
+    Returns
+    -------
+    torch.LongTensor
+        For the edge from residue :code:`i` to its :code:`m`-th neighbor :code:`j`, the position :code:`j * k + m'`
+        of the edge from :code:`j` to :code:`i` in the flattened neighbor lists of the protein,
+        or -1 if :code:`i` is not a neighbor of :code:`j`
+        Shape: n_batch x n_res x k
+    """
+    n_batch, n_res, k = E_idx.shape
+    src = torch.arange(n_res).view(1, -1, 1).expand_as(E_idx)
+    offset = torch.arange(n_batch).view(-1, 1, 1) * n_res * n_res
+    # encode every edge as one integer, then look up the codes of the reverse edges
+    forward = (offset + src * n_res + E_idx).flatten()
+    backward = (offset + E_idx * n_res + src).flatten()
+    order = torch.argsort(forward)
+    pos = torch.searchsorted(forward[order], backward).clamp(max=len(forward) - 1)
+    found = forward[order][pos] == backward
+    local = order[pos] - torch.arange(n_batch).repeat_interleave(n_res * k) * n_res * k
+    return torch.where(found, local, torch.full_like(local, -1)).view(E_idx.shape)
+
+
+def _package(b_idx, featurize=()):
     """Package the given datapoints into tensors based on provided indices.
 
     Tensors are extracted from the data and padded. Coordinates are featurized
@@ -465,11 +821,15 @@ def _package(b_idx):
     b_idx : list of tuples (dicts, int)
         The feature dictionaries, as well as an int for the sum of the lengths of all TERMs,
         for each datapoint to package.
+    featurize : tuple, default=()
+        Names of the optional featurizers in :code:`FEATURIZERS` to run on each datapoint, and the kNN graph
+        to build (see :code:`featurization_plan`). Only these entries are added to the batch.
 
     Returns
     -------
-    dict
-        Collection of batched features required for running TERMinator. This contains:
+    TERMBatch
+        Collection of batched features required for running TERMinator (see :code:`terminator.data.batch`).
+        This contains:
 
         - :code:`msas` - the sequences for each TERM match to the target structure
 
@@ -494,37 +854,62 @@ def _package(b_idx):
         - :code:`ids` - the PDB ids
 
         - :code:`chain_idx` - the chain IDs
+
+        - :code:`scatter_idx` - the index of each protein in the batch, for :code:`nn.DataParallel`
+
+        - :code:`E_idx`, :code:`E_dist`, :code:`E_reverse` - the kNN graph, its CA distances, and
+          the position of the reverse of each edge, if :code:`featurize` plans the kNN graph
+          (see :code:`_knn_graph` and :code:`_reverse_edges`)
+
+        - one entry per featurizer in :code:`featurize`, e.g. :code:`gvp_data`
     """
     # wrap up all the tensors with proper padding and masks
     batch = [data[0] for data in b_idx]
     focus_lens = [data[1] for data in b_idx]
-    features, msas, focuses, seq_lens, coords = [], [], [], [], []
-    term_lens = []
-    seqs = []
-    ids = []
-    chain_lens = []
-    ppoe = []
-    contact_idxs = []
-    gvp_data = []
-    geometric_data = []
+    n_batch = len(batch)
+    ids = [data['pdb'] for data in batch]
+    seq_lens = torch.tensor([data['seq_len'] for data in batch])
+    chain_lens = [data['chain_lens'] for data in batch]
+    proteins = []
+
+    # preallocate the padded batch from the largest shapes in the batch.
+    # datapoints may be stored in compact dtypes (see terminator.data.compact), so cast to what the model consumes
+    features = _pad_buffer(batch, 'features', dtype=np.float32)
+    msas = _pad_buffer(batch, 'msas', dtype=np.int64)
+    ppoe = _pad_buffer(batch, 'ppoe', dtype=np.float32)
+    focuses = _pad_buffer(batch, 'focuses', dtype=np.int64)
+    contact_idxs = _pad_buffer(batch, 'contact_idxs', dtype=np.int64)
+    seqs = _pad_buffer(batch, 'sequence', dtype=np.int64)
+    chain_idx = np.zeros((n_batch, max(sum(c_lens) for c_lens in chain_lens)), dtype=np.float32)
+    src_key_mask = np.ones((n_batch, max(focus_lens)), dtype=bool)
+
+    # we do some padding so that tensor reshaping during batchifyTERM works:
+    # each protein's TERM lengths are extended with TERMs of its longest TERM length
+    # (plus one remainder TERM) to cover the padded TERM residues, then padded with -1
+    # TODO(alex): explain this since I have no idea what's going on
+    max_aa = focuses.shape[-1]
+    padded_term_lens = []
+    for data in batch:
+        lens = np.asarray(data['term_lens'], dtype=np.int64)
+        max_term_len = lens.max()
+        diff = max_aa - lens.sum()
+        padded_term_lens.append(
+            np.concatenate([lens, np.full(diff // max_term_len, max_term_len), [diff % max_term_len]]))
+    term_lens = np.full((n_batch, max(len(lens) for lens in padded_term_lens)), -1, dtype=np.int64)
 
     sortcery_seqs = []
     sortcery_nrgs = []
 
-    for _, data in enumerate(batch):
-        # have to transpose these two because then we can use pad_sequence for padding
-        features.append(convert(data['features']).transpose(0, 1))
-        msas.append(convert(data['msas']).transpose(0, 1))
-
-        ppoe.append(convert(data['ppoe']))
-        focuses.append(convert(data['focuses']))
-        contact_idxs.append(convert(data['contact_idxs']))
-        seq_lens.append(data['seq_len'])
-        term_lens.append(data['term_lens'].tolist())
-        coords.append(data['coords'])
-        seqs.append(convert(data['sequence']))
-        ids.append(data['pdb'])
-        chain_lens.append(data['chain_lens'])
+    # fill the buffers in a single pass over the batch
+    for i, data in enumerate(batch):
+        for buffer, field in [(features, 'features'), (msas, 'msas'), (ppoe, 'ppoe'), (focuses, 'focuses'),
+                              (contact_idxs, 'contact_idxs'), (seqs, 'sequence')]:
+            value = data[field]
+            buffer[(i, ) + tuple(slice(0, dim) for dim in value.shape)] = value
+        protein_chain_idx = np.repeat(np.arange(len(chain_lens[i]), dtype=np.float32), chain_lens[i])
+        chain_idx[i, :len(protein_chain_idx)] = protein_chain_idx
+        src_key_mask[i, :focus_lens[i]] = False
+        term_lens[i, :len(padded_term_lens[i])] = padded_term_lens[i]
 
         if 'sortcery_seqs' in data:
             assert len(batch) == 1, "batch_size for SORTCERY fine-tuning should be set to 1"
@@ -532,68 +917,54 @@ def _package(b_idx):
         if 'sortcery_nrgs' in data:
             sortcery_nrgs = convert(data['sortcery_nrgs']).unsqueeze(0)
 
-        chain_idx = []
-        for i, c_len in enumerate(data['chain_lens']):
-            chain_idx.append(torch.ones(c_len) * i)
-        chain_idx = torch.cat(chain_idx, dim=0)
-        gvp_data.append(
-            _jing_featurize({
+        if featurize:
+            proteins.append({
                 'name': data['pdb'],
                 'coords': data['coords'],
                 'seq': data['sequence'],
-                'chain_idx': chain_idx
-            }))
-        geometric_data.append(
-            _ingraham_geometric_featurize({
-                'name': data['pdb'],
-                'coords': data['coords'],
-                'seq': data['sequence'],
-                'chain_idx': chain_idx
-            }))
-
-    # transpose back after padding
-    features = pad_sequence(features, batch_first=True).transpose(1, 2)
-    msas = pad_sequence(msas, batch_first=True).transpose(1, 2).long()
-
-    # we can pad these using standard pad_sequence
-    ppoe = pad_sequence(ppoe, batch_first=True)
-    focuses = pad_sequence(focuses, batch_first=True)
-    contact_idxs = pad_sequence(contact_idxs, batch_first=True)
-    src_key_mask = pad_sequence([torch.zeros(l) for l in focus_lens], batch_first=True, padding_value=1).bool()
-    seqs = pad_sequence(seqs, batch_first=True)
-
-    # we do some padding so that tensor reshaping during batchifyTERM works
-    # TODO(alex): explain this since I have no idea what's going on
-    max_aa = focuses.size(-1)
-    for lens in term_lens:
-        max_term_len = max(lens)
-        diff = max_aa - sum(lens)
-        lens += [max_term_len] * (diff // max_term_len)
-        lens.append(diff % max_term_len)
+                'chain_idx': torch.from_numpy(protein_chain_idx)
+            })
 
     # featurize coordinates same way as ingraham et al
-    X, x_mask, _ = _ingraham_featurize(coords)
-
-    # pad with -1 so we can store term_lens in a tensor
-    seq_lens = torch.tensor(seq_lens)
-    max_all_term_lens = max([len(term) for term in term_lens])
-    for i, _ in enumerate(term_lens):
-        term_lens[i] += [-1] * (max_all_term_lens - len(term_lens[i]))
-    term_lens = torch.tensor(term_lens)
-
-    # generate chain_idx from chain_lens
-    chain_idx = []
-    for c_lens in chain_lens:
-        arrs = []
-        for i, chain_len in enumerate(c_lens):
-            arrs.append(torch.ones(chain_len) * i)
-        chain_idx.append(torch.cat(arrs, dim=-1))
-    chain_idx = pad_sequence(chain_idx, batch_first=True)
-
-    return {
+    X, x_mask, _ = _ingraham_featurize([data['coords'] for data in batch])
+
+    featurized = {}
+    k = next((_knn_neighbors(name) for name in featurize if _knn_neighbors(name) is not None), None)
+    if k is not None:
+        # build the kNN graph once, for the model and the graph featurizers
+        E_idx, featurized['E_dist'] = _knn_graph(X, x_mask, k=k)
+        featurized['E_idx'] = E_idx
+        featurized['E_reverse'] = _reverse_edges(E_idx)
+        for i, protein in enumerate(proteins):
+            # neighbor lists of short proteins may hold padding, in which case the featurizers search again
+            n_res = len(protein['coords'])
+            protein['k_neighbors'] = k
+            if (E_idx[i, :n_res] < n_res).all():
+                protein['E_idx'] = E_idx[i, :n_res]
+
+    # only run the graph featurizers the model will consume, on the whole batch at once when possible
+    for name in featurize:
+        if _knn_neighbors(name) is not None:
+            continue
+        if name in BATCH_FEATURIZERS:
+            featurized[name] = BATCH_FEATURIZERS[name](proteins)
+        else:
+            featurized[name] = [FEATURIZERS[name](protein) for protein in proteins]
+
+    features = convert(features)
+    msas = convert(msas)
+    ppoe = convert(ppoe)
+    focuses = convert(focuses)
+    contact_idxs = convert(contact_idxs)
+    seqs = convert(seqs)
+    chain_idx = convert(chain_idx)
+    src_key_mask = convert(src_key_mask)
+    term_lens = convert(term_lens)
+
+    packaged_batch = TERMBatch({
         'msas': msas,
-        'features': features.float(),
-        'ppoe': ppoe.float(),
+        'features': features,
+        'ppoe': ppoe,
         'seq_lens': seq_lens,
         'focuses': focuses,
         'contact_idxs': contact_idxs,
@@ -604,16 +975,212 @@ def _package(b_idx):
         'seqs': seqs,
         'ids': ids,
         'chain_idx': chain_idx,
-        'gvp_data': gvp_data,
         'sortcery_seqs': sortcery_seqs,
         'sortcery_nrgs': sortcery_nrgs,
-        'geometric_data': geometric_data
-    }
+        'scatter_idx': torch.arange(n_batch)
+    })
+    packaged_batch.update(featurized)
+    return packaged_batch
+
+
+# Bin packing functions
+
+
+def _batch_cost(term_lengths, seq_lengths, max_term_res=None, max_seq_tokens=None, max_seq_pairs=None):
+    """Compute the fraction of each token budget used by each datapoint if it were batched alone.
+
+    The padded size of a batch is its size times the size of its largest member,
+    so the cost of a batch is the largest cost of its members times the batch size.
+
+    Args
+    ----
+    term_lengths : np.ndarray of int
+        Sum of the lengths of all TERMs of each datapoint
+    seq_lengths : np.ndarray of int
+        Sequence length of each datapoint
+    max_term_res : int or None
+        Budget of padded TERM residues per batch
+    max_seq_tokens : int or None
+        Budget of padded sequence tokens per batch
+    max_seq_pairs : int or None
+        Budget of padded residue pairs per batch, which bounds the
+        :code:`n_batch x L x L` edge tensors built by :code:`aggregate_edges`
+
+    Returns
+    -------
+    np.ndarray of float
+        Cost of each datapoint, as a fraction of the tightest budget
+    """
+    term_lengths = np.asarray(term_lengths, dtype=np.float64)
+    seq_lengths = np.asarray(seq_lengths, dtype=np.float64)
+    cost = np.zeros(len(seq_lengths))
+    if max_term_res:
+        cost = np.maximum(cost, term_lengths / max_term_res)
+    if max_seq_tokens:
+        cost = np.maximum(cost, seq_lengths / max_seq_tokens)
+    if max_seq_pairs:
+        cost = np.maximum(cost, seq_lengths**2 / max_seq_pairs)
+    return cost
+
+
+def _bin_pack(idx_list, term_lengths, seq_lengths, max_term_res=None, max_seq_tokens=None, max_seq_pairs=None,
+              bucket_size=500):
+    """Pack datapoints into batches which fill the token budgets as tightly as possible.
+
+    Datapoints are bucketed by cost in windows of :code:`bucket_size` along :code:`idx_list`, so that
+    the ordering (e.g. shuffling) of :code:`idx_list` is mostly preserved while neighbouring datapoints have
+    similar lengths. Batches are then filled greedily, accounting for padding against the largest member
+    in every budget at once, which yields batches of near-equal padded cost.
+
+    Args
+    ----
+    idx_list : list of int
+        Ordering of the datapoints to pack
+    term_lengths : list of int
+        Sum of the lengths of all TERMs of each datapoint
+    seq_lengths : list of int
+        Sequence length of each datapoint
+    max_term_res : int or None
+        Budget of padded TERM residues per batch
+    max_seq_tokens : int or None
+        Budget of padded sequence tokens per batch
+    max_seq_pairs : int or None
+        Budget of padded residue pairs per batch (see :code:`_batch_cost`)
+    bucket_size : int, default=500
+        Number of consecutive datapoints in :code:`idx_list` sorted together
+
+    Returns
+    -------
+    list of list of int
+        Batches of datapoint indices
+    """
+    idx_list = np.asarray(idx_list, dtype=np.int64)
+    costs = _batch_cost(term_lengths, seq_lengths, max_term_res, max_seq_tokens, max_seq_pairs)
+    # sort by cost within each bucket
+    buckets = np.arange(len(idx_list)) // bucket_size
+    idx_list = idx_list[np.lexsort((costs[idx_list], buckets))]
+
+    clusters, batch = [], []
+    max_cost = 0
+    for idx in idx_list.tolist():
+        new_max_cost = max(max_cost, costs[idx])
+        if batch and new_max_cost * (len(batch) + 1) > 1:
+            clusters.append(batch)
+            batch, new_max_cost = [], costs[idx]
+        batch.append(idx)
+        max_cost = new_max_cost
+    if batch:
+        clusters.append(batch)
+    return clusters
+
+
+def _padding_efficiency(clusters, lengths):
+    """Fraction of the padded batch entries which hold real data.
+
+    Args
+    ----
+    clusters : list of list of int
+        Batches of datapoint indices
+    lengths : list of int
+        Length of each datapoint
+
+    Returns
+    -------
+    float
+        Real tokens over padded tokens, summed over all batches
+    """
+    lengths = np.asarray(lengths)
+    real, padded = 0, 0
+    for batch in clusters:
+        batch_lens = lengths[batch]
+        real += batch_lens.sum()
+        padded += batch_lens.max() * len(batch)
+    return real / max(padded, 1)
 
 
 # Non-lazy data loading functions
 
 
+def _truncate_matches(data, num_matches):
+    """Keep only the top :code:`num_matches` TERM matches of a feature dictionary.
+
+    :code:`features` and :code:`msas` are stored match-major, so this is a view of their prefix.
+
+    Args
+    ----
+    data : dict
+        Feature dictionary
+    num_matches : int or None
+        Number of matches to keep. If :code:`None`, keep all matches.
+
+    Returns
+    -------
+    dict
+        Feature dictionary with truncated :code:`features` and :code:`msas`
+    """
+    if num_matches is None:
+        return data
+    data = dict(data)
+    data['features'] = data['features'][:num_matches]
+    data['msas'] = data['msas'][:num_matches]
+    return data
+
+
+def _sample_term_dropout(term_dropout, n_align):
+    """Sample the number of TERM matches kept by TERM match dropout for one batch.
+
+    Args
+    ----
+    term_dropout : str
+        :code:`'keep_first'` or :code:`'all'` (see :code:`TERMLazyBatchSampler`)
+    n_align : int
+        Number of TERM matches available
+
+    Returns
+    -------
+    n_keep : int
+        Number of matches to sample, besides the first match under :code:`'keep_first'`
+    num_matches : int
+        Number of top matches to load, from which the kept matches are sampled
+    """
+    if term_dropout == 'keep_first':
+        n_keep = torch.randint(0, n_align, [1]).item()
+        return n_keep, n_keep + 1
+    n_keep = torch.randint(1, n_align, [1]).item()
+    return n_keep, n_keep
+
+
+def _apply_term_dropout(packaged_batch, term_dropout, n_keep):
+    """Shuffle the kept TERM matches of a packaged batch, independently for every TERM residue.
+
+    Args
+    ----
+    packaged_batch : dict or TERMBatch
+        Batch packaged from the top :code:`num_matches` matches (see :code:`_sample_term_dropout`),
+        whose :code:`features` and :code:`msas` are updated in place
+    term_dropout : str
+        :code:`'keep_first'` or :code:`'all'`
+    n_keep : int
+        Number of matches sampled, as outputted by :code:`_sample_term_dropout`
+    """
+    if n_keep == 0:
+        return
+    features = packaged_batch["features"]
+    msas = packaged_batch["msas"]
+    # the first match is always kept under keep_first
+    n_fixed = 1 if term_dropout == 'keep_first' else 0
+    n_batch, _, n_terms, n_features = features.shape
+    # sample from a multinomial distribution
+    weights = torch.ones([1, 1]).expand([n_batch * n_terms, n_keep])
+    sample_idx = torch.multinomial(weights, n_keep)
+    sample_idx = sample_idx.view([n_batch, n_terms, n_keep]).transpose(-1, -2)
+    sample_idx_features = sample_idx.unsqueeze(-1).expand([n_batch, n_keep, n_terms, n_features])
+    sample_features = torch.gather(features[:, n_fixed:], 1, sample_idx_features)
+    sample_msas = torch.gather(msas[:, n_fixed:], 1, sample_idx)
+    packaged_batch["features"] = torch.cat([features[:, :n_fixed], sample_features], dim=1)
+    packaged_batch["msas"] = torch.cat([msas[:, :n_fixed], sample_msas], dim=1)
+
+
 def load_file(in_folder, pdb_id, min_protein_len=30):
     """Load the data specified in the proper .features file and return them.
     If the read sequence length is less than :code:`min_protein_len`, instead return None.
@@ -649,10 +1216,17 @@ def load_file(in_folder, pdb_id, min_protein_len=30):
 class TERMDataset(Dataset):
     """TERM Dataset that loads all feature files into a Pytorch Dataset-like structure.
 
+    Features are held in a shared-memory :code:`SharedShard`, so DataLoader workers
+    all read the same physical pages instead of gradually copying the dataset.
+
     Attributes
     ----
-    dataset : list
-        list of tuples containing features, TERM length, and sequence length
+    arena : SharedShard or None
+        shared-memory arrays holding the features of every protein, or :code:`None` if the dataset is empty
+    total_term_lengths : np.ndarray of int
+        sum of the lengths of all TERMs of each protein
+    seq_lengths : np.ndarray of int
+        sequence length of each protein
     shuffle_idx : list
         array of indices for the dataset, for shuffling
     """
@@ -663,7 +1237,8 @@ class TERMDataset(Dataset):
         Reads in all feature files from the given directory, using multiprocessing
         with the provided number of processes. Stores the features, the TERM length,
         and the sequence length as a tuple representing the data. Can read from PDB ids or
-        file paths directly. Uses the given protein length as a cutoff.
+        file paths directly. Uses the given protein length as a cutoff. If the directory
+        has a manifest (see :code:`terminator/data/manifest.py`), it is used to select which files to read.
 
         Args
         ----
@@ -676,11 +1251,19 @@ class TERMDataset(Dataset):
         num_processes: int, default=32
             number of processes to use during dataloading
         """
-        self.dataset = []
+        dataset = []
+
+        # the dataset manifest, if present, applies the split and length filters without touching feature files
+        entries = read_manifest(in_folder,
+                                pdb_ids=pdb_ids,
+                                min_protein_len=min_protein_len,
+                                num_processes=num_processes)
+        if entries is not None:
+            pdb_ids = [pdb_id for pdb_id, _, _ in entries]
 
         with mp.Pool(num_processes) as pool:
 
-            if pdb_ids:
+            if pdb_ids or entries is not None:
                 print("Loading feature files")
                 progress = tqdm(total=len(pdb_ids))
 
@@ -700,7 +1283,7 @@ class TERMDataset(Dataset):
                     data = res.get()
                     if data is not None:
                         features, total_term_length, seq_len = data
-                        self.dataset.append((features, total_term_length, seq_len))
+                        dataset.append((features, total_term_length, seq_len))
             else:
                 print("Loading feature file paths")
 
@@ -726,9 +1309,19 @@ class TERMDataset(Dataset):
                     data = res.get()
                     if data is not None:
                         features, total_term_length, seq_len = data
-                        self.dataset.append((features, total_term_length, seq_len))
+                        dataset.append((features, total_term_length, seq_len))
 
-            self.shuffle_idx = np.arange(len(self.dataset))
+        # move the features into shared memory, keeping only a compact index per protein
+        if dataset:
+            features, total_term_lengths, seq_lengths = zip(*dataset)
+            del dataset
+            self.arena = SharedShard(list(features))
+        else:
+            total_term_lengths, seq_lengths = [], []
+            self.arena = None
+        self.total_term_lengths = np.array(total_term_lengths, dtype=np.int64)
+        self.seq_lengths = np.array(seq_lengths, dtype=np.int64)
+        self.shuffle_idx = np.arange(len(self.seq_lengths))
 
     def shuffle(self):
         """Shuffle the current dataset."""
@@ -742,7 +1335,7 @@ class TERMDataset(Dataset):
         int
             length of dataset
         """
-        return len(self.dataset)
+        return len(self.seq_lengths)
 
     def __getitem__(self, idx):
         """Extract a given item with provided index.
@@ -762,8 +1355,12 @@ class TERMDataset(Dataset):
         """
         data_idx = self.shuffle_idx[idx]
         if isinstance(data_idx, list):
-            return [self.dataset[i] for i in data_idx]
-        return self.dataset[data_idx]
+            return [self._item(i) for i in data_idx]
+        return self._item(data_idx)
+
+    def _item(self, data_idx):
+        """Build the datapoint tuple at position :code:`data_idx` of the index, viewing into the shared arena."""
+        return self.arena.load(data_idx), int(self.total_term_lengths[data_idx]), int(self.seq_lengths[data_idx])
 
 
 class TERMBatchSampler(Sampler):
@@ -773,8 +1370,8 @@ class TERMBatchSampler(Sampler):
     ----
     size: int
         Length of the dataset
-    dataset: List
-        List of features from TERM dataset
+    dataset: TERMDataset or List
+        TERM dataset, or list of features from a TERM dataset
     total_term_lengths: List
         List of TERM lengths from the given dataset
     seq_lengths: List
@@ -812,6 +1409,18 @@ class TERMBatchSampler(Sampler):
         When :code:`batch_size=None, max_term_res=None, max_seq_tokens>0`,
         batch by fitting as many datapoints as possible with the total number of
         sequence residues included below `max_seq_tokens`.
+    max_seq_pairs : int or None, default=None
+        Budget of padded residue pairs (:code:`n_batch * L * L`) per batch when :code:`bin_pack=True`,
+        bounding the dense edge tensors built in :code:`aggregate_edges`.
+    bin_pack : bool, default=False
+        When :code:`batch_size=None`, pack batches with :code:`_bin_pack` so that every set budget
+        among :code:`max_term_res`, :code:`max_seq_tokens` and :code:`max_seq_pairs` is respected at once.
+    padding_efficiency : tuple of float or None
+        Fraction of real TERM residues and sequence tokens among the padded ones, over the last packing
+    rng : np.random.RandomState or None, default=None
+        Random state used to shuffle and cluster the data. If :code:`None`, use the global numpy random state.
+    featurize : tuple of str
+        Optional featurizers from :code:`FEATURIZERS` run while packaging batches.
     """
     def __init__(self,
                  dataset,
@@ -823,7 +1432,10 @@ class TERMBatchSampler(Sampler):
                  batch_shuffle=True,
                  drop_last=False,
                  max_term_res=55000,
-                 max_seq_tokens=None):
+                 max_seq_tokens=None,
+                 max_seq_pairs=None,
+                 bin_pack=False,
+                 featurize=None):
         """
         Reads in and processes a given dataset.
 
@@ -864,14 +1476,35 @@ class TERMBatchSampler(Sampler):
             When :code:`batch_size=None, max_term_res=None, max_seq_tokens>0`,
             batch by fitting as many datapoints as possible with the total number of
             sequence residues included below `max_seq_tokens`. Exactly one of :code:`max_term_res`
-            and :code:`max_seq_tokens` must be None.
+            and :code:`max_seq_tokens` must be None, unless :code:`bin_pack=True`.
+        max_seq_pairs : int or None, default=None
+            Budget of padded residue pairs (:code:`n_batch * L * L`) per batch when :code:`bin_pack=True`,
+            bounding the dense edge tensors built in :code:`aggregate_edges`.
+        bin_pack : bool, default=False
+            When :code:`batch_size=None`, pack batches with :code:`_bin_pack` so that every set budget
+            among :code:`max_term_res`, :code:`max_seq_tokens` and :code:`max_seq_pairs` is respected at once.
+            Unlike the default greedy batching, any number of the budgets may be set.
+        featurize : list of str or None, default=None
+            Optional featurizers from :code:`FEATURIZERS` to run while packaging batches,
+            usually built from the model hparams via :code:`featurization_plan`.
+            If :code:`None`, no optional featurizers are run.
         """
         super().__init__(dataset)
         self.size = len(dataset)
-        self.dataset, self.total_term_lengths, self.seq_lengths = zip(*dataset)
-        assert not (max_term_res is None
-                    and max_seq_tokens is None), "Exactly one of max_term_res and max_seq_tokens must be None"
-        if max_term_res is None and max_seq_tokens > 0:
+        if isinstance(dataset, TERMDataset):
+            # read lengths from the compact index rather than materializing every datapoint
+            self.dataset = dataset
+            self.total_term_lengths, self.seq_lengths = dataset.total_term_lengths, dataset.seq_lengths
+        else:
+            self.dataset, self.total_term_lengths, self.seq_lengths = zip(*dataset)
+        if bin_pack:
+            assert max_term_res or max_seq_tokens or max_seq_pairs, "bin_pack requires at least one token budget"
+            # order datapoints by how much of the tightest budget they use
+            self.lengths = _batch_cost(self.total_term_lengths, self.seq_lengths, max_term_res, max_seq_tokens,
+                                       max_seq_pairs)
+        elif max_term_res is None and max_seq_tokens is None:
+            raise ValueError("Exactly one of max_term_res and max_seq_tokens must be None")
+        elif max_term_res is None and max_seq_tokens > 0:
             self.lengths = self.seq_lengths
         elif max_term_res > 0 and max_seq_tokens is None:
             self.lengths = self.total_term_lengths
@@ -884,8 +1517,13 @@ class TERMBatchSampler(Sampler):
         self.drop_last = drop_last
         self.max_term_res = max_term_res
         self.max_seq_tokens = max_seq_tokens
+        self.max_seq_pairs = max_seq_pairs
+        self.bin_pack = bin_pack
+        self.padding_efficiency = None
+        self.rng = None
         self.semi_shuffle = semi_shuffle
         self.semi_shuffle_cluster_size = semi_shuffle_cluster_size
+        self.featurize = _check_featurization_plan(featurize)
 
         assert not (shuffle and semi_shuffle), "Lazy Dataloader shuffle and semi shuffle cannot both be set"
 
@@ -901,9 +1539,12 @@ class TERMBatchSampler(Sampler):
         into clusters based on length and shuffled within the clusters. Otherwise,
         it is randomly shuffled. Data is then loaded into batches based on the number
         of proteins that will fit into the GPU without overloading it, based on
-        :code:`max_term_res` or :code:`max_seq_tokens`.
+        :code:`max_term_res` or :code:`max_seq_tokens`. If :code:`bin_pack` is set, batches are
+        instead packed by :code:`_bin_pack` against all set budgets, and the padding efficiency is reported.
         """
 
+        rng = np.random if self.rng is None else self.rng
+
         # if we sort data, use sorted indexes instead
         if self.sort_data:
             idx_list = np.argsort(self.lengths)
@@ -925,20 +1566,30 @@ class TERMBatchSampler(Sampler):
                 start = shuffle_borders[cluster_idx]
                 if cluster_idx < last_cluster_idx:
                     end = shuffle_borders[cluster_idx + 1]
-                    np.random.shuffle(idx_list[start:end])
+                    rng.shuffle(idx_list[start:end])
                 else:
-                    np.random.shuffle(idx_list[start:])
+                    rng.shuffle(idx_list[start:])
 
         else:
             idx_list = list(range(len(self.dataset)))
-            np.random.shuffle(idx_list)
+            rng.shuffle(idx_list)
 
         # Cluster into batches of similar sizes
         clusters, batch = [], []
 
         # if batch_size is None, fit as many proteins we can into a batch
         # without overloading the GPU
-        if self.batch_size is None:
+        if self.batch_size is None and self.bin_pack:
+            clusters = _bin_pack(idx_list,
+                                 self.total_term_lengths,
+                                 self.seq_lengths,
+                                 max_term_res=self.max_term_res,
+                                 max_seq_tokens=self.max_seq_tokens,
+                                 max_seq_pairs=self.max_seq_pairs,
+                                 bucket_size=self.semi_shuffle_cluster_size)
+            batch = clusters.pop() if clusters else []
+
+        elif self.batch_size is None:
             if self.max_term_res is None and self.max_seq_tokens > 0:
                 cap_len = self.max_seq_tokens
             elif self.max_term_res > 0 and self.max_seq_tokens is None:
@@ -968,6 +1619,12 @@ class TERMBatchSampler(Sampler):
             clusters.append(batch)
         self.clusters = clusters
 
+        if self.batch_size is None and self.bin_pack:
+            self.padding_efficiency = (_padding_efficiency(clusters, self.total_term_lengths),
+                                       _padding_efficiency(clusters, self.seq_lengths))
+            print(f"Packed {len(clusters)} batches, padding efficiency "
+                  f"{self.padding_efficiency[0]:.2f} (TERM residues), {self.padding_efficiency[1]:.2f} (sequence)")
+
     def package(self, b_idx):
         """Package the given datapoints into tensors based on provided indices.
 
@@ -1009,7 +1666,7 @@ class TERMBatchSampler(Sampler):
 
             - :code:`chain_idx` - the chain IDs
         """
-        return _package([b[0:2] for b in b_idx])
+        return _package([b[0:2] for b in b_idx], featurize=self.featurize)
 
     def __len__(self):
         """Returns length of dataset, i.e. number of batches.
@@ -1025,7 +1682,7 @@ class TERMBatchSampler(Sampler):
         """Allows iteration over dataset."""
         if self.shuffle or self.semi_shuffle:
             self._cluster()
-            np.random.shuffle(self.clusters)
+            (np.random if self.rng is None else self.rng).shuffle(self.clusters)
         for batch in self.clusters:
             yield batch
 
@@ -1082,7 +1739,9 @@ class TERMLazyDataset(Dataset):
         Reads in all feature files from the given directory, using multiprocessing
         with the provided number of processes. Stores the feature filenames, the TERM length,
         and the sequence length as a tuple representing the data. Can read from PDB ids or
-        file paths directly. Uses the given protein length as a cutoff.
+        file paths directly. Uses the given protein length as a cutoff. If the directory
+        has a manifest (see :code:`terminator/data/manifest.py`), the lengths are read from it
+        instead of from each :code:`.length` file.
 
         Args
         ----
@@ -1096,6 +1755,22 @@ class TERMLazyDataset(Dataset):
             number of processes to use during dataloading
         """
         self.dataset = []
+        self.in_folder = in_folder
+        self.pdb_ids = pdb_ids
+        self.min_protein_len = min_protein_len
+
+        # the dataset manifest, if present, holds all the lengths we need
+        self._manifest_mtime = manifest_mtime(in_folder)
+        entries = read_manifest(in_folder,
+                                pdb_ids=pdb_ids,
+                                min_protein_len=min_protein_len,
+                                num_processes=num_processes)
+        if entries is not None:
+            for pdb_id, total_term_length, seq_len in entries:
+                filename = features_path(in_folder, pdb_id)
+                self.dataset.append((os.path.abspath(filename), total_term_length, seq_len))
+            self.shuffle_idx = np.arange(len(self.dataset))
+            return
 
         with mp.Pool(num_processes) as pool:
 
@@ -1151,6 +1826,65 @@ class TERMLazyDataset(Dataset):
 
         self.shuffle_idx = np.arange(len(self.dataset))
 
+    def load(self, filepath, num_matches=None):
+        """Load the feature dictionary for a datapoint.
+
+        Args
+        ----
+        filepath : str
+            Path to the feature file, as stored in :code:`self.dataset`
+        num_matches : int or None, default=None
+            Only keep the top :code:`num_matches` TERM matches. If :code:`None`, keep all matches.
+
+        Returns
+        -------
+        dict
+            Feature dictionary
+        """
+        with open(filepath, 'rb') as fp:
+            return _truncate_matches(pickle.load(fp), num_matches)
+
+    def num_matches(self, filepath):
+        """Number of TERM matches stored for a datapoint.
+
+        Feature files must be unpickled to know this, so this always returns :code:`None`.
+        """
+        del filepath
+        return None
+
+    def refresh(self, pdb_ids=None):
+        """Pick up proteins added to or removed from the dataset manifest since the dataset was loaded.
+
+        Proteins are registered with :code:`terminator.data.manifest.register_proteins`, e.g. by
+        :code:`generateDataset.py --subset`. Only the manifest is read, not the feature files.
+        Datasets without a manifest are left unchanged.
+
+        Args
+        ----
+        pdb_ids : list of str or None, default=None
+            New list of PDB ids to include, e.g. a re-read split file. If :code:`None`, keep the current list.
+
+        Returns
+        -------
+        bool
+            Whether the dataset was reloaded
+        """
+        mtime = manifest_mtime(self.in_folder)
+        if mtime is None or (mtime == self._manifest_mtime and (pdb_ids is None or pdb_ids == self.pdb_ids)):
+            return False
+        if pdb_ids is not None:
+            self.pdb_ids = pdb_ids
+        self._manifest_mtime = mtime
+        manifest = DatasetManifest.load(self.in_folder)
+        # listed proteins that are not registered yet are picked up by a later refresh
+        idx, _ = manifest.select(self.pdb_ids, min_protein_len=self.min_protein_len)
+        self.dataset = [(os.path.abspath(features_path(self.in_folder, pdb_id)), total_term_length, seq_len)
+                        for pdb_id, total_term_length, seq_len in zip(manifest.pdb_ids[idx].tolist(),
+                                                                       manifest.total_term_lengths[idx].tolist(),
+                                                                       manifest.seq_lens[idx].tolist())]
+        self.shuffle_idx = np.arange(len(self.dataset))
+        return True
+
     def shuffle(self):
         """Shuffle the dataset"""
         np.random.shuffle(self.shuffle_idx)
@@ -1190,9 +1924,12 @@ class TERMLazyDataset(Dataset):
 class TERMLazyBatchSampler(Sampler):
     """BatchSampler/Dataloader helper class for TERM data using TERMLazyDataset.
 
+    Any dataset exposing a :code:`load(key)` method for the keys it stores,
+    such as :code:`terminator.data.shards.TERMShardDataset`, can be batched as well.
+
     Attributes
     ----------
-    dataset : TERMLazyDataset
+    dataset : TERMLazyDataset or TERMShardDataset
         Dataset to batch.
     size : int
         Length of dataset
@@ -1226,6 +1963,16 @@ class TERMLazyBatchSampler(Sampler):
         When :code:`batch_size=None, max_term_res=None, max_seq_tokens>0`,
         batch by fitting as many datapoints as possible with the total number of
         sequence residues included below `max_seq_tokens`.
+    max_seq_pairs : int or None, default=None
+        Budget of padded residue pairs (:code:`n_batch * L * L`) per batch when :code:`bin_pack=True`,
+        bounding the dense edge tensors built in :code:`aggregate_edges`.
+    bin_pack : bool, default=False
+        When :code:`batch_size=None`, pack batches with :code:`_bin_pack` so that every set budget
+        among :code:`max_term_res`, :code:`max_seq_tokens` and :code:`max_seq_pairs` is respected at once.
+    padding_efficiency : tuple of float or None
+        Fraction of real TERM residues and sequence tokens among the padded ones, over the last packing
+    rng : np.random.RandomState or None, default=None
+        Random state used to shuffle and cluster the data. If :code:`None`, use the global numpy random state.
     term_matches_cutoff : int or None, default=None
         Use the top :code:`term_matches_cutoff` TERM matches for featurization.
         If :code:`None`, apply no cutoff.
@@ -1235,6 +1982,11 @@ class TERMLazyBatchSampler(Sampler):
         of the given TERM matches to keep. If :code:`term_dropout='keep_first'`,
         keep the first match and choose `n-1` from the rest.
         If :code:`term_dropout='all'`, choose `n` matches from all matches.
+        The number of matches kept is sampled before loading, so only those matches are read.
+    featurize : tuple of str
+        Optional featurizers from :code:`FEATURIZERS` run while packaging batches.
+    io_threads : int, default=8
+        Number of threads used to load the datapoints of a batch concurrently.
     """
     def __init__(self,
                  dataset,
@@ -1247,8 +1999,12 @@ class TERMLazyBatchSampler(Sampler):
                  drop_last=False,
                  max_term_res=55000,
                  max_seq_tokens=None,
+                 max_seq_pairs=None,
+                 bin_pack=False,
                  term_matches_cutoff=None,
-                 term_dropout=None):
+                 term_dropout=None,
+                 featurize=None,
+                 io_threads=8):
         """
         Reads in and processes a given dataset.
 
@@ -1257,7 +2013,7 @@ class TERMLazyBatchSampler(Sampler):
 
         Args
         ----
-        dataset : TERMLazyDataset
+        dataset : TERMLazyDataset or TERMShardDataset
             Dataset to batch.
         batch_size : int or None, default=4
             Size of batches created. If variable sized batches are desired, set to None.
@@ -1289,6 +2045,13 @@ class TERMLazyBatchSampler(Sampler):
             When :code:`batch_size=None, max_term_res=None, max_seq_tokens>0`,
             batch by fitting as many datapoints as possible with the total number of
             sequence residues included below `max_seq_tokens`.
+        max_seq_pairs : int or None, default=None
+            Budget of padded residue pairs (:code:`n_batch * L * L`) per batch when :code:`bin_pack=True`,
+            bounding the dense edge tensors built in :code:`aggregate_edges`.
+        bin_pack : bool, default=False
+            When :code:`batch_size=None`, pack batches with :code:`_bin_pack` so that every set budget
+            among :code:`max_term_res`, :code:`max_seq_tokens` and :code:`max_seq_pairs` is respected at once.
+            Unlike the default greedy batching, any number of the budgets may be set.
         term_matches_cutoff : int or None, default=None
             Use the top :code:`term_matches_cutoff` TERM matches for featurization.
             If :code:`None`, apply no cutoff.
@@ -1298,19 +2061,19 @@ class TERMLazyBatchSampler(Sampler):
             of the given TERM matches to keep. If :code:`term_dropout='keep_first'`,
             keep the first match and choose `n-1` from the rest.
             If :code:`term_dropout='all'`, choose `n` matches from all matches.
+        featurize : list of str or None, default=None
+            Optional featurizers from :code:`FEATURIZERS` to run while packaging batches,
+            usually built from the model hparams via :code:`featurization_plan`.
+            If :code:`None`, no optional featurizers are run.
+        io_threads : int, default=8
+            Number of threads used to load the datapoints of a batch concurrently.
+            Set to 1 to load datapoints one after another.
         """
         super().__init__(dataset)
         self.dataset = dataset
-        self.size = len(dataset)
-        self.filepaths, self.total_term_lengths, self.seq_lengths = zip(*dataset)
-        assert not (max_term_res is None
-                    and max_seq_tokens is None), "Exactly one of max_term_res and max_seq_tokens must be None"
-        if max_term_res is None and max_seq_tokens > 0:
-            self.lengths = self.seq_lengths
-        elif max_term_res > 0 and max_seq_tokens is None:
-            self.lengths = self.total_term_lengths
-        else:
-            raise Exception("Exactly one of max_term_res and max_seq_tokens must be None")
+        self.io_threads = io_threads
+        self._io_pool = None
+        self._io_pool_pid = None
         self.shuffle = shuffle
         self.sort_data = sort_data
         self.batch_shuffle = batch_shuffle
@@ -1318,17 +2081,78 @@ class TERMLazyBatchSampler(Sampler):
         self.drop_last = drop_last
         self.max_term_res = max_term_res
         self.max_seq_tokens = max_seq_tokens
+        self.max_seq_pairs = max_seq_pairs
+        self.bin_pack = bin_pack
+        self.padding_efficiency = None
+        self.rng = None
         self.semi_shuffle = semi_shuffle
         self.semi_shuffle_cluster_size = semi_shuffle_cluster_size
         self.term_matches_cutoff = term_matches_cutoff
         assert term_dropout in ["keep_first", "all", None], f"term_dropout={term_dropout} is not a valid argument"
         self.term_dropout = term_dropout
+        self.featurize = _check_featurization_plan(featurize)
 
         assert not (shuffle and semi_shuffle), "Lazy Dataloader shuffle and semi shuffle cannot both be set"
 
         # initialize clusters
+        self._index()
         self._cluster()
 
+    def _index(self):
+        """ Read the keys and lengths of the datapoints from the dataset, and the length used for batching."""
+        self.size = len(self.dataset)
+        self.filepaths, self.total_term_lengths, self.seq_lengths = zip(*self.dataset)
+        if self.bin_pack:
+            assert self.max_term_res or self.max_seq_tokens or self.max_seq_pairs, \
+                "bin_pack requires at least one token budget"
+            # order datapoints by how much of the tightest budget they use
+            self.lengths = _batch_cost(self.total_term_lengths, self.seq_lengths, self.max_term_res,
+                                       self.max_seq_tokens, self.max_seq_pairs)
+        elif self.max_term_res is None and self.max_seq_tokens is None:
+            raise ValueError("Exactly one of max_term_res and max_seq_tokens must be None")
+        elif self.max_term_res is None and self.max_seq_tokens > 0:
+            self.lengths = self.seq_lengths
+        elif self.max_term_res > 0 and self.max_seq_tokens is None:
+            self.lengths = self.total_term_lengths
+        else:
+            raise Exception("Exactly one of max_term_res and max_seq_tokens must be None")
+
+    def refresh(self):
+        """ Re-index the dataset after it changed, e.g. with :code:`TERMLazyDataset.refresh`, and rebuild the batches."""
+        self._index()
+        self._cluster()
+
+    def __getstate__(self):
+        # thread pools cannot be sent to DataLoader workers, which start their own
+        state = self.__dict__.copy()
+        state['_io_pool'] = None
+        state['_io_pool_pid'] = None
+        return state
+
+    def _load(self, keys, num_matches=None):
+        """ Load the datapoints of a batch, reading them concurrently from a pool of I/O threads.
+
+        The pool is created on first use in each process, so that every DataLoader worker has its own.
+
+        Args
+        ----
+        keys : list
+            Dataset keys of the datapoints (e.g. filepaths)
+        num_matches : int or None, default=None
+            Only load the top :code:`num_matches` TERM matches. If :code:`None`, load all matches.
+
+        Returns
+        -------
+        list of dict
+            Feature dictionaries, in the order of :code:`keys`
+        """
+        if self.io_threads <= 1 or len(keys) <= 1:
+            return [self.dataset.load(key, num_matches=num_matches) for key in keys]
+        if self._io_pool is None or self._io_pool_pid != os.getpid():
+            self._io_pool = ThreadPoolExecutor(max_workers=self.io_threads)
+            self._io_pool_pid = os.getpid()
+        return list(self._io_pool.map(lambda key: self.dataset.load(key, num_matches=num_matches), keys))
+
     def _cluster(self):
         """ Shuffle data and make clusters of indices corresponding to batches of data.
 
@@ -1338,9 +2162,12 @@ class TERMLazyBatchSampler(Sampler):
         into clusters based on length and shuffled within the clusters. Otherwise,
         it is randomly shuffled. Data is then loaded into batches based on the number
         of proteins that will fit into the GPU without overloading it, based on
-        :code:`max_term_res` or :code:`max_seq_tokens`.
+        :code:`max_term_res` or :code:`max_seq_tokens`. If :code:`bin_pack` is set, batches are
+        instead packed by :code:`_bin_pack` against all set budgets, and the padding efficiency is reported.
         """
 
+        rng = np.random if self.rng is None else self.rng
+
         # if we sort data, use sorted indexes instead
         if self.sort_data:
             idx_list = np.argsort(self.lengths)
@@ -1362,20 +2189,30 @@ class TERMLazyBatchSampler(Sampler):
                 start = shuffle_borders[cluster_idx]
                 if cluster_idx < last_cluster_idx:
                     end = shuffle_borders[cluster_idx + 1]
-                    np.random.shuffle(idx_list[start:end])
+                    rng.shuffle(idx_list[start:end])
                 else:
-                    np.random.shuffle(idx_list[start:])
+                    rng.shuffle(idx_list[start:])
 
         else:
             idx_list = list(range(len(self.dataset)))
-            np.random.shuffle(idx_list)
+            rng.shuffle(idx_list)
 
         # Cluster into batches of similar sizes
         clusters, batch = [], []
 
         # if batch_size is None, fit as many proteins we can into a batch
         # without overloading the GPU
-        if self.batch_size is None:
+        if self.batch_size is None and self.bin_pack:
+            clusters = _bin_pack(idx_list,
+                                 self.total_term_lengths,
+                                 self.seq_lengths,
+                                 max_term_res=self.max_term_res,
+                                 max_seq_tokens=self.max_seq_tokens,
+                                 max_seq_pairs=self.max_seq_pairs,
+                                 bucket_size=self.semi_shuffle_cluster_size)
+            batch = clusters.pop() if clusters else []
+
+        elif self.batch_size is None:
             if self.max_term_res is None and self.max_seq_tokens > 0:
                 cap_len = self.max_seq_tokens
             elif self.max_term_res > 0 and self.max_seq_tokens is None:
@@ -1405,17 +2242,24 @@ class TERMLazyBatchSampler(Sampler):
             clusters.append(batch)
         self.clusters = clusters
 
+        if self.batch_size is None and self.bin_pack:
+            self.padding_efficiency = (_padding_efficiency(clusters, self.total_term_lengths),
+                                       _padding_efficiency(clusters, self.seq_lengths))
+            print(f"Packed {len(clusters)} batches, padding efficiency "
+                  f"{self.padding_efficiency[0]:.2f} (TERM residues), {self.padding_efficiency[1]:.2f} (sequence)")
+
     def package(self, b_idx):
         """Package the given datapoints into tensors based on provided indices.
 
         Tensors are extracted from the data and padded. Coordinates are featurized
-        and the length of TERMs and chain IDs are added to the data.
+        and the length of TERMs and chain IDs are added to the data. Only the TERM matches
+        kept by :code:`term_matches_cutoff` and :code:`term_dropout` are loaded from the dataset.
 
         Args
         ----
         b_idx : list of (str, int, int)
-            The path to the feature files, the sum of the lengths of all TERMs, and the sum of all sequence lengths
-            for each datapoint to package.
+            The dataset key (e.g. path to the feature file), the sum of the lengths of all TERMs,
+            and the sum of all sequence lengths for each datapoint to package.
 
         Returns
         -------
@@ -1451,58 +2295,35 @@ class TERMLazyBatchSampler(Sampler):
             random.shuffle(b_idx_copy)
             b_idx = b_idx_copy
 
-        # load the files specified by filepaths
-        batch = []
-        for data in b_idx:
-            filepath = data[0]
-            with open(filepath, 'rb') as fp:
-                batch.append((pickle.load(fp), data[1]))
-                if 'ppoe' not in batch[-1][0].keys():
-                    print(filepath)
+        # decide how many TERM matches to read before loading anything
+        num_matches = self.term_matches_cutoff
+        batch = None
+        if self.term_dropout:
+            counts = [self.dataset.num_matches(data[0]) for data in b_idx]
+            if None in counts:
+                # match counts are only known once the datapoints are loaded
+                batch = list(zip(self._load([data[0] for data in b_idx], num_matches), [data[1] for data in b_idx]))
+                counts = [len(features['msas']) for features, _ in batch]
+            n_align = max(counts)
+            if self.term_matches_cutoff:
+                n_align = min(n_align, self.term_matches_cutoff)
+            n_keep, num_matches = _sample_term_dropout(self.term_dropout, n_align)
+
+        # load the datapoints specified by the dataset keys (e.g. filepaths)
+        if batch is None:
+            batch = list(zip(self._load([data[0] for data in b_idx], num_matches), [data[1] for data in b_idx]))
+        else:
+            batch = [(_truncate_matches(features, num_matches), term_len) for features, term_len in batch]
+        for (features, _), data in zip(batch, b_idx):
+            if 'ppoe' not in features.keys():
+                print(data[0])
 
         # package batch
-        packaged_batch = _package(batch)
-
-        features = packaged_batch["features"]
-        msas = packaged_batch["msas"]
-        # apply TERM matches cutoff
-        if self.term_matches_cutoff:
-            features = features[:, :self.term_matches_cutoff]
-            msas = msas[:, :self.term_matches_cutoff]
+        packaged_batch = _package(batch, featurize=self.featurize)
+
         # apply TERM matches dropout
         if self.term_dropout:
-            # sample a random number of alignments to keep
-            n_batch, n_align, n_terms, n_features = features.shape
-            if self.term_dropout == 'keep_first':
-                n_keep = torch.randint(0, n_align, [1]).item()
-            elif self.term_dropout == 'all':
-                n_keep = torch.randint(1, n_align, [1]).item()
-            # sample from a multinomial distribution
-            weights = torch.ones([1, 1]).expand([n_batch * n_terms, n_keep])
-            if n_keep == 0:
-                sample_idx = torch.ones(1)
-            else:
-                sample_idx = torch.multinomial(weights, n_keep)
-                sample_idx = sample_idx.view([n_batch, n_terms, n_keep]).transpose(-1, -2)
-                sample_idx_features = sample_idx.unsqueeze(-1).expand([n_batch, n_keep, n_terms, n_features])
-                sample_idx_msas = sample_idx
-
-            if self.term_dropout == 'keep_first':
-                if n_keep == 0:
-                    features = features[:, 0:1]
-                    msas = msas[:, 0:1]
-                else:
-                    sample_features = torch.gather(features[:, 1:], 1, sample_idx_features)
-                    sample_msas = torch.gather(msas[:, 1:], 1, sample_idx_msas)
-                    features = torch.cat([features[:, 0:1], sample_features], dim=1)
-                    msas = torch.cat([msas[:, 0:1], sample_msas], dim=1)
-            elif self.term_dropout == 'all':
-                features = torch.gather(features, 1, sample_idx_features)
-                msas = torch.gather(msas, 1, sample_idx_msas)
-
-        packaged_batch["features"] = features
-        packaged_batch["msas"] = msas
-
+            _apply_term_dropout(packaged_batch, self.term_dropout, n_keep)
         return packaged_batch
 
     def __len__(self):
@@ -1519,6 +2340,123 @@ class TERMLazyBatchSampler(Sampler):
         """Allows iteration over dataset."""
         if self.shuffle or self.semi_shuffle:
             self._cluster()
-            np.random.shuffle(self.clusters)
+            (np.random if self.rng is None else self.rng).shuffle(self.clusters)
         for batch in self.clusters:
             yield batch
+
+
+class DistributedBatchSampler(Sampler):
+    """Shards the batches of a TERMBatchSampler or TERMLazyBatchSampler across distributed ranks.
+
+    Every rank builds the same batches from a seed shared across ranks and the current epoch,
+    then takes a disjoint subset of them. Batches are grouped into steps of :code:`num_replicas`
+    batches of similar padded size, so that no rank waits on another which drew the longest proteins,
+    and every rank runs the same number of steps.
+
+    Attributes
+    ----------
+    batch_sampler : TERMBatchSampler or TERMLazyBatchSampler
+        Sampler producing the batches to shard
+    num_replicas : int
+        Number of ranks
+    rank : int
+        Rank of the current process
+    seed : int
+        Random seed shared across ranks
+    epoch : int
+        Current epoch, combined with :code:`seed` to seed shuffling
+    drop_last : bool
+        If :code:`True`, drop batches that don't fill a step. Otherwise, repeat batches to fill the last step.
+    """
+    def __init__(self, batch_sampler, num_replicas=None, rank=None, seed=0, drop_last=False):
+        """
+        Args
+        ----
+        batch_sampler : TERMBatchSampler or TERMLazyBatchSampler
+            Sampler producing the batches to shard
+        num_replicas : int or None, default=None
+            Number of ranks. If :code:`None`, use the world size of the default process group.
+        rank : int or None, default=None
+            Rank of the current process. If :code:`None`, use the rank in the default process group.
+        seed : int, default=0
+            Random seed, which must be the same across ranks
+        drop_last : bool, default=False
+            If :code:`True`, drop batches that don't fill a step. Otherwise, repeat batches to fill the last step.
+        """
+        super().__init__(batch_sampler.dataset)
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size()
+        if rank is None:
+            rank = torch.distributed.get_rank()
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank}, rank should be in the interval [0, {num_replicas - 1}]")
+        self.batch_sampler = batch_sampler
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.drop_last = drop_last
+        # steps of the epoch they were built for, as (epoch, steps)
+        self._cached_steps = None
+
+    def set_epoch(self, epoch):
+        """Set the epoch used to seed shuffling, and build its batches.
+
+        Call this at the start of every epoch on every rank.
+        """
+        self.epoch = epoch
+        self._cached_steps = (epoch, self._steps())
+
+    def _epoch_steps(self):
+        """Steps of the current epoch (see :code:`_steps`), built once per epoch"""
+        if self._cached_steps is None or self._cached_steps[0] != self.epoch:
+            self._cached_steps = (self.epoch, self._steps())
+        return self._cached_steps[1]
+
+    def package(self, b_idx):
+        """Package a batch using the wrapped sampler (see :code:`TERMLazyBatchSampler.package`)."""
+        return self.batch_sampler.package(b_idx)
+
+    def _steps(self):
+        """Build this epoch's batches and group them into steps of :code:`num_replicas` batches.
+
+        Returns
+        -------
+        list of list of list of int
+            For every step, one batch per rank
+        """
+        sampler = self.batch_sampler
+        rng = np.random.RandomState(self.seed + self.epoch)
+        sampler.rng = rng
+        if sampler.shuffle or sampler.semi_shuffle:
+            sampler._cluster()  # pylint: disable=protected-access
+        clusters = list(sampler.clusters)
+
+        # group batches of similar padded size into the same step
+        lengths = np.asarray(sampler.lengths)
+        costs = np.array([lengths[batch].max() * len(batch) for batch in clusters])
+        clusters = [clusters[i] for i in np.argsort(costs, kind='stable')]
+        remainder = len(clusters) % self.num_replicas
+        if remainder and self.drop_last:
+            clusters = clusters[:len(clusters) - remainder]
+        elif remainder:
+            # cycle through the batches, as there can be fewer batches than ranks
+            clusters += [clusters[i % len(clusters)] for i in range(self.num_replicas - remainder)]
+        steps = [clusters[i:i + self.num_replicas] for i in range(0, len(clusters), self.num_replicas)]
+
+        if sampler.shuffle or sampler.semi_shuffle:
+            rng.shuffle(steps)
+            # rotate batches across ranks so no rank always gets the largest batch of a step
+            steps = [step[offset:] + step[:offset] for step, offset in
+                     zip(steps, rng.randint(self.num_replicas, size=len(steps)).tolist())]
+        return steps
+
+    def __len__(self):
+        """Number of steps in the current epoch, which is the same on every rank."""
+        return len(self._epoch_steps())
+
+    def __iter__(self):
+        """Iterate over this rank's batches."""
+        for step in self._epoch_steps():
+            yield step[self.rank]
+
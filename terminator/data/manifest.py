@@ -0,0 +1,436 @@
+"""Dataset manifests for fast dataset startup.
+
+A manifest is a single tab-separated file :code:`<dataset_dir>/manifest.tsv` holding, for every
+:code:`<pdb_id>/<pdb_id>.features` file in a dataset folder, the PDB id, the total TERM length,
+the sequence length, the chain lengths, and a content hash of the feature file
+(plus the file size and modification time, used as a cheap staleness check).
+
+Datasets read the manifest instead of opening one :code:`.length` or :code:`.features` file per protein,
+and filtering by split lists or :code:`min_protein_len` is a vectorized operation over the manifest columns.
+The manifest is written by :code:`scripts/data/preprocessing/generateDataset.py`.
+
+Proteins can be added to or removed from a dataset incrementally with :code:`register_proteins` and
+:code:`unregister_proteins`, which only read the affected feature files. Lazy datasets pick up such changes
+with :code:`refresh` (see :code:`terminator.data.data.TERMLazyDataset.refresh`).
+"""
+import contextlib
+import fcntl
+import glob
+import hashlib
+import multiprocessing as mp
+import os
+import pickle
+
+import numpy as np
+from tqdm import tqdm
+
+MANIFEST_FILE = "manifest.tsv"
+LOCK_FILE = ".manifest.lock"
+MANIFEST_COLUMNS = ["pdb_id", "total_term_length", "seq_len", "chain_lens", "size", "mtime_ns", "sha1"]
+
+
+def features_path(in_folder, pdb_id):
+    """Path to the feature file of :code:`pdb_id` in dataset folder :code:`in_folder`"""
+    return os.path.join(in_folder, pdb_id, f"{pdb_id}.features")
+
+
+@contextlib.contextmanager
+def _manifest_lock(in_folder):
+    """Hold an exclusive lock on the manifest of :code:`in_folder`, so concurrent updates don't overwrite each other"""
+    with open(os.path.join(in_folder, LOCK_FILE), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def manifest_mtime(in_folder):
+    """Modification time (ns) of the manifest of :code:`in_folder`, or :code:`None` if it has no manifest"""
+    try:
+        return os.stat(os.path.join(in_folder, MANIFEST_FILE)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _hash_file(path, chunk_size=1 << 20):
+    """Compute the SHA-1 hex digest of a file"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def manifest_entry(in_folder, pdb_id):
+    """Compute the manifest entry for one protein by reading its feature file.
+
+    Args
+    ----
+    in_folder : str
+        Dataset folder
+    pdb_id : str
+        PDB id of the protein
+
+    Returns
+    -------
+    tuple
+        Values for each column in :code:`MANIFEST_COLUMNS`
+    """
+    path = features_path(in_folder, pdb_id)
+    stat = os.stat(path)
+    with open(path, 'rb') as fp:
+        data = pickle.load(fp)
+    return (pdb_id, int(np.sum(data['term_lens'])), int(data['seq_len']), tuple(int(c) for c in data['chain_lens']),
+            stat.st_size, stat.st_mtime_ns, _hash_file(path))
+
+
+def _manifest_entries(in_folder, pdb_ids, num_processes=32):
+    """Compute manifest entries for many proteins in parallel"""
+    if not pdb_ids:
+        return []
+    print("Building manifest entries")
+    progress = tqdm(total=len(pdb_ids))
+
+    def update_progress(res):
+        del res
+        progress.update(1)
+
+    with mp.Pool(min(num_processes, len(pdb_ids))) as pool:
+        res_list = [
+            pool.apply_async(manifest_entry, (in_folder, pdb_id), callback=update_progress) for pdb_id in pdb_ids
+        ]
+        pool.close()
+        pool.join()
+    progress.close()
+    return [res.get() for res in res_list]
+
+
+class DatasetManifest:
+    """Columnar view of a dataset manifest.
+
+    Attributes
+    ----------
+    in_folder : str
+        Dataset folder the manifest describes
+    pdb_ids : np.ndarray of str
+        PDB id of each protein
+    total_term_lengths : np.ndarray of int
+        Sum of the lengths of all TERMs of each protein
+    seq_lens : np.ndarray of int
+        Sequence length of each protein
+    chain_lens : list of tuple of int
+        Chain lengths of each protein
+    sizes, mtimes : np.ndarray of int
+        Size and modification time (ns) of each feature file when the manifest was built
+    hashes : np.ndarray of str
+        SHA-1 digest of each feature file
+    """
+    def __init__(self, in_folder, entries):
+        """
+        Args
+        ----
+        in_folder : str
+            Dataset folder the manifest describes
+        entries : list of tuple
+            Manifest rows, with values for each column in :code:`MANIFEST_COLUMNS`
+        """
+        self.in_folder = in_folder
+        self._set_entries(entries)
+
+    def _set_entries(self, entries):
+        """Set the manifest columns from a list of rows"""
+        self.pdb_ids = np.array([e[0] for e in entries], dtype=str)
+        self.total_term_lengths = np.array([e[1] for e in entries], dtype=np.int64)
+        self.seq_lens = np.array([e[2] for e in entries], dtype=np.int64)
+        self.chain_lens = [tuple(e[3]) for e in entries]
+        self.sizes = np.array([e[4] for e in entries], dtype=np.int64)
+        self.mtimes = np.array([e[5] for e in entries], dtype=np.int64)
+        self.hashes = np.array([e[6] for e in entries], dtype=str)
+
+    def __len__(self):
+        return len(self.pdb_ids)
+
+    def entries(self):
+        """Return the manifest rows as a list of tuples"""
+        return list(
+            zip(self.pdb_ids.tolist(), self.total_term_lengths.tolist(), self.seq_lens.tolist(), self.chain_lens,
+                self.sizes.tolist(), self.mtimes.tolist(), self.hashes.tolist()))
+
+    @classmethod
+    def load(cls, in_folder):
+        """Read the manifest of :code:`in_folder`.
+
+        Returns
+        -------
+        DatasetManifest or None
+            The manifest, or :code:`None` if the dataset folder has no manifest
+        """
+        path = os.path.join(in_folder, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return None
+        entries = []
+        with open(path, 'rt') as fp:
+            header = fp.readline().rstrip('\n').split('\t')
+            assert header == MANIFEST_COLUMNS, f"unrecognized manifest header {header} in {path}"
+            for line in fp:
+                pdb_id, total_term_length, seq_len, chain_lens, size, mtime, sha1 = line.rstrip('\n').split('\t')
+                chain_lens = tuple(int(c) for c in chain_lens.split(',') if c)
+                entries.append((pdb_id, int(total_term_length), int(seq_len), chain_lens, int(size), int(mtime), sha1))
+        return cls(in_folder, entries)
+
+    def save(self):
+        """Write the manifest to :code:`<in_folder>/manifest.tsv`, atomically replacing any existing manifest"""
+        path = os.path.join(self.in_folder, MANIFEST_FILE)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wt') as fp:
+            fp.write('\t'.join(MANIFEST_COLUMNS) + '\n')
+            for pdb_id, total_term_length, seq_len, chain_lens, size, mtime, sha1 in self.entries():
+                chain_lens = ','.join(str(c) for c in chain_lens)
+                fp.write(f"{pdb_id}\t{total_term_length}\t{seq_len}\t{chain_lens}\t{size}\t{mtime}\t{sha1}\n")
+        os.replace(tmp_path, path)
+
+    def select(self, pdb_ids=None, min_protein_len=30):
+        """Select the proteins to include in a dataset.
+
+        Args
+        ----
+        pdb_ids : list of str or None, default=None
+            PDB ids to select, in order. If :code:`None`, select every protein in the manifest.
+        min_protein_len : int, default=30
+            Minimum sequence length of a selected protein
+
+        Returns
+        -------
+        np.ndarray of int
+            Indices into the manifest columns of the selected proteins
+        missing : list of str
+            Requested PDB ids which are not in the manifest
+        """
+        if pdb_ids is None:
+            idx = np.arange(len(self))
+            missing = []
+        elif len(self) == 0:
+            idx = np.arange(0)
+            missing = list(pdb_ids)
+        else:
+            requested = np.array(pdb_ids, dtype=str)
+            sorter = np.argsort(self.pdb_ids)
+            pos = np.searchsorted(self.pdb_ids, requested, sorter=sorter)
+            idx = sorter[np.clip(pos, 0, len(self) - 1)]
+            found = self.pdb_ids[idx] == requested
+            missing = requested[~found].tolist()
+            idx = idx[found]
+        return idx[self.seq_lens[idx] >= min_protein_len], missing
+
+    def stale(self, idx, deep=False):
+        """Find the entries whose feature files changed or were deleted since the manifest was built.
+
+        Entries whose file size and modification time still match are considered fresh. If :code:`deep=True`,
+        entries whose stat changed are rehashed, and only count as stale if their content changed.
+
+        Args
+        ----
+        idx : np.ndarray of int
+            Indices of the entries to check
+        deep : bool, default=False
+            Whether to compare content hashes of entries whose stat changed
+
+        Returns
+        -------
+        stale : list of int
+            Indices of the entries whose feature files changed
+        deleted : list of int
+            Indices of the entries whose feature files no longer exist
+        """
+        stale, deleted = [], []
+        for i in idx.tolist():
+            path = features_path(self.in_folder, self.pdb_ids[i])
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                deleted.append(i)
+                continue
+            if stat.st_size == self.sizes[i] and stat.st_mtime_ns == self.mtimes[i]:
+                continue
+            if deep and stat.st_size == self.sizes[i] and _hash_file(path) == self.hashes[i]:
+                # touched but unchanged
+                self.mtimes[i] = stat.st_mtime_ns
+                continue
+            stale.append(i)
+        return stale, deleted
+
+    def update(self, entries):
+        """Add or replace entries in the manifest.
+
+        Args
+        ----
+        entries : list of tuple
+            Manifest rows, with values for each column in :code:`MANIFEST_COLUMNS`
+        """
+        rows = {row[0]: row for row in self.entries()}
+        for entry in entries:
+            rows[entry[0]] = entry
+        self._set_entries(sorted(rows.values()))
+
+    def remove(self, pdb_ids):
+        """Remove entries from the manifest.
+
+        Args
+        ----
+        pdb_ids : list of str
+            PDB ids of the entries to remove. Ids not in the manifest are ignored.
+        """
+        pdb_ids = set(pdb_ids)
+        self._set_entries([row for row in self.entries() if row[0] not in pdb_ids])
+
+
+def build_manifest(in_folder, pdb_ids=None, num_processes=32, update=True):
+    """Build (or update) the manifest of a dataset folder and write it to disk.
+
+    Args
+    ----
+    in_folder : str
+        Dataset folder generated by :code:`scripts/data/preprocessing/generateDataset.py`
+    pdb_ids : list of str or None, default=None
+        Proteins whose entries should be recomputed, e.g. because their feature files were regenerated.
+        Entries are always computed for feature files in :code:`in_folder` not already in the manifest.
+    num_processes : int, default=32
+        Number of processes to use when reading feature files
+    update : bool, default=True
+        Whether to keep entries of an existing manifest. If :code:`False`, the manifest is rebuilt from scratch.
+
+    Returns
+    -------
+    DatasetManifest
+        The written manifest
+    """
+    filelist = glob.glob(os.path.join(in_folder, '*', '*.features'))
+    on_disk = {os.path.basename(path)[:-len(".features")] for path in filelist}
+    with _manifest_lock(in_folder):
+        manifest = DatasetManifest.load(in_folder) if update else None
+        if manifest is None:
+            manifest = DatasetManifest(in_folder, [])
+        refresh = on_disk - set(manifest.pdb_ids.tolist())
+        if pdb_ids is not None:
+            refresh |= on_disk & set(pdb_ids)
+        manifest.update(_manifest_entries(in_folder, sorted(refresh), num_processes=num_processes))
+        # drop entries whose feature files no longer exist
+        if not np.isin(manifest.pdb_ids, list(on_disk)).all():
+            manifest = DatasetManifest(in_folder, [e for e in manifest.entries() if e[0] in on_disk])
+        manifest.save()
+    return manifest
+
+
+def register_proteins(in_folder, pdb_ids, num_processes=32):
+    """Add proteins to the manifest of a dataset folder, or refresh their entries, without scanning the folder.
+
+    Only the feature files of :code:`pdb_ids` are read, so this is cheap when adding a few proteins
+    to a large dataset. The manifest is created if the folder has none.
+
+    Args
+    ----
+    in_folder : str
+        Dataset folder generated by :code:`scripts/data/preprocessing/generateDataset.py`
+    pdb_ids : list of str
+        Proteins whose feature files were written or rewritten
+    num_processes : int, default=32
+        Number of processes to use when reading feature files
+
+    Returns
+    -------
+    DatasetManifest
+        The updated manifest
+    """
+    entries = _manifest_entries(in_folder, sorted(set(pdb_ids)), num_processes=num_processes)
+    with _manifest_lock(in_folder):
+        manifest = DatasetManifest.load(in_folder)
+        if manifest is None:
+            manifest = DatasetManifest(in_folder, [])
+        manifest.update(entries)
+        manifest.save()
+    return manifest
+
+
+def unregister_proteins(in_folder, pdb_ids):
+    """Remove proteins from the manifest of a dataset folder.
+
+    Their feature files are left untouched, so a later full :code:`build_manifest` adds them back
+    unless the files are deleted.
+
+    Args
+    ----
+    in_folder : str
+        Dataset folder with a manifest
+    pdb_ids : list of str
+        Proteins to remove
+
+    Returns
+    -------
+    DatasetManifest
+        The updated manifest
+    """
+    with _manifest_lock(in_folder):
+        manifest = DatasetManifest.load(in_folder)
+        assert manifest is not None, f"{in_folder} has no manifest"
+        manifest.remove(pdb_ids)
+        manifest.save()
+    return manifest
+
+
+def read_manifest(in_folder, pdb_ids=None, min_protein_len=30, num_processes=32, deep=False):
+    """Select proteins from a dataset folder using its manifest, refreshing stale or missing entries.
+
+    Entries whose feature files were deleted are dropped from the manifest.
+
+    Args
+    ----
+    in_folder : str
+        Dataset folder generated by :code:`scripts/data/preprocessing/generateDataset.py`
+    pdb_ids : list of str or None, default=None
+        PDB ids to select, in order. If :code:`None`, select every protein in the manifest.
+    min_protein_len : int, default=30
+        Minimum sequence length of a selected protein
+    num_processes : int, default=32
+        Number of processes to use when refreshing entries
+    deep : bool, default=False
+        Whether to compare content hashes when feature files were touched (see :code:`DatasetManifest.stale`)
+
+    Returns
+    -------
+    list of tuple or None
+        :code:`(pdb_id, total_term_length, seq_len)` for each selected protein,
+        or :code:`None` if the dataset folder has no manifest
+    """
+    manifest = DatasetManifest.load(in_folder)
+    if manifest is None:
+        return None
+
+    idx, missing = manifest.select(pdb_ids, min_protein_len=0)
+    stale, deleted = manifest.stale(idx, deep=deep)
+    if missing or stale or deleted:
+        refresh = missing + manifest.pdb_ids[stale].tolist()
+        removed = manifest.pdb_ids[deleted].tolist()
+        print(f"Manifest of {in_folder} is stale for {len(refresh)} proteins and lists {len(removed)} deleted ones, "
+              "refreshing")
+        entries = _manifest_entries(in_folder, refresh, num_processes=num_processes)
+        manifest.update(entries)
+        manifest.remove(removed)
+        try:
+            # merge into the latest manifest on disk, which may have been updated in the meantime
+            with _manifest_lock(in_folder):
+                latest = DatasetManifest.load(in_folder)
+                latest.update(entries)
+                latest.remove(removed)
+                latest.save()
+        except OSError:
+            print(f"Could not write refreshed manifest to {in_folder}")
+        idx, missing = manifest.select(pdb_ids, min_protein_len=0)
+        assert not missing, f"proteins {missing} not found in {in_folder}"
+
+    # filter on length after refreshing so that stale lengths never decide selection
+    idx = idx[manifest.seq_lens[idx] >= min_protein_len]
+    return list(
+        zip(manifest.pdb_ids[idx].tolist(),
+            manifest.total_term_lengths[idx].tolist(),
+            manifest.seq_lens[idx].tolist()))
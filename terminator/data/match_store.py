@@ -0,0 +1,288 @@
+"""Dataset format storing each unique TERM match once, in a table shared across proteins.
+
+Matches mined from the same database recur across many target proteins, yet every :code:`.features` file
+holds its own copy of each match's sequence and structural features. A match store splits the TERM match
+data of every protein into
+
+- a global match table, holding the sequence and the :math:`\\sin, \\cos` of the :math:`\\phi, \\psi, \\omega`
+  dihedrals and environment value of every unique match once, and
+- per-protein feature files holding, for every TERM match, a reference to its record in the match table
+  plus the RMSD of the match to the target TERM, which is specific to the target.
+
+Matches are deduplicated by content, so identical matches found for different targets share one record.
+The on-disk layout is
+
+.. code-block::
+
+    <store>/matches/seqs.npy          # residue codes of all match records, concatenated
+    <store>/matches/ppoe.npy          # (sin phi/psi/omega, cos phi/psi/omega, env) of all match records
+    <store>/matches/offsets.npy       # first row of each match record in seqs.npy and ppoe.npy
+    <store>/matches/lengths.npy       # number of residues of each match record
+    <store>/<pdb>/<pdb>.features      # feature dictionary, with match references instead of features and msas
+    <store>/<pdb>/<pdb>.length        # as written by generateDataset.py
+
+Per-protein feature files replace :code:`features` and :code:`msas` with :code:`match_ids`
+(:code:`n_matches x n_terms`), :code:`rmsds` (:code:`n_matches x n_terms`) and :code:`term_len_features`
+(:code:`n_terms`), which are resolved against the match table when loaded.
+"""
+import glob
+import hashlib
+import os
+import pickle
+import shutil
+
+import numpy as np
+from tqdm import tqdm
+
+from terminator.data.data import TERMLazyDataset
+from terminator.data.manifest import build_manifest, features_path
+
+MATCH_DIR = "matches"
+# columns of the :code:`features` array stored per match residue in the match table.
+# the remaining two columns, RMSD and TERM length, are stored per TERM match and per TERM
+MATCH_FEATURES = 7
+RMSD_COL, TERM_LEN_COL = 7, 8
+
+
+def _term_index(term_lens):
+    """For each TERM residue, the index of its TERM and its position within the TERM"""
+    term_lens = np.asarray(term_lens, dtype=np.int64)
+    term_of_res = np.repeat(np.arange(len(term_lens)), term_lens)
+    starts = np.cumsum(term_lens) - term_lens
+    return term_of_res, np.arange(term_lens.sum()) - starts[term_of_res]
+
+
+class MatchTableWriter:
+    """Accumulates unique match records while a match store is being written.
+
+    Attributes
+    ----------
+    num_matches : int
+        Number of TERM matches added so far
+    num_unique : int
+        Number of unique match records
+    """
+    def __init__(self):
+        self._ids = {}
+        self._seqs = []
+        self._ppoe = []
+        self._lengths = []
+        self.num_matches = 0
+
+    @property
+    def num_unique(self):
+        return len(self._lengths)
+
+    def add(self, seq, ppoe):
+        """Add one TERM match, returning the id of its match record.
+
+        Args
+        ----
+        seq : np.ndarray
+            Residue codes of the match
+        ppoe : np.ndarray
+            Per-residue :code:`(sin phi/psi/omega, cos phi/psi/omega, env)` features of the match
+
+        Returns
+        -------
+        int
+            Id of the match record
+        """
+        seq = np.ascontiguousarray(seq, dtype=np.uint8)
+        ppoe = np.ascontiguousarray(ppoe, dtype=np.float32)
+        key = hashlib.sha1(seq.tobytes() + ppoe.tobytes()).digest()
+        self.num_matches += 1
+        if key not in self._ids:
+            self._ids[key] = len(self._lengths)
+            self._seqs.append(seq)
+            self._ppoe.append(ppoe)
+            self._lengths.append(len(seq))
+        return self._ids[key]
+
+    def encode(self, data):
+        """Replace the TERM match data of a feature dictionary by references into the match table.
+
+        Args
+        ----
+        data : dict
+            Feature dictionary, as outputted by :code:`scripts/data/preprocessing/packageTensors.py`
+
+        Returns
+        -------
+        dict
+            Feature dictionary with :code:`match_ids`, :code:`rmsds` and :code:`term_len_features`
+            instead of :code:`features` and :code:`msas`
+        """
+        features, msas = data['features'], data['msas']
+        term_lens = np.asarray(data['term_lens'], dtype=np.int64)
+        starts = np.cumsum(term_lens) - term_lens
+        n_matches = msas.shape[0]
+        match_ids = np.zeros((n_matches, len(term_lens)), dtype=np.int64)
+        rmsds = np.zeros((n_matches, len(term_lens)), dtype=np.float32)
+        for term, (start, term_len) in enumerate(zip(starts, term_lens)):
+            term_features = features[:, start:start + term_len]
+            # RMSD and TERM length are stored per TERM match, so they must not vary along the TERM
+            if not (term_features[:, :, RMSD_COL:] == term_features[:, :1, RMSD_COL:]).all():
+                raise ValueError(f"{data['pdb']}: RMSD or TERM length features vary within TERM {term}")
+            rmsds[:, term] = term_features[:, 0, RMSD_COL]
+            for match in range(n_matches):
+                match_ids[match, term] = self.add(msas[match, start:start + term_len],
+                                                  term_features[match, :, :MATCH_FEATURES])
+
+        encoded = {field: value for field, value in data.items() if field not in ['features', 'msas']}
+        encoded['match_ids'] = match_ids
+        encoded['rmsds'] = rmsds
+        encoded['term_len_features'] = features[0, starts, TERM_LEN_COL].astype(np.float32)
+        return encoded
+
+    def save(self, out_folder):
+        """Write the match table into :code:`<out_folder>/matches`"""
+        match_dir = os.path.join(out_folder, MATCH_DIR)
+        if not os.path.isdir(match_dir):
+            os.makedirs(match_dir)
+        lengths = np.array(self._lengths, dtype=np.int64)
+        np.save(os.path.join(match_dir, "seqs.npy"),
+                np.concatenate(self._seqs) if self._seqs else np.zeros(0, np.uint8))
+        np.save(os.path.join(match_dir, "ppoe.npy"),
+                np.concatenate(self._ppoe) if self._ppoe else np.zeros((0, MATCH_FEATURES), np.float32))
+        np.save(os.path.join(match_dir, "offsets.npy"), np.cumsum(lengths) - lengths)
+        np.save(os.path.join(match_dir, "lengths.npy"), lengths)
+
+
+def write_match_store(in_folder, out_folder, pdb_ids=None, num_processes=32):
+    """Convert a dataset folder of :code:`.features` files into a match store.
+
+    Args
+    ----
+    in_folder : str
+        Path to directory containing feature files generated by :code:`scripts/data/preprocessing/generateDataset.py`
+    out_folder : str
+        Path to the match store to create
+    pdb_ids : list of str or None, default=None
+        PDB ids from :code:`in_folder` to include. If :code:`None`, include every protein in :code:`in_folder`.
+    num_processes : int, default=32
+        Number of processes to use when building the manifest of the store
+
+    Returns
+    -------
+    MatchTableWriter
+        The written match table, e.g. to report how many matches were deduplicated
+    """
+    if pdb_ids is None:
+        filelist = sorted(glob.glob(os.path.join(in_folder, '*/*.features')))
+        pdb_ids = [os.path.basename(path)[:-len(".features")] for path in filelist]
+
+    table = MatchTableWriter()
+    for pdb_id in tqdm(pdb_ids):
+        with open(features_path(in_folder, pdb_id), 'rb') as fp:
+            data = pickle.load(fp)
+        protein_dir = os.path.join(out_folder, pdb_id)
+        if not os.path.isdir(protein_dir):
+            os.makedirs(protein_dir)
+        with open(features_path(out_folder, pdb_id), 'wb') as fp:
+            pickle.dump(table.encode(data), fp)
+        length_file = os.path.join(in_folder, pdb_id, f"{pdb_id}.length")
+        if os.path.exists(length_file):
+            shutil.copy(length_file, protein_dir)
+    table.save(out_folder)
+    build_manifest(out_folder, num_processes=num_processes, update=False)
+    return table
+
+
+class MatchTable:
+    """Read-only, memory-mapped match table of a match store.
+
+    Attributes
+    ----------
+    seqs, ppoe, offsets, lengths : np.ndarray
+        Match table columns (see :code:`terminator.data.match_store`)
+    """
+    def __init__(self, store):
+        match_dir = os.path.join(store, MATCH_DIR)
+        self.seqs = np.load(os.path.join(match_dir, "seqs.npy"), mmap_mode='r')
+        self.ppoe = np.load(os.path.join(match_dir, "ppoe.npy"), mmap_mode='r')
+        self.offsets = np.load(os.path.join(match_dir, "offsets.npy"))
+        self.lengths = np.load(os.path.join(match_dir, "lengths.npy"))
+
+    def resolve(self, data, num_matches=None):
+        """Rebuild :code:`features` and :code:`msas` of a feature dictionary from its match references.
+
+        Args
+        ----
+        data : dict
+            Feature dictionary from a match store
+        num_matches : int or None, default=None
+            Only resolve the top :code:`num_matches` TERM matches. If :code:`None`, resolve all matches.
+
+        Returns
+        -------
+        dict
+            Feature dictionary, as outputted by :code:`scripts/data/preprocessing/packageTensors.py`
+        """
+        match_ids = data['match_ids'][:num_matches]
+        rmsds = data['rmsds'][:num_matches]
+        term_of_res, pos = _term_index(data['term_lens'])
+        # row of the match table holding each match residue, (n_matches, n_term_res)
+        rows = self.offsets[match_ids[:, term_of_res]] + pos
+
+        features = np.empty(rows.shape + (MATCH_FEATURES + 2, ), dtype=self.ppoe.dtype)
+        features[..., :MATCH_FEATURES] = self.ppoe[rows.ravel()].reshape(rows.shape + (MATCH_FEATURES, ))
+        features[..., RMSD_COL] = rmsds[:, term_of_res]
+        features[..., TERM_LEN_COL] = data['term_len_features'][term_of_res]
+
+        resolved = {
+            field: value
+            for field, value in data.items() if field not in ['match_ids', 'rmsds', 'term_len_features']
+        }
+        resolved['features'] = features
+        resolved['msas'] = self.seqs[rows.ravel()].reshape(rows.shape)
+        return resolved
+
+
+class TERMMatchStoreDataset(TERMLazyDataset):
+    """Lazy TERM dataset reading from a match store (see :code:`terminator.data.match_store`).
+
+    This is a drop-in replacement for :code:`TERMLazyDataset`, to be used with TERMLazyBatchSampler.
+    """
+    def __init__(self, in_folder, pdb_ids=None, min_protein_len=30, num_processes=32):
+        """
+        Args
+        ----
+        in_folder : str
+            Path to a match store generated by :code:`scripts/data/preprocessing/shardDataset.py --match_store`
+        pdb_ids : list of str or None, default=None
+            PDB ids to include. If :code:`None`, include every protein in the store.
+        min_protein_len : int, default=30
+            Minimum sequence length of an included protein
+        num_processes : int, default=32
+            Number of processes to use when refreshing the manifest of the store
+        """
+        super().__init__(in_folder, pdb_ids=pdb_ids, min_protein_len=min_protein_len, num_processes=num_processes)
+        self._table = None
+
+    def __getstate__(self):
+        # memory maps would be copied into the pickle, so every process opens its own
+        state = self.__dict__.copy()
+        state['_table'] = None
+        return state
+
+    def load(self, filepath, num_matches=None):
+        """Load the feature dictionary for a datapoint, resolving its TERM matches.
+
+        Args
+        ----
+        filepath : str
+            Path to the feature file, as stored in :code:`self.dataset`
+        num_matches : int or None, default=None
+            Only keep the top :code:`num_matches` TERM matches. If :code:`None`, keep all matches.
+
+        Returns
+        -------
+        dict
+            Feature dictionary
+        """
+        if self._table is None:
+            self._table = MatchTable(self.in_folder)
+        with open(filepath, 'rb') as fp:
+            data = pickle.load(fp)
+        return self._table.resolve(data, num_matches)
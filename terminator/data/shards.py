@@ -0,0 +1,397 @@
+"""Sharded, memory-mapped feature store for TERM data.
+
+Instead of one pickled :code:`<pdb>/<pdb>.features` file per protein, a shard store
+groups many proteins into shards. Each shard holds one contiguous array per feature field
+(e.g. :code:`features`, :code:`msas`, :code:`focuses`, :code:`coords`) alongside an offset index,
+so a protein can be read as a zero-copy view into a memory-mapped array.
+
+The on-disk layout is
+
+.. code-block::
+
+    <store>/index.npz                     # global index: pdb ids, shard ids, lengths
+    <store>/shard_<idx>/<field>.npy       # flat concatenation of a field across the shard's proteins
+    <store>/shard_<idx>/index.npz         # per-field offsets and shapes for each protein in the shard
+
+Arrays are stored flattened in the layout produced by :code:`scripts/data/preprocessing/packageTensors.py`.
+"""
+import glob
+import os
+import pickle
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from terminator.data.compact import compact_features
+
+# fields of the feature dictionary that are stored as arrays
+SHARD_FIELDS = ['coords', 'ppoe', 'features', 'msas', 'focuses', 'contact_idxs', 'term_lens', 'sequence', 'chain_lens']
+# fields only present in some datasets (e.g. SORTCERY fine-tuning data)
+OPTIONAL_SHARD_FIELDS = ['sortcery_seqs', 'sortcery_nrgs']
+# fields indexed by TERM match along their first axis. these are stored match-major,
+# so the top N matches of a protein are a contiguous prefix of its data
+MATCH_FIELDS = ['features', 'msas']
+INDEX_FILE = "index.npz"
+
+
+def _shard_name(shard_idx):
+    """Name of the folder holding shard :code:`shard_idx`"""
+    return f"shard_{shard_idx:05d}"
+
+
+def _pack_fields(datapoints, fields=None):
+    """Concatenate each field of a list of feature dictionaries into one flat array.
+
+    Args
+    ----
+    datapoints : list of dict
+        Feature dictionaries, as outputted by :code:`scripts/data/preprocessing/packageTensors.py`
+    fields : list of str or None, default=None
+        Fields to pack. Defaults to :code:`SHARD_FIELDS`, plus any of :code:`OPTIONAL_SHARD_FIELDS`
+        present in every datapoint.
+
+    Returns
+    -------
+    arrays : dict of np.ndarray
+        Flat concatenation of each field across datapoints
+    index : dict of np.ndarray
+        Per-field offsets and shapes for each datapoint, as well as PDB ids and sequence lengths
+    """
+    if fields is None:
+        fields = SHARD_FIELDS + [
+            field for field in OPTIONAL_SHARD_FIELDS if all(field in data for data in datapoints)
+        ]
+
+    flat_arrays, index = {}, {}
+    for field in fields:
+        arrays = [np.asarray(data[field]) for data in datapoints]
+        max_ndim = max(arr.ndim for arr in arrays)
+        # pad shapes with -1 so we can store shapes of differing rank in one array
+        shapes = np.full((len(arrays), max_ndim), -1, dtype=np.int64)
+        for i, arr in enumerate(arrays):
+            shapes[i, :arr.ndim] = arr.shape
+        sizes = np.array([arr.size for arr in arrays], dtype=np.int64)
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)
+
+        flat_arrays[field] = np.concatenate([arr.reshape(-1) for arr in arrays])
+        index[f"{field}_offsets"] = offsets
+        index[f"{field}_shapes"] = shapes
+
+    index["pdb"] = np.array([data['pdb'] for data in datapoints])
+    index["seq_len"] = np.array([data['seq_len'] for data in datapoints], dtype=np.int64)
+    index["fields"] = np.array(fields)
+    return flat_arrays, index
+
+
+def write_shard(shard_folder, datapoints, fields=None):
+    """Write a list of feature dictionaries into one shard.
+
+    Args
+    ----
+    shard_folder : str
+        Folder to write the shard into. Will be created if it does not exist.
+    datapoints : list of dict
+        Feature dictionaries, as outputted by :code:`scripts/data/preprocessing/packageTensors.py`
+    fields : list of str or None, default=None
+        Fields to store. Defaults to :code:`SHARD_FIELDS`, plus any of :code:`OPTIONAL_SHARD_FIELDS`
+        present in every datapoint.
+    """
+    if not os.path.isdir(shard_folder):
+        os.makedirs(shard_folder)
+    arrays, index = _pack_fields(datapoints, fields)
+    for field, flat in arrays.items():
+        np.save(os.path.join(shard_folder, f"{field}.npy"), flat)
+    np.savez(os.path.join(shard_folder, INDEX_FILE), **index)
+
+
+def write_shard_store(in_folder, out_folder, pdb_ids=None, shard_size=1000, compact=None):
+    """Convert a dataset folder of :code:`.features` files into a shard store.
+
+    Args
+    ----
+    in_folder : str
+        Path to directory containing feature files generated by :code:`scripts/data/preprocessing/generateDataset.py`
+    out_folder : str
+        Path to the shard store to create
+    pdb_ids : list of str or None, default=None
+        PDB ids from :code:`in_folder` to include. If :code:`None`, include every protein in :code:`in_folder`.
+    shard_size : int, default=1000
+        Number of proteins per shard
+    compact : str or None, default=None
+        If set, store arrays in compact dtypes (see :code:`terminator.data.compact`), with real-valued
+        features stored as :code:`'float32'` or :code:`'float16'`
+    """
+    if pdb_ids is None:
+        filelist = sorted(glob.glob(os.path.join(in_folder, '*/*.features')))
+        pdb_ids = [os.path.basename(path)[:-len(".features")] for path in filelist]
+    if not os.path.isdir(out_folder):
+        os.makedirs(out_folder)
+
+    shard_names, shard_ids, positions, term_lengths, seq_lens, names = [], [], [], [], [], []
+    progress = tqdm(total=len(pdb_ids))
+    for shard_idx, start in enumerate(range(0, len(pdb_ids), shard_size)):
+        datapoints = []
+        for pdb_id in pdb_ids[start:start + shard_size]:
+            with open(os.path.join(in_folder, pdb_id, f"{pdb_id}.features"), 'rb') as fp:
+                data = pickle.load(fp)
+            datapoints.append(data if compact is None else compact_features(data, float_dtype=np.dtype(compact)))
+            progress.update(1)
+        shard_name = _shard_name(shard_idx)
+        write_shard(os.path.join(out_folder, shard_name), datapoints)
+
+        shard_names.append(shard_name)
+        for position, data in enumerate(datapoints):
+            names.append(data['pdb'])
+            shard_ids.append(shard_idx)
+            positions.append(position)
+            term_lengths.append(int(np.asarray(data['term_lens']).sum()))
+            seq_lens.append(data['seq_len'])
+    progress.close()
+
+    np.savez(os.path.join(out_folder, INDEX_FILE),
+             shard_names=np.array(shard_names),
+             pdb=np.array(names),
+             shard=np.array(shard_ids, dtype=np.int64),
+             position=np.array(positions, dtype=np.int64),
+             total_term_length=np.array(term_lengths, dtype=np.int64),
+             seq_len=np.array(seq_lens, dtype=np.int64))
+
+
+class Shard:
+    """A single shard of a shard store, whose field arrays are memory-mapped on first access.
+
+    Attributes
+    ----------
+    folder : str
+        Path to the shard folder
+    index : dict of np.ndarray
+        Per-field offsets and shapes for each protein in the shard
+    fields : list of str
+        Fields stored in the shard
+    """
+    def __init__(self, folder):
+        """
+        Args
+        ----
+        folder : str
+            Path to the shard folder
+        """
+        self.folder = folder
+        with np.load(os.path.join(folder, INDEX_FILE)) as index:
+            self.index = dict(index.items())
+        self.fields = self.index["fields"].tolist()
+        self._arrays = None
+
+    def __getstate__(self):
+        # never pickle the memory maps, reopen them in whichever process needs them
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _open(self):
+        """Memory-map every field of the shard."""
+        # copy-on-write maps so that torch.from_numpy gets writable views without copying
+        self._arrays = {
+            field: np.load(os.path.join(self.folder, f"{field}.npy"), mmap_mode='c')
+            for field in self.fields
+        }
+
+    def shape(self, position, field):
+        """Shape of :code:`field` for the protein at :code:`position` in the shard."""
+        shape = self.index[f"{field}_shapes"][position]
+        return tuple(int(s) for s in shape if s >= 0)
+
+    def get(self, position, field, num_rows=None):
+        """Return a zero-copy view of :code:`field` for the protein at :code:`position` in the shard.
+
+        If :code:`num_rows` is given, only the first :code:`num_rows` entries along the first axis are viewed,
+        so only that prefix is ever read from disk.
+        """
+        if self._arrays is None:
+            self._open()
+        offsets = self.index[f"{field}_offsets"]
+        start, end = offsets[position], offsets[position + 1]
+        shape = self.shape(position, field)
+        if num_rows is not None and num_rows < shape[0]:
+            end = start + num_rows * int(np.prod(shape[1:], dtype=np.int64))
+            shape = (num_rows, ) + shape[1:]
+        return self._arrays[field][start:end].reshape(shape)
+
+    def num_matches(self, position):
+        """Number of TERM matches stored for the protein at :code:`position` in the shard."""
+        return self.shape(position, 'msas')[0]
+
+    def load(self, position, num_matches=None):
+        """Load the feature dictionary for the protein at :code:`position` in the shard.
+
+        Args
+        ----
+        position : int
+            Position of the protein in the shard
+        num_matches : int or None, default=None
+            Only read the top :code:`num_matches` TERM matches. If :code:`None`, read all matches.
+
+        Returns
+        -------
+        dict
+            Feature dictionary with the same keys as a :code:`.features` file,
+            where all array fields are views into the memory-mapped shard
+        """
+        data = {
+            field: self.get(position, field, num_rows=num_matches if field in MATCH_FIELDS else None)
+            for field in self.fields
+        }
+        if 'chain_lens' in data:
+            data['chain_lens'] = data['chain_lens'].tolist()
+        data['pdb'] = str(self.index["pdb"][position])
+        data['seq_len'] = int(self.index["seq_len"][position])
+        return data
+
+
+class SharedShard(Shard):
+    """An in-memory shard whose field arrays live in shared memory.
+
+    Forked or spawned DataLoader workers all read the same physical pages, and since the data is held
+    in one array per field rather than in per-protein objects, reference counting never copies it.
+
+    Attributes
+    ----------
+    tensors : dict of torch.Tensor
+        Flat shared-memory tensor for each field
+    index : dict of np.ndarray
+        Per-field offsets and shapes for each protein in the shard
+    fields : list of str
+        Fields stored in the shard
+    """
+    def __init__(self, datapoints, fields=None):  # pylint: disable=super-init-not-called
+        """
+        Args
+        ----
+        datapoints : list of dict
+            Feature dictionaries, as outputted by :code:`scripts/data/preprocessing/packageTensors.py`
+        fields : list of str or None, default=None
+            Fields to store (see :code:`write_shard`)
+        """
+        self.folder = None
+        arrays, self.index = _pack_fields(datapoints, fields)
+        self.fields = self.index["fields"].tolist()
+        self.tensors = {field: torch.from_numpy(flat).share_memory_() for field, flat in arrays.items()}
+        self._arrays = None
+
+    def _open(self):
+        """View the shared-memory tensors as numpy arrays."""
+        self._arrays = {field: tensor.numpy() for field, tensor in self.tensors.items()}
+
+
+class TERMShardDataset(Dataset):
+    """TERM Dataset that reads feature data from a memory-mapped shard store.
+
+    This is a drop-in replacement for TERMLazyDataset, to be used with TERMLazyBatchSampler.
+    Items are keys into the store rather than feature filenames.
+
+    Attributes
+    ----
+    dataset : list
+        list of tuples containing (shard idx, position in shard) keys, TERM length, and sequence length
+    shards : list of Shard
+        Shards of the store
+    shuffle_idx : list
+        array of indices for the dataset, for shuffling
+    """
+    def __init__(self, in_folder, pdb_ids=None, min_protein_len=30):
+        """
+        Initializes current TERM dataset by reading the index of a shard store.
+
+        Args
+        ----
+        in_folder : str
+            path to a shard store generated by :code:`scripts/data/preprocessing/shardDataset.py`
+        pdb_ids: list, optional
+            list of pdbs from `in_folder` to include in the dataset
+        min_protein_len: int, default=30
+            minimum length of a protein in the dataset
+        """
+        with np.load(os.path.join(in_folder, INDEX_FILE)) as index:
+            index = dict(index.items())
+        self.shards = [Shard(os.path.join(in_folder, name)) for name in index["shard_names"].tolist()]
+
+        keep = index["seq_len"] >= min_protein_len
+        if pdb_ids:
+            keep &= np.isin(index["pdb"], np.array(pdb_ids))
+        self.dataset = [((int(shard), int(position)), int(term_len), int(seq_len))
+                        for shard, position, term_len, seq_len in zip(index["shard"][keep], index["position"][keep],
+                                                                       index["total_term_length"][keep],
+                                                                       index["seq_len"][keep])]
+        self.shuffle_idx = np.arange(len(self.dataset))
+
+    def load(self, key, num_matches=None):
+        """Load the feature dictionary for a datapoint.
+
+        Args
+        ----
+        key : tuple of (int, int)
+            Shard index and position within the shard, as stored in :code:`self.dataset`
+        num_matches : int or None, default=None
+            Only read the top :code:`num_matches` TERM matches. If :code:`None`, read all matches.
+
+        Returns
+        -------
+        dict
+            Feature dictionary, with array fields as zero-copy views into the shard store
+        """
+        shard_idx, position = key
+        return self.shards[shard_idx].load(position, num_matches=num_matches)
+
+    def num_matches(self, key):
+        """Number of TERM matches stored for a datapoint, read from the shard index.
+
+        Args
+        ----
+        key : tuple of (int, int)
+            Shard index and position within the shard, as stored in :code:`self.dataset`
+
+        Returns
+        -------
+        int
+            Number of TERM matches
+        """
+        shard_idx, position = key
+        return self.shards[shard_idx].num_matches(position)
+
+    def shuffle(self):
+        """Shuffle the dataset"""
+        np.random.shuffle(self.shuffle_idx)
+
+    def __len__(self):
+        """Returns length of the given dataset.
+
+        Returns
+        -------
+        int
+            length of dataset
+        """
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        """Extract a given item with provided index.
+
+        Args
+        ----
+        idx : int
+            Index of item to return.
+        Returns
+        ----
+        key : tuple of (int, int)
+            Key of the datapoint in the shard store
+        total_term_len : int
+            Sum of lengths of all TERMs
+        seq_len : int
+            Length of protein sequence
+        """
+        data_idx = self.shuffle_idx[idx]
+        if isinstance(data_idx, list):
+            return [self.dataset[i] for i in data_idx]
+        return self.dataset[data_idx]
@@ -0,0 +1,322 @@
+"""Streaming dataset over tar shards, for sequential I/O on parallel filesystems.
+
+Listing and opening one :code:`<pdb>/<pdb>.features` file per protein is metadata-heavy, which
+parallel filesystems handle poorly. A tar store instead packs the feature files of many proteins into
+a few large tar shards, which are read front to back.
+
+The on-disk layout is
+
+.. code-block::
+
+    <store>/index.npz              # global index: shard names, pdb ids, shard ids, lengths
+    <store>/shard_<idx>.tar        # <pdb>.features members, as written by generateDataset.py
+
+:code:`TERMStreamDataset` streams proteins from the shards, shuffling at the shard level and through a bounded
+shuffle buffer, and groups them into batches on the fly. It yields packaged batches, so it is used with a
+:code:`torch.utils.data.DataLoader` with :code:`batch_size=None, collate_fn=terminator.data.batch.keep_batch`
+in place of a batch sampler.
+"""
+import io
+import os
+import pickle
+import tarfile
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from tqdm import tqdm
+
+from terminator.data.compact import compact_features
+from terminator.data.data import (_apply_term_dropout, _check_featurization_plan, _package, _sample_term_dropout,
+                                  _truncate_matches)
+from terminator.data.shards import INDEX_FILE
+
+
+def _tar_shard_name(shard_idx):
+    """Name of the tar file holding shard :code:`shard_idx`"""
+    return f"shard_{shard_idx:05d}.tar"
+
+
+def write_tar_store(in_folder, out_folder, pdb_ids=None, shard_size=1000, compact=None):
+    """Pack a dataset folder of :code:`.features` files into tar shards.
+
+    Args
+    ----
+    in_folder : str
+        Path to directory containing feature files generated by :code:`scripts/data/preprocessing/generateDataset.py`
+    out_folder : str
+        Path to the tar store to create
+    pdb_ids : list of str or None, default=None
+        PDB ids from :code:`in_folder` to include. If :code:`None`, include every protein in :code:`in_folder`.
+    shard_size : int, default=1000
+        Number of proteins per shard
+    compact : str or None, default=None
+        If set, store arrays in compact dtypes (see :code:`terminator.data.compact`), with real-valued
+        features stored as :code:`'float32'` or :code:`'float16'`
+    """
+    if pdb_ids is None:
+        pdb_ids = sorted(entry.name for entry in os.scandir(in_folder)
+                         if os.path.exists(os.path.join(in_folder, entry.name, f"{entry.name}.features")))
+    if not os.path.isdir(out_folder):
+        os.makedirs(out_folder)
+
+    shard_names, shard_ids, term_lengths, seq_lens, names = [], [], [], [], []
+    progress = tqdm(total=len(pdb_ids))
+    for shard_idx, start in enumerate(range(0, len(pdb_ids), shard_size)):
+        shard_name = _tar_shard_name(shard_idx)
+        with tarfile.open(os.path.join(out_folder, shard_name), 'w') as tar:
+            for pdb_id in pdb_ids[start:start + shard_size]:
+                with open(os.path.join(in_folder, pdb_id, f"{pdb_id}.features"), 'rb') as fp:
+                    raw = fp.read()
+                data = pickle.loads(raw)
+                if compact is not None:
+                    data = compact_features(data, float_dtype=np.dtype(compact))
+                    raw = pickle.dumps(data)
+                member = tarfile.TarInfo(f"{pdb_id}.features")
+                member.size = len(raw)
+                tar.addfile(member, io.BytesIO(raw))
+
+                names.append(pdb_id)
+                shard_ids.append(shard_idx)
+                term_lengths.append(int(np.asarray(data['term_lens']).sum()))
+                seq_lens.append(data['seq_len'])
+                progress.update(1)
+        shard_names.append(shard_name)
+    progress.close()
+
+    np.savez(os.path.join(out_folder, INDEX_FILE),
+             shard_names=np.array(shard_names),
+             pdb=np.array(names),
+             shard=np.array(shard_ids, dtype=np.int64),
+             total_term_length=np.array(term_lengths, dtype=np.int64),
+             seq_len=np.array(seq_lens, dtype=np.int64))
+
+
+def _greedy_batches(items, length, batch_size=None, cap_len=None):
+    """Split a stream of datapoints into consecutive batches, the same way :code:`TERMBatchSampler` does.
+
+    Args
+    ----
+    items : iterable
+        Datapoints to batch
+    length : callable
+        Function giving the length of a datapoint under the batch budget
+    batch_size : int or None, default=None
+        Fixed batch size. If :code:`None`, fit as many datapoints per batch as possible
+        while :code:`max length * number of datapoints <= cap_len`.
+    cap_len : int or None, default=None
+        Padded size budget of a batch, used when :code:`batch_size=None`
+
+    Yields
+    ------
+    list
+        Batches of datapoints
+    """
+    batch, max_len = [], 0
+    for item in items:
+        item_len = length(item)
+        if batch:
+            full = len(batch) == batch_size if batch_size else max(max_len, item_len) * (len(batch) + 1) > cap_len
+            if full:
+                yield batch
+                batch, max_len = [], 0
+        batch.append(item)
+        max_len = max(max_len, item_len)
+    if batch:
+        yield batch
+
+
+class TERMStreamDataset(IterableDataset):
+    """Iterable dataset streaming packaged batches from a tar store.
+
+    Shards are split across DataLoader workers, so every protein is read once per epoch.
+    Within a worker, shards are visited in a random order and read sequentially. Proteins pass through a shuffle
+    buffer, then every :code:`sort_window` proteins are sorted by length and grouped into batches, which are yielded
+    in random order.
+
+    Streaming doesn't support distributed training: ranks streaming their own shards would run different numbers of
+    steps, which deadlocks them at the end of an epoch. Iterating raises if a process group of several ranks
+    is initialized.
+
+    Attributes
+    ----------
+    store : str
+        Path to the tar store
+    shard_paths : list of str
+        Paths to the shards containing at least one selected protein
+    num_proteins : int
+        Number of selected proteins
+    epoch : int
+        Epoch used to seed shuffling (see :code:`set_epoch`)
+    """
+    def __init__(self,
+                 store,
+                 pdb_ids=None,
+                 min_protein_len=30,
+                 batch_size=None,
+                 max_term_res=55000,
+                 max_seq_tokens=None,
+                 shuffle=True,
+                 shuffle_buffer=1000,
+                 sort_window=500,
+                 term_matches_cutoff=None,
+                 term_dropout=None,
+                 featurize=None,
+                 seed=0):
+        """
+        Args
+        ----
+        store : str
+            Path to a tar store generated by :code:`scripts/data/preprocessing/shardDataset.py --tar`
+        pdb_ids : list of str or None, default=None
+            PDB ids to include. If :code:`None`, include every protein in the store.
+        min_protein_len : int, default=30
+            Minimum sequence length of an included protein
+        batch_size : int or None, default=None
+            Size of batches created. If :code:`None`, batch by fitting as many proteins as possible
+            under the :code:`max_term_res` or :code:`max_seq_tokens` budget.
+        max_term_res : int or None, default=55000
+            When :code:`batch_size=None, max_seq_tokens=None`, budget of padded TERM residues per batch.
+        max_seq_tokens : int or None, default=None
+            When :code:`batch_size=None, max_term_res=None`, budget of padded sequence residues per batch.
+        shuffle : bool, default=True
+            Shuffle the shard order and the proteins within the shuffle buffer, and the order of batches.
+            If :code:`False`, stream the proteins in store order.
+        shuffle_buffer : int, default=1000
+            Number of proteins held in the shuffle buffer
+        sort_window : int, default=500
+            Number of proteins sorted by length together before batching, to reduce padding.
+            Only used when :code:`shuffle=True` and :code:`batch_size=None`.
+        term_matches_cutoff : int or None, default=None
+            Use the top :code:`term_matches_cutoff` TERM matches for featurization.
+            If :code:`None`, apply no cutoff.
+        term_dropout : str or None, default=None
+            Let `t` be the number of TERM matches in the given datapoint.
+            Select a random int `n` from 1 to `t`, and take a random subset `n`
+            of the given TERM matches to keep. If :code:`term_dropout='keep_first'`,
+            keep the first match and choose `n-1` from the rest.
+            If :code:`term_dropout='all'`, choose `n` matches from all matches.
+        featurize : list of str or None, default=None
+            Optional featurizers from :code:`FEATURIZERS` to run while packaging batches.
+        seed : int, default=0
+            Random seed, shared across ranks
+        """
+        super().__init__()
+        if batch_size is None:
+            assert (max_term_res is None) != (max_seq_tokens is None), \
+                "Exactly one of max_term_res and max_seq_tokens must be None"
+        self.store = store
+        self.batch_size = batch_size
+        self.max_term_res = max_term_res
+        self.max_seq_tokens = max_seq_tokens
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.sort_window = sort_window
+        self.term_matches_cutoff = term_matches_cutoff
+        assert term_dropout in ["keep_first", "all", None], f"term_dropout={term_dropout} is not a valid argument"
+        self.term_dropout = term_dropout
+        self.featurize = _check_featurization_plan(featurize)
+        self.seed = seed
+        self.epoch = 0
+
+        index = np.load(os.path.join(store, INDEX_FILE))
+        selected = index['seq_len'] >= min_protein_len
+        if pdb_ids is not None:
+            selected &= np.isin(index['pdb'], list(pdb_ids))
+        self._lengths = {
+            pdb_id: (int(term_len), int(seq_len))
+            for pdb_id, term_len, seq_len in zip(index['pdb'][selected], index['total_term_length'][selected],
+                                                 index['seq_len'][selected])
+        }
+        self.num_proteins = len(self._lengths)
+        self.shard_paths = [
+            os.path.join(store, index['shard_names'][shard]) for shard in np.unique(index['shard'][selected])
+        ]
+
+    def set_epoch(self, epoch):
+        """Set the epoch, so that every epoch visits shards and proteins in a different order"""
+        self.epoch = epoch
+
+    def _worker_shards(self, rng):
+        """Shards read by this DataLoader worker"""
+        if (torch.distributed.is_available() and torch.distributed.is_initialized()
+                and torch.distributed.get_world_size() > 1):
+            raise RuntimeError("TERMStreamDataset does not support distributed training, "
+                               "as ranks would run different numbers of steps")
+        shard_paths = list(self.shard_paths)
+        if self.shuffle:
+            rng.shuffle(shard_paths)
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        return shard_paths[worker_id::num_workers]
+
+    def _stream(self, shard_paths):
+        """Read the selected proteins from the shards, in order"""
+        for path in shard_paths:
+            with tarfile.open(path, mode='r|') as tar:
+                for member in tar:
+                    pdb_id = member.name[:-len(".features")]
+                    if not member.isfile() or pdb_id not in self._lengths:
+                        continue
+                    data = pickle.load(tar.extractfile(member))
+                    term_len, seq_len = self._lengths[pdb_id]
+                    yield _truncate_matches(data, self.term_matches_cutoff), term_len, seq_len
+
+    def _shuffled(self, stream, rng):
+        """Shuffle a stream of proteins through a buffer of :code:`shuffle_buffer` proteins"""
+        buffer = []
+        for item in stream:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            idx = rng.randint(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = item
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _length(self, item):
+        """Length of a streamed protein under the batch budget"""
+        return item[2] if self.max_term_res is None else item[1]
+
+    def _batches(self, stream, rng):
+        """Group a stream of proteins into batches"""
+        cap_len = self.max_seq_tokens if self.max_term_res is None else self.max_term_res
+        if self.batch_size is not None or not self.shuffle:
+            yield from _greedy_batches(stream, self._length, self.batch_size, cap_len)
+            return
+
+        def window_batches(window):
+            batches = list(_greedy_batches(sorted(window, key=self._length), self._length, cap_len=cap_len))
+            rng.shuffle(batches)
+            return batches
+
+        # sort windows of proteins by length so that batches hold proteins of similar lengths
+        window = []
+        for item in stream:
+            window.append(item)
+            if len(window) == self.sort_window:
+                yield from window_batches(window)
+                window = []
+        yield from window_batches(window)
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        stream = self._stream(self._worker_shards(rng))
+        if self.shuffle:
+            # shuffle buffers differ between workers
+            worker_info = get_worker_info()
+            worker_id = 0 if worker_info is None else worker_info.id
+            stream = self._shuffled(stream, np.random.RandomState([self.seed, self.epoch, worker_id]))
+        for batch in self._batches(stream, rng):
+            batch = [(data, term_len) for data, term_len, _ in batch]
+            if not self.term_dropout:
+                yield _package(batch, featurize=self.featurize)
+                continue
+            # TERM match dropout, as in TERMLazyBatchSampler.package
+            n_keep, num_matches = _sample_term_dropout(self.term_dropout,
+                                                       max(len(data['msas']) for data, _ in batch))
+            packaged_batch = _package([(_truncate_matches(data, num_matches), term_len) for data, term_len in batch],
+                                      featurize=self.featurize)
+            _apply_term_dropout(packaged_batch, self.term_dropout, n_keep)
+            yield packaged_batch
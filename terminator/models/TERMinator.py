@@ -7,7 +7,7 @@ from torch.nn.utils.rnn import pad_sequence
 from .layers.condense import CondenseTERM
 from .layers.energies.gvp import GVPPairEnergies
 from .layers.energies.s2s import (AblatedPairEnergies, PairEnergies)
-from .layers.utils import gather_edges, pad_sequence_12
+from .layers.utils import cu_seqlens, gather_edges, pack, pack_knn_graph, pad_sequence_12
 
 # pylint: disable=no-member, not-callable
 
@@ -47,6 +47,9 @@ class TERMinator(nn.Module):
         else:
             self.hparams['energies_input_dim'] = 0
 
+        if hparams.get('energies_packed', False) and hparams['energies_gvp']:
+            raise ValueError("energies_packed is not supported with energies_gvp")
+
         if hparams['struct2seq_linear']:
             self.top = AblatedPairEnergies(hparams).to(self.dev)
         elif hparams['energies_gvp']:
@@ -129,6 +132,50 @@ class TERMinator(nn.Module):
 
         return h_V, gvp_batch.edge_index, h_E, E_idx
 
+    def _to_packed_input(self, node_embeddings, edge_embeddings, data):
+        """ Convert padded inputs of the GNN Potts Model Encoder to the packed layout
+
+        See :code:`terminator.models.layers.utils.cu_seqlens` for the packed layout.
+
+        Args
+        ----
+        node_embeddings : torch.Tensor or None
+            Node embeddings at the structure level, outputted by the TERM Info Condensor.
+            :code:`None` if running in TERMless mode
+            Shape: n_batch x max_seq_len x tic_n_hidden
+
+        edge_embeddings : torch.Tensor or None
+            Edge embedings at the structure level, outputted by the TERM Info Condensor.
+            :code:`None` if running in TERMless mode
+            Shape: n_batch x max_seq_len x max_seq_len x tic_n_hidden
+
+        data : dict of torch.Tensor
+            Overall input data dictionary. See :code:`forward` for more info.
+
+        Returns
+        -------
+        dict
+            Keyword arguments to :code:`self.top`, with all tensors packed. Edge embeddings are gathered
+            at the kNN edges before packing.
+        """
+        if 'E_idx' not in data:
+            raise ValueError("energies_packed requires the kNN graph to be built at collate time, "
+                             "see terminator.data.data.featurization_plan")
+        seq_lens = data['seq_lens']
+        if node_embeddings is not None:
+            node_embeddings = pack(node_embeddings, seq_lens)
+        if edge_embeddings is not None:
+            edge_embeddings = pack(gather_edges(edge_embeddings, data['E_idx']), seq_lens)
+        return {
+            'V_embed': node_embeddings,
+            'E_embed': edge_embeddings,
+            'X': pack(data['X'], seq_lens),
+            'x_mask': pack(data['x_mask'], seq_lens),
+            'chain_idx': pack(data['chain_idx'], seq_lens),
+            'knn_graph': pack_knn_graph(data['E_idx'], data['E_dist'], data['E_reverse'], seq_lens),
+            'cu_seqlens': cu_seqlens(seq_lens).to(data['X'].device)
+        }
+
     def _from_gvp_outputs(self, h_E, E_idx, seq_lens, max_seq_len):
         """ Convert outputs of GVP models to Ingraham style outputs
 
@@ -219,12 +266,19 @@ class TERMinator(nn.Module):
                 Shape: n_batch x n_term_res
             gvp_data : list of torch_geometric.data.Data
                 Vector and scalar featurizations of the backbone, as required by GVP
+            E_idx, E_dist, E_reverse : torch.Tensor, optional
+                kNN graph of the backbone built at collate time (see :code:`terminator.data.data._knn_graph`),
+                reused by the GNN Potts Model Encoder instead of rebuilding the graph.
+                Shape: n_batch x n_res x k
 
         Returns
         -------
         etab : torch.FloatTensor
             Dense kNN representation of the energy table, with :code:`E_idx`
             denotating which energies correspond to which edge.
+            If :code:`hparams['energies_packed']`, :code:`etab` and :code:`E_idx` are in the packed layout
+            (see :code:`terminator.models.layers.utils.cu_seqlens`), with a batch dimension of 1
+            and :code:`n_res = sum(seq_lens)`.
             Shape: n_batch x n_res x k(=30 by default) x :code:`hparams['energies_output_dim']` (=400 by default)
         E_idx : torch.LongTensor
             Indices representing edges in the kNN graph.
@@ -243,8 +297,16 @@ class TERMinator(nn.Module):
             h_E, edge_index = self.top(h_V, edge_index, h_E)
 
             etab, E_idx = self._from_gvp_outputs(h_E, E_idx, data['seq_lens'], max_seq_len)
+        elif self.hparams.get('energies_packed', False):
+            etab, E_idx = self.top(**self._to_packed_input(node_embeddings, edge_embeddings, data))
         else:
-            etab, E_idx = self.top(node_embeddings, edge_embeddings, data['X'], data['x_mask'], data['chain_idx'])
+            knn_graph = (data['E_idx'], data['E_dist'], data['E_reverse']) if 'E_idx' in data else None
+            etab, E_idx = self.top(node_embeddings,
+                                   edge_embeddings,
+                                   data['X'],
+                                   data['x_mask'],
+                                   data['chain_idx'],
+                                   knn_graph=knn_graph)
 
         if self.hparams['k_cutoff']:
             k = E_idx.shape[-1]
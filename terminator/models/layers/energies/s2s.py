@@ -16,6 +16,13 @@ from terminator.models.layers.utils import (cat_edge_endpoints, cat_neighbors_no
 # pylint: disable=no-member, not-callable
 
 
+def _reverse_edges(features, knn_graph, cu_seqlens=None):
+    """ Reverse edge positions of the collate-time kNN graph, if :code:`features` used that graph """
+    if features.reuses_graph(knn_graph, packed=cu_seqlens is not None):
+        return knn_graph[2]
+    return None
+
+
 class AblatedPairEnergies(nn.Module):
     """Ablated GNN Potts Model Encoder
 
@@ -46,7 +53,7 @@ class AblatedPairEnergies(nn.Module):
 
         self.W = nn.Linear(hparams['energies_input_dim'] * 3, hparams['energies_output_dim'])
 
-    def forward(self, V_embed, E_embed, X, x_mask, chain_idx):
+    def forward(self, V_embed, E_embed, X, x_mask, chain_idx, knn_graph=None, cu_seqlens=None):
         """ Create kNN etab from TERM features, then project to proper output dimensionality.
 
         Args
@@ -67,6 +74,13 @@ class AblatedPairEnergies(nn.Module):
             Indices such that each chain is assigned a unique integer and each residue in that chain
             is assigned that integer.
             Shape: n_batch x n_res
+        knn_graph : tuple of torch.Tensor or None, default=None
+            kNN graph :code:`(E_idx, E_dist, E_reverse)` built at collate time
+            (see :code:`terminator.data.data._knn_graph`). If None, the graph is built from :code:`X`.
+        cu_seqlens : torch.LongTensor or None, default=None
+            If given, all inputs are a packed batch (see :code:`terminator.models.layers.utils.cu_seqlens`),
+            :code:`knn_graph` is required, and :code:`E_embed` holds the TERM edge embeddings of the kNN edges only,
+            with shape n_batch x n_res x k x n_hidden.
 
         Returns
         -------
@@ -78,8 +92,9 @@ class AblatedPairEnergies(nn.Module):
             Shape: n_batch x n_res x k
         """
         # compute the kNN etab
-        _, _, E_idx = self.features(X, chain_idx, x_mask)  # notably, we throw away the backbone features
-        E_embed_neighbors = gather_edges(E_embed, E_idx)
+        # notably, we throw away the backbone features
+        _, _, E_idx = self.features(X, chain_idx, x_mask, knn_graph=knn_graph, cu_seqlens=cu_seqlens)
+        E_embed_neighbors = E_embed if cu_seqlens is not None else gather_edges(E_embed, E_idx)
         h_E = cat_edge_endpoints(E_embed_neighbors, V_embed, E_idx)
         etab = self.W(h_E)
 
@@ -89,7 +104,7 @@ class AblatedPairEnergies(nn.Module):
         etab = etab * x_mask.view(n_batch, n_res, 1, 1)
         etab = etab.unsqueeze(-1).view(n_batch, n_res, k, 20, 20)
         etab[:, :, 0] = etab[:, :, 0] * torch.eye(20).to(etab.device) # zero off-diagonal energies
-        etab = merge_duplicate_pairE(etab, E_idx)
+        etab = merge_duplicate_pairE(etab, E_idx, E_reverse=_reverse_edges(self.features, knn_graph, cu_seqlens))
         etab = etab.view(n_batch, n_res, k, out_dim)
 
         return etab, E_idx
@@ -168,7 +183,7 @@ class PairEnergies(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
-    def forward(self, V_embed, E_embed, X, x_mask, chain_idx):
+    def forward(self, V_embed, E_embed, X, x_mask, chain_idx, knn_graph=None, cu_seqlens=None):
         """ Create kNN etab from backbone and TERM features, then project to proper output dimensionality.
 
         Args
@@ -189,6 +204,13 @@ class PairEnergies(nn.Module):
             Indices such that each chain is assigned a unique integer and each residue in that chain
             is assigned that integer.
             Shape: n_batch x n_res
+        knn_graph : tuple of torch.Tensor or None, default=None
+            kNN graph :code:`(E_idx, E_dist, E_reverse)` built at collate time
+            (see :code:`terminator.data.data._knn_graph`). If None, the graph is built from :code:`X`.
+        cu_seqlens : torch.LongTensor or None, default=None
+            If given, all inputs are a packed batch (see :code:`terminator.models.layers.utils.cu_seqlens`),
+            :code:`knn_graph` is required, and :code:`E_embed` holds the TERM edge embeddings of the kNN edges only,
+            with shape n_batch x n_res x k x n_hidden.
 
         Returns
         -------
@@ -201,17 +223,17 @@ class PairEnergies(nn.Module):
         """
         # Prepare node and edge embeddings
         if self.hparams['energies_input_dim'] != 0:
-            V, E, E_idx = self.features(X, chain_idx, x_mask)
+            V, E, E_idx = self.features(X, chain_idx, x_mask, knn_graph=knn_graph, cu_seqlens=cu_seqlens)
             if not self.hparams['use_coords']:  # this is hacky/inefficient but i am lazy
                 V = torch.zeros_like(V)
                 E = torch.zeros_like(E)
             # fuse backbone and TERM embeddings
             h_V = self.W_v(torch.cat([V, V_embed], dim=-1))
-            E_embed_neighbors = gather_edges(E_embed, E_idx)
+            E_embed_neighbors = E_embed if cu_seqlens is not None else gather_edges(E_embed, E_idx)
             h_E = self.W_e(torch.cat([E, E_embed_neighbors], dim=-1))
         else:
             # just use backbone features
-            V, E, E_idx = self.features(X, chain_idx, x_mask)
+            V, E, E_idx = self.features(X, chain_idx, x_mask, knn_graph=knn_graph, cu_seqlens=cu_seqlens)
             h_V = self.W_v(V)
             h_E = self.W_e(E)
 
@@ -231,7 +253,7 @@ class PairEnergies(nn.Module):
         h_E = h_E * x_mask.view(n_batch, n_res, 1, 1) # ensure output etab is masked properly
         h_E = h_E.unsqueeze(-1).view(n_batch, n_res, k, 20, 20)
         h_E[:, :, 0] = h_E[:, :, 0] * torch.eye(20).to(h_E.device) # zero off-diagonal energies
-        h_E = merge_duplicate_pairE(h_E, E_idx)
+        h_E = merge_duplicate_pairE(h_E, E_idx, E_reverse=_reverse_edges(self.features, knn_graph, cu_seqlens))
 
         # if specified, use generate self energies from node embeddings
         if "node_self_sub" in self.hparams.keys() and self.hparams["node_self_sub"] is True:
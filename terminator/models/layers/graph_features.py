@@ -13,6 +13,26 @@ from .utils import gather_edges, gather_nodes
 # pylint: disable=no-member
 
 
+def _packed_positions(cu_seqlens):
+    """ Position of every residue of a packed batch within its protein, and the length of that protein
+
+    Args
+    ----
+    cu_seqlens : torch.LongTensor
+        Offsets of the proteins of a packed batch (see :code:`terminator.models.layers.utils.cu_seqlens`)
+        Shape: n_batch + 1
+
+    Returns
+    -------
+    pos, seq_len : torch.LongTensor
+        Shape: sum(seq_lens)
+    """
+    seq_lens = cu_seqlens[1:] - cu_seqlens[:-1]
+    seq_len = torch.repeat_interleave(seq_lens, seq_lens)
+    pos = torch.arange(len(seq_len), device=cu_seqlens.device) - torch.repeat_interleave(cu_seqlens[:-1], seq_lens)
+    return pos, seq_len
+
+
 class PositionalEncodings(nn.Module):
     """ Module to generate differential positional encodings for protein graph edges """
     def __init__(self, num_embeddings):
@@ -225,7 +245,7 @@ class ProteinFeatures(nn.Module):
         # exit(0)
         return neighbor_HB
 
-    def _orientations_coarse(self, X, E_idx, eps=1e-6):
+    def _orientations_coarse(self, X, E_idx, eps=1e-6, cu_seqlens=None):
         # Pair features
 
         # Shifted slices of unit vectors
@@ -256,6 +276,14 @@ class ProteinFeatures(nn.Module):
         O = O.view(list(O.shape[:2]) + [9])
         O = F.pad(O, (0, 0, 1, 2), 'constant', 0)
 
+        if cu_seqlens is not None:
+            # in a packed batch, zero the features spanning two proteins,
+            # as the padding above does at the ends of a lone protein
+            pos, seq_len = _packed_positions(cu_seqlens)
+            inside = ((pos >= 1) & (pos <= seq_len - 3)).view(1, -1, 1).to(O.dtype)
+            AD_features = AD_features * inside
+            O = O * inside
+
         # DEBUG: Viz [dense] pairwise orientations
         # O = O.view(list(O.shape[:2]) + [3,3])
         # dX = X.unsqueeze(2) - X.unsqueeze(1)
@@ -298,7 +326,7 @@ class ProteinFeatures(nn.Module):
         # print(Q.sum(), dU.sum(), R.sum())
         return AD_features, O_features
 
-    def _dihedrals(self, X, eps=1e-7):
+    def _dihedrals(self, X, eps=1e-7, cu_seqlens=None):
         # First 3 coordinates are N, CA, C
         X = X[:, :, :3, :].reshape(X.shape[0], 3 * X.shape[1], 3)
 
@@ -320,6 +348,12 @@ class ProteinFeatures(nn.Module):
         # This scheme will remove phi[0], psi[-1], omega[-1]
         D = F.pad(D, (1, 2), 'constant', 0)
         D = D.view((D.size(0), int(D.size(1) / 3), 3))
+        if cu_seqlens is not None:
+            # in a packed batch, also remove phi[0], psi[-1], omega[-1] of every protein
+            pos, seq_len = _packed_positions(cu_seqlens)
+            first, last = (pos == 0).unsqueeze(-1), (pos == seq_len - 1).unsqueeze(-1)
+            angle = torch.arange(3, device=D.device)
+            D = D.masked_fill(((first & (angle == 0)) | (last & (angle > 0))).unsqueeze(0), 0)
 
         # print(cosD.cpu().data.numpy().flatten())
         # print(omega.sum().cpu().data.numpy().flatten())
@@ -522,8 +556,15 @@ class MultiChainProteinFeatures(ProteinFeatures):
         # the math is the same so i'm not gonna code a new module lol
         self.embeddings = IndexDiffEncoding(num_positional_embeddings)
 
+    def reuses_graph(self, knn_graph, packed=False):
+        """ Whether :code:`forward` uses the given collate-time kNN graph rather than building its own """
+        if knn_graph is None or knn_graph[0].shape[-1] != self.top_k:
+            return False
+        # augmented coordinates have different neighbors, but packed batches can't be searched for neighbors
+        return packed or not (self.training and self.augment_eps > 0)
+
     # pylint: disable=arguments-differ
-    def forward(self, X, chain_idx, mask):
+    def forward(self, X, chain_idx, mask, knn_graph=None, cu_seqlens=None):
         """ Featurize coordinates as an attributed graph
 
         Args
@@ -538,6 +579,16 @@ class MultiChainProteinFeatures(ProteinFeatures):
         mask : torch.ByteTensor
             Mask for residues
             Shape: n_batch x seq_len
+        knn_graph : tuple of torch.Tensor or None, default=None
+            kNN graph :code:`(E_idx, D_neighbors, ...)` built at collate time
+            (see :code:`terminator.data.data._knn_graph`).
+            Used instead of building the graph here, unless its number of neighbors differs from :code:`top_k`
+            or coordinates are augmented.
+        cu_seqlens : torch.LongTensor or None, default=None
+            If given, the inputs are a packed batch (see :code:`terminator.models.layers.utils.cu_seqlens`)
+            with a single batch entry, and :code:`knn_graph` must be given in the packed layout.
+            Neighbors are then always taken from :code:`knn_graph`, with distances recomputed when coordinates
+            are augmented.
 
         Returns
         -------
@@ -558,10 +609,19 @@ class MultiChainProteinFeatures(ProteinFeatures):
 
         # Build k-Nearest Neighbors graph
         X_ca = X[:, :, 1, :]
-        D_neighbors, E_idx, mask_neighbors = self._dist(X_ca, mask)
+        packed = cu_seqlens is not None
+        if self.reuses_graph(knn_graph, packed=packed):
+            E_idx, D_neighbors = knn_graph[:2]
+            if self.training and self.augment_eps > 0:
+                D_neighbors = torch.sqrt(((gather_nodes(X_ca, E_idx) - X_ca.unsqueeze(-2))**2).sum(-1) + 1e-6)
+            mask_neighbors = mask.view(mask.shape + (1, 1)) * gather_nodes(mask.unsqueeze(-1), E_idx)
+        elif packed:
+            raise ValueError(f"packed batches require a kNN graph with k={self.top_k}")
+        else:
+            D_neighbors, E_idx, mask_neighbors = self._dist(X_ca, mask)
 
         # Pairwise features
-        AD_features, O_features = self._orientations_coarse(X_ca, E_idx)
+        AD_features, O_features = self._orientations_coarse(X_ca, E_idx, cu_seqlens=cu_seqlens)
         RBF = self._rbf(D_neighbors)
 
         # Pairwise embeddings
@@ -587,11 +647,11 @@ class MultiChainProteinFeatures(ProteinFeatures):
             E = torch.cat((E_positional, neighbor_C, neighbor_HB), -1)
         elif self.features_type == 'full':
             # Full backbone angles
-            V = self._dihedrals(X)
+            V = self._dihedrals(X, cu_seqlens=cu_seqlens)
             E = torch.cat((E_positional, RBF, O_features), -1)
         elif self.features_type == 'dist':
             # Full backbone angles
-            V = self._dihedrals(X)
+            V = self._dihedrals(X, cu_seqlens=cu_seqlens)
             E = torch.cat((E_positional, RBF), -1)
 
         # Embed the nodes
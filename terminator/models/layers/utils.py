@@ -76,6 +76,156 @@ def batchify(batched_flat_terms, term_lens):
 # struct level
 
 
+def cu_seqlens(seq_lens):
+    """ Cumulative sequence lengths, i.e. the offset of each protein in a packed batch.
+
+    In the packed layout, the residues of all proteins in a batch are concatenated into a single
+    batch entry of :code:`n_res = sum(seq_lens)` residues, without padding, and protein :code:`b` holds
+    residues :code:`cu_seqlens[b]:cu_seqlens[b + 1]`.
+
+    Args
+    ----
+    seq_lens : torch.LongTensor
+        Sequence length of each protein
+        Shape: n_batch
+
+    Returns
+    -------
+    torch.LongTensor
+        Offsets of the proteins, followed by the total number of residues
+        Shape: n_batch + 1
+    """
+    seq_lens = torch.as_tensor(seq_lens, dtype=torch.long)
+    return torch.cat([seq_lens.new_zeros(1), torch.cumsum(seq_lens, 0)])
+
+
+def is_packed(tensor, seq_lens):
+    """ Whether a batch tensor is in the packed layout (see :code:`cu_seqlens`) rather than padded.
+
+    Batches of one protein are the same in both layouts.
+
+    Args
+    ----
+    tensor : torch.Tensor
+        Batch tensor with the batch in dim 0
+    seq_lens : torch.LongTensor or list of int
+        Sequence length of each protein in the batch
+    """
+    return tensor.shape[0] != len(seq_lens)
+
+
+def pack(padded, seq_lens):
+    """ Convert a padded batch tensor to the packed layout (see :code:`cu_seqlens`).
+
+    Args
+    ----
+    padded : torch.Tensor
+        Padded tensor
+        Shape: n_batch x max_seq_len x ...
+    seq_lens : torch.LongTensor
+        Sequence length of each protein
+        Shape: n_batch
+
+    Returns
+    -------
+    torch.Tensor
+        Packed tensor
+        Shape: 1 x sum(seq_lens) x ...
+    """
+    seq_lens = torch.as_tensor(seq_lens, device=padded.device)
+    length_mask = torch.arange(padded.shape[1], device=padded.device) < seq_lens.unsqueeze(-1)
+    return padded[length_mask].unsqueeze(0)
+
+
+def unpack(packed, seq_lens, max_seq_len=None):
+    """ Convert a packed batch tensor (see :code:`cu_seqlens`) back to a zero-padded one.
+
+    Args
+    ----
+    packed : torch.Tensor
+        Packed tensor
+        Shape: 1 x sum(seq_lens) x ...
+    seq_lens : torch.LongTensor
+        Sequence length of each protein
+        Shape: n_batch
+    max_seq_len : int or None, default=None
+        Length to pad to. If :code:`None`, pad to the longest protein.
+
+    Returns
+    -------
+    torch.Tensor
+        Padded tensor
+        Shape: n_batch x max_seq_len x ...
+    """
+    seq_lens = torch.as_tensor(seq_lens, device=packed.device)
+    if max_seq_len is None:
+        max_seq_len = int(seq_lens.max())
+    length_mask = torch.arange(max_seq_len, device=packed.device) < seq_lens.unsqueeze(-1)
+    padded = packed.new_zeros(length_mask.shape + packed.shape[2:])
+    padded[length_mask] = packed[0]
+    return padded
+
+
+def pack_knn_graph(E_idx, E_dist, E_reverse, seq_lens):
+    """ Convert a padded kNN graph to the packed layout (see :code:`cu_seqlens`).
+
+    Edge indices are shifted to index into the concatenated residues, so the graphs of
+    different proteins stay disconnected. Every protein must have at least :code:`k` residues:
+    the neighbor lists of shorter proteins run into padding residues, which the packed layout drops.
+
+    Args
+    ----
+    E_idx, E_dist, E_reverse : torch.Tensor
+        kNN graph, as built by :code:`terminator.data.data._knn_graph`
+        Shape: n_batch x max_seq_len x k
+    seq_lens : torch.LongTensor
+        Sequence length of each protein
+        Shape: n_batch
+
+    Returns
+    -------
+    E_idx, E_dist, E_reverse : torch.Tensor
+        Packed kNN graph
+        Shape: 1 x sum(seq_lens) x k
+
+    Raises
+    ------
+    ValueError
+        If a protein has fewer than :code:`k` residues
+    """
+    k = E_idx.shape[-1]
+    if min(torch.as_tensor(seq_lens).tolist()) < k:
+        raise ValueError(f"packed batches require proteins of at least k={k} residues, got lengths "
+                         f"{torch.as_tensor(seq_lens).tolist()}. Raise min_protein_len or use padded batches")
+    offsets = cu_seqlens(seq_lens)[:-1].to(E_idx.device).view(-1, 1, 1)
+    E_reverse = torch.where(E_reverse >= 0, E_reverse + offsets * k, E_reverse)
+    return pack(E_idx + offsets, seq_lens), pack(E_dist, seq_lens), pack(E_reverse, seq_lens)
+
+
+def unpack_knn_idx(E_idx, seq_lens, max_seq_len=None):
+    """ Convert packed kNN edge indices (see :code:`pack_knn_graph`) back to padded, per-protein indices.
+
+    Args
+    ----
+    E_idx : torch.LongTensor
+        Packed kNN edge indices
+        Shape: 1 x sum(seq_lens) x k
+    seq_lens : torch.LongTensor
+        Sequence length of each protein
+        Shape: n_batch
+    max_seq_len : int or None, default=None
+        Length to pad to. If :code:`None`, pad to the longest protein.
+
+    Returns
+    -------
+    torch.LongTensor
+        Padded kNN edge indices, zero at padding residues
+        Shape: n_batch x max_seq_len x k
+    """
+    offsets = cu_seqlens(seq_lens)[:-1].to(E_idx.device).view(-1, 1, 1)
+    return (unpack(E_idx, seq_lens, max_seq_len) - offsets).clamp(min=0)
+
+
 def gather_edges(edges, neighbor_idx):
     """ Gather the edge features of the nearest neighbors.
 
@@ -382,7 +532,8 @@ def merge_duplicate_edges(h_E_update, E_idx):
     offset = [seq_lens[:i].sum() for i in range(len(seq_lens))]
     split_E_idxs = [e.to(h_E_update.device) + o for e, o in zip(split_E_idxs, offset)]
     edge_index_row = torch.cat([e.view(-1) for e in split_E_idxs], dim=0)
-    edge_index_col = torch.repeat_interleave(torch.arange(edge_index_row.shape[0] // 30), 30).to(h_E_update.device)
+    k = E_idx.shape[-1]
+    edge_index_col = torch.repeat_interleave(torch.arange(edge_index_row.shape[0] // k), k).to(h_E_update.device)
     edge_index = torch.stack([edge_index_row, edge_index_col])
     merge = merge_duplicate_edges_geometric(h_E_geometric, edge_index)
     merge = merge.view(h_E_update.shape)
@@ -479,7 +630,7 @@ def merge_duplicate_term_edges(h_E_update, E_idx):
     return merged_E_updates
 
 
-def merge_duplicate_pairE(h_E, E_idx):
+def merge_duplicate_pairE(h_E, E_idx, E_reverse=None):
     """ Average pair energy tables across bidirectional edges.
 
     TERMinator edges are represented as two bidirectional edges, and to allow for
@@ -496,6 +647,10 @@ def merge_duplicate_pairE(h_E, E_idx):
     E_idx : torch.LongTensor
         kNN sparse edge indices
         Shape : n_batch x n_res x k
+    E_reverse : torch.LongTensor or None, default=None
+        Position of the reverse of each edge, as built at collate time
+        (see :code:`terminator.data.data._reverse_edges`). If given, the reverse edges aren't searched for.
+        Shape : n_batch x n_res x k
 
     Returns
     -------
@@ -503,6 +658,8 @@ def merge_duplicate_pairE(h_E, E_idx):
         Pair energies with merged energies for bidirectional edges
         Shape : n_batch x n_res x k x n_aa x n_aa
     """
+    if E_reverse is not None:
+        return merge_duplicate_pairE_reverse(h_E, E_reverse)
     try:
         seq_lens = torch.ones(h_E.shape[0]).long().to(h_E.device) * h_E.shape[1]
         h_E_geometric = h_E.view([-1, 400])
@@ -510,7 +667,8 @@ def merge_duplicate_pairE(h_E, E_idx):
         offset = [seq_lens[:i].sum() for i in range(len(seq_lens))]
         split_E_idxs = [e.to(h_E.device) + o for e, o in zip(split_E_idxs, offset)]
         edge_index_row = torch.cat([e.view(-1) for e in split_E_idxs], dim=0)
-        edge_index_col = torch.repeat_interleave(torch.arange(edge_index_row.shape[0] // 30), 30).to(h_E.device)
+        k = E_idx.shape[-1]
+        edge_index_col = torch.repeat_interleave(torch.arange(edge_index_row.shape[0] // k), k).to(h_E.device)
         edge_index = torch.stack([edge_index_row, edge_index_col])
         merge = merge_duplicate_pairE_geometric(h_E_geometric, edge_index)
         merge = merge.view(h_E.shape)
@@ -525,6 +683,36 @@ def merge_duplicate_pairE(h_E, E_idx):
         return merge_duplicate_pairE_sparse(h_E, E_idx)
 
 
+def merge_duplicate_pairE_reverse(h_E, E_reverse):
+    """ Average pair energy tables across bidirectional edges, given the position of every reverse edge.
+
+    Equivalent to :code:`merge_duplicate_pairE_geometric`, but gathers the reverse edges directly.
+
+    Args
+    ----
+    h_E : torch.Tensor
+        Pair energies in kNN sparse form
+        Shape : n_batch x n_res x k x n_aa x n_aa
+    E_reverse : torch.LongTensor
+        Position of the reverse of each edge in the flattened :code:`n_res x k` neighbor lists, or -1 if the reverse
+        edge isn't in the graph (see :code:`terminator.data.data._reverse_edges`)
+        Shape : n_batch x n_res x k
+
+    Returns
+    -------
+    torch.Tensor
+        Pair energies with merged energies for bidirectional edges
+        Shape : n_batch x n_res x k x n_aa x n_aa
+    """
+    n_batch, n_res, k, n_aa, _ = h_E.shape
+    flat_h_E = h_E.reshape([n_batch, n_res * k, n_aa * n_aa])
+    reverse_idx = E_reverse.reshape([n_batch, n_res * k, 1]).clamp(min=0).expand(-1, -1, n_aa * n_aa)
+    # transpose each pair energy table of the reverse edges
+    reverse_E = torch.gather(flat_h_E, 1, reverse_idx).view(h_E.shape).transpose(-2, -1)
+    has_reverse = (E_reverse >= 0).view([n_batch, n_res, k, 1, 1])
+    return torch.where(has_reverse, (h_E + reverse_E) / 2, h_E)
+
+
 def merge_duplicate_pairE_dense(h_E, E_idx):
     """ Dense method to average pair energy tables across bidirectional edges.
 
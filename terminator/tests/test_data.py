@@ -0,0 +1,729 @@
+""" Data loading test suite
+
+A collection of tests to ensure that batches are packaged correctly.
+"""
+
+import os
+import pickle
+import shutil
+
+import numpy as np
+import pytest
+import torch
+
+from terminator.data.data import (BATCH_FEATURIZERS, FEATURIZERS, DistributedBatchSampler, TERMBatchSampler,
+                                  TERMDataset, TERMLazyBatchSampler, TERMLazyDataset, _bin_pack,
+                                  _check_featurization_plan, _package, _padding_efficiency, featurization_plan)
+from terminator.data.batch import TERMBatch, keep_batch
+from terminator.data import cache
+from terminator.data.cache import TERMCachedDataset
+from terminator.data.compact import compact_features
+from terminator.data.manifest import (DatasetManifest, build_manifest, read_manifest, register_proteins,
+                                      unregister_proteins)
+from terminator.data.match_store import TERMMatchStoreDataset, write_match_store
+from terminator.data.shards import TERMShardDataset, write_shard_store
+from terminator.data.stream import TERMStreamDataset, write_tar_store
+from terminator.models.layers.graph_features import MultiChainProteinFeatures
+from terminator.models.layers.energies.s2s import PairEnergies
+from terminator.models.layers.utils import (cu_seqlens, merge_duplicate_pairE, pack, pack_knn_graph, unpack,
+                                            unpack_knn_idx)
+from terminator.utils.common import seq_to_ints
+from terminator.utils.dat import contact_idx, index_terms, parse_term_data
+from terminator.utils.model.loss_fn import construct_loss_fn
+from terminator.utils.model.default_hparams import DEFAULT_MODEL_HPARAMS
+from terminator.utils.model.loop_utils import PrefetchIterator, _to_dev
+from terminator.utils.pdb import read_backbone, read_pdb_records
+
+# pylint: disable=no-member
+
+
+def _fake_protein(pdb, chain_lens, n_matches=3, term_len=4, num_features=9, seed=0):
+    """ Generate a feature dictionary in the format of :code:`scripts/data/preprocessing/packageTensors.py`
+
+    Args
+    ----
+    pdb : str
+        Name of the fake protein
+    chain_lens : list of int
+        Length of each chain
+    n_matches : int
+        Number of TERM matches per TERM
+    term_len : int
+        Length of each TERM
+    num_features : int
+        Number of features per TERM match residue
+    seed : int
+        Random seed
+
+    Returns
+    -------
+    dict
+        Fake feature dictionary
+    """
+    rng = np.random.default_rng(seed)
+    seq_len = sum(chain_lens)
+    n_terms = max(seq_len // term_len, 1)
+    term_lens = np.array([term_len] * n_terms)
+    n_term_res = term_lens.sum()
+    # build an extended backbone so that the featurization is well defined
+    ca = np.cumsum(rng.normal(size=(seq_len, 3)) + np.array([3.8, 0, 0]), axis=0)
+    coords = np.stack([ca - 1, ca, ca + 1, ca + np.array([1, 1, 0])], axis=1)
+    return {
+        'pdb': pdb,
+        'coords': coords,
+        'ppoe': rng.normal(size=(seq_len, 7)),
+        'features': rng.normal(size=(n_matches, n_term_res, num_features)),
+        'msas': rng.integers(0, 21, size=(n_matches, n_term_res)),
+        'focuses': rng.integers(0, seq_len, size=n_term_res),
+        'contact_idxs': rng.integers(-2, 3, size=n_term_res),
+        'term_lens': term_lens,
+        'sequence': rng.integers(0, 20, size=seq_len),
+        'seq_len': seq_len,
+        'chain_lens': chain_lens
+    }
+
+
+def _fake_batch():
+    """ Generate a list of (feature dict, total term length) tuples as consumed by :code:`_package` """
+    proteins = [_fake_protein('AAAA', [40], seed=0), _fake_protein('BBBB', [20, 25], seed=1)]
+    return [(p, p['term_lens'].sum()) for p in proteins]
+
+
+def _write_features(folder, proteins):
+    """ Write feature dictionaries into a dataset folder, as :code:`<folder>/<pdb>/<pdb>.features` """
+    for protein in proteins:
+        os.makedirs(os.path.join(folder, protein['pdb']), exist_ok=True)
+        with open(os.path.join(folder, protein['pdb'], f"{protein['pdb']}.features"), 'wb') as fp:
+            pickle.dump(protein, fp)
+
+
+def test_featurization_plan():
+    """ Test that only the graph features consumed by the model are planned """
+    hparams = DEFAULT_MODEL_HPARAMS.copy()
+    assert featurization_plan(hparams) == (('knn_graph', 30), )
+    hparams['energies_gvp'] = True
+    assert featurization_plan(hparams) == (('knn_graph', 30), 'gvp_data')
+    # augmented training coordinates are searched for neighbors again, unless batches are packed or GVP featurized
+    hparams['energies_augment_eps'] = 0.1
+    assert featurization_plan(hparams, training=True) == (('knn_graph', 30), 'gvp_data')
+    hparams['energies_gvp'] = False
+    assert featurization_plan(hparams, training=True) == ()
+    assert featurization_plan(hparams) == (('knn_graph', 30), )
+    hparams['energies_packed'] = True
+    assert featurization_plan(hparams, training=True) == (('knn_graph', 30), )
+    # the collate-time graph has the number of neighbors of the model
+    hparams['k_neighbors'] = 20
+    assert featurization_plan(hparams) == (('knn_graph', 20), )
+    assert _check_featurization_plan(featurization_plan(hparams)) == (('knn_graph', 20), )
+
+
+def test_package_skips_unplanned_features():
+    """ Test that packaging only runs the featurizers in the plan """
+    batch = _package(_fake_batch())
+    assert 'gvp_data' not in batch
+    assert 'geometric_data' not in batch
+    assert batch['X'].shape == (2, 45, 4, 3)
+    assert batch['seq_lens'].tolist() == [40, 45]
+
+    batch = _package(_fake_batch(), featurize=('gvp_data',))
+    assert len(batch['gvp_data']) == 2
+    assert 'geometric_data' not in batch
+
+
+def test_package_padding():
+    """ Test the padding and masks of a packaged batch """
+    proteins = _fake_batch()
+    batch = _package(proteins)
+    focus_lens = [p['term_lens'].sum() for p, _ in proteins]
+    assert batch['msas'].dtype == torch.int64
+    assert batch['features'].dtype == torch.float32
+    assert batch['features'].shape == (2, 3, max(focus_lens), 9)
+    assert batch['src_key_mask'].sum(-1).tolist() == [max(focus_lens) - l for l in focus_lens]
+    for i, (protein, focus_len) in enumerate(proteins):
+        assert (batch['features'][i, :, :focus_len].numpy() == protein['features'].astype(np.float32)).all()
+        assert (batch['features'][i, :, focus_len:] == 0).all()
+        # term_lens are extended to cover the padded TERM residues, then padded with -1
+        term_lens = batch['term_lens'][i]
+        assert term_lens[term_lens >= 0].sum() == max(focus_lens)
+    assert batch['chain_idx'][1].tolist() == [0.] * 20 + [1.] * 25
+    assert batch['x_mask'].tolist() == [[1.] * 40 + [0.] * 5, [1.] * 45]
+
+
+@pytest.mark.parametrize("name", ['gvp_data', 'geometric_data'])
+def test_batch_featurizers(name):
+    """ Test that featurizing a batch at once matches featurizing each protein alone """
+    proteins = []
+    for i, chain_lens in enumerate([[40], [20, 25], [12]]):
+        protein = _fake_protein(f"P{i}", chain_lens, seed=i)
+        proteins.append({
+            'name': protein['pdb'],
+            'coords': protein['coords'],
+            'seq': protein['sequence'],
+            'chain_idx': torch.from_numpy(np.repeat(np.arange(len(chain_lens), dtype=np.float32), chain_lens))
+        })
+    proteins[1]['coords'][3] = np.nan
+    for batched, protein in zip(BATCH_FEATURIZERS[name](proteins), proteins):
+        alone = FEATURIZERS[name](protein)
+        assert batched.name == alone.name
+        for key in alone.keys():
+            if key != 'name':
+                assert torch.allclose(batched[key].float(), alone[key].float(), atol=1e-5), key
+
+
+def test_knn_graph():
+    """ Test that the kNN graph built at collate time matches the graph built in the model """
+    proteins = [(p, p['term_lens'].sum()) for p in [_fake_protein('AAAA', [40]), _fake_protein('BBBB', [20, 25])]]
+    batch = _package(proteins, featurize=('knn_graph', 'gvp_data'))
+    features = MultiChainProteinFeatures(node_features=8, edge_features=8)
+    D_neighbors, E_idx, _ = features._dist(batch['X'][:, :, 1], batch['x_mask'])
+    assert (batch['E_idx'] == E_idx).all()
+    assert torch.allclose(batch['E_dist'], D_neighbors)
+    for k in [20, 30]:
+        features_k = MultiChainProteinFeatures(node_features=8, edge_features=8, top_k=k)
+        batch_k = _package(proteins, featurize=(('knn_graph', k), 'gvp_data'))
+        assert (batch_k['E_idx'] == features_k._dist(batch['X'][:, :, 1], batch['x_mask'])[1]).all()
+        # the GVP featurizer searches short proteins for the same number of neighbors
+        short = _package([(_fake_protein('CCCC', [15]), 12), proteins[0]], featurize=(('knn_graph', k), 'gvp_data'))
+        assert [graph.edge_index.shape[1] for graph in short['gvp_data']] == [15 * 15, 40 * k]
+
+    # the GVP graph is taken from the collate-time graph
+    gvp_data = _package(proteins, featurize=('gvp_data', ))['gvp_data']
+    for reused, built in zip(batch['gvp_data'], gvp_data):
+        assert (reused.edge_index == built.edge_index).all()
+        assert torch.allclose(reused.edge_s, built.edge_s)
+
+    # merging pair energies through the reverse edges matches searching for them
+    h_E = torch.randn(E_idx.shape + (20, 20)) * batch['x_mask'].view(2, 45, 1, 1, 1)
+    merged = merge_duplicate_pairE(h_E, E_idx, E_reverse=batch['E_reverse'])
+    assert torch.allclose(merged, merge_duplicate_pairE(h_E, E_idx), atol=1e-6)
+
+
+@pytest.mark.parametrize("k", [30, 20])
+def test_packed_energies(k):
+    """ Test that the packed layout matches running the GNN Potts Model Encoder on each protein alone """
+    torch.manual_seed(0)
+    hparams = dict(DEFAULT_MODEL_HPARAMS, energies_input_dim=0, k_neighbors=k)
+    model = PairEnergies(hparams).eval()
+    proteins = [_fake_protein('AAAA', [40]), _fake_protein('BBBB', [20, 25], seed=1)]
+    featurize = featurization_plan(dict(hparams, energies_packed=True))
+    batch = _package([(p, p['term_lens'].sum()) for p in proteins], featurize=featurize)
+    seq_lens = batch['seq_lens']
+    knn_graph = pack_knn_graph(batch['E_idx'], batch['E_dist'], batch['E_reverse'], seq_lens)
+    with torch.no_grad():
+        etab, E_idx = model(None,
+                            None,
+                            pack(batch['X'], seq_lens),
+                            pack(batch['x_mask'], seq_lens),
+                            pack(batch['chain_idx'], seq_lens),
+                            knn_graph=knn_graph,
+                            cu_seqlens=cu_seqlens(seq_lens))
+    assert etab.shape[:2] == (1, sum(seq_lens))
+
+    # proteins shorter than k would have neighbors in the next protein once packed
+    short = _package([(p, p['term_lens'].sum()) for p in [_fake_protein('CCCC', [15]), proteins[0]]],
+                     featurize=featurize)
+    with pytest.raises(ValueError):
+        pack_knn_graph(short['E_idx'], short['E_dist'], short['E_reverse'], short['seq_lens'])
+    padded_etab, padded_E_idx = unpack(etab, seq_lens), unpack_knn_idx(E_idx, seq_lens)
+    for i, protein in enumerate(proteins):
+        alone = _package([(protein, protein['term_lens'].sum())], featurize=featurize)
+        with torch.no_grad():
+            alone_etab, alone_E_idx = model(None,
+                                            None,
+                                            alone['X'],
+                                            alone['x_mask'],
+                                            alone['chain_idx'],
+                                            knn_graph=(alone['E_idx'], alone['E_dist'], alone['E_reverse']))
+        n_res = protein['seq_len']
+        assert (padded_E_idx[i, :n_res] == alone_E_idx[0]).all()
+        assert torch.allclose(padded_etab[i, :n_res], alone_etab[0], atol=1e-5)
+
+    # losses are the same on the packed and padded etabs
+    data = {'seqs': batch['seqs'], 'x_mask': batch['x_mask'], 'seq_lens': seq_lens}
+    loss_fn = construct_loss_fn({'loss_config': {'nlcpl': 1, 'nlpl': 1, 'etab_norm_penalty': 1}})
+    packed_losses = loss_fn(etab, E_idx, data)
+    padded_losses = loss_fn(padded_etab, padded_E_idx, data)
+    for name, packed_loss in packed_losses.items():
+        assert torch.allclose(packed_loss['loss'], padded_losses[name]['loss'], atol=1e-5), name
+        assert packed_loss['count'] == padded_losses[name]['count'], name
+
+
+def test_unregistered_featurizer():
+    """ Test that unknown featurizers are rejected """
+    with pytest.raises(ValueError):
+        _check_featurization_plan(['not_a_featurizer'])
+
+
+def test_term_batch():
+    """ Test that batches behave as dictionaries and are moved in one buffer """
+    proteins = [_fake_protein('AAAA', [40]), _fake_protein('BBBB', [20, 25], seed=1)]
+    batch = _package([(p, p['term_lens'].sum()) for p in proteins], featurize=('knn_graph', 'gvp_data'))
+    assert isinstance(batch, TERMBatch)
+    assert 'gvp_data' in batch and 'geometric_data' not in batch
+    with pytest.raises(KeyError):
+        batch['geometric_data']  # pylint: disable=pointless-statement
+    assert pickle.loads(pickle.dumps(batch)).keys() == batch.keys()
+
+    moved = batch.to('cpu')
+    buffer = moved._buffer  # pylint: disable=protected-access
+    start, end = buffer.data_ptr(), buffer.data_ptr() + buffer.numel()
+    for key, value in batch.items():
+        if isinstance(value, torch.Tensor):
+            assert torch.equal(moved[key], value), key
+            assert start <= moved[key].data_ptr() < end or moved[key].numel() == 0, key
+    for moved_graph, graph in zip(moved['gvp_data'], batch['gvp_data']):
+        assert torch.equal(moved_graph.node_s, graph.node_s)
+        assert start <= moved_graph.edge_index.data_ptr() < end
+
+    # setting a field invalidates the buffer
+    moved['extra_field'] = torch.ones(3)
+    assert moved['extra_field'].sum() == 3
+    assert moved._buffer is None  # pylint: disable=protected-access
+
+    # batches stay TERMBatches through a DataLoader and are moved in one buffer
+    loaded = next(iter(torch.utils.data.DataLoader([batch], batch_size=None, collate_fn=keep_batch)))
+    assert isinstance(loaded, TERMBatch)
+    assert isinstance(_to_dev(loaded, 'cpu'), TERMBatch)
+    if torch.cuda.is_available():
+        pinned = batch.pin_memory()
+        assert isinstance(pinned, TERMBatch) and pinned._buffer.is_pinned()  # pylint: disable=protected-access
+        on_device = _to_dev(batch, 'cuda')
+        assert isinstance(on_device, TERMBatch) and on_device['X'].is_cuda
+
+    protein = batch.protein(0)
+    assert protein['ids'] == 'AAAA'
+    assert protein['X'].shape == (40, 4, 3)
+    assert protein['features'].shape == (3, proteins[0]['term_lens'].sum(), 9)
+
+
+def test_shard_store_roundtrip(tmp_path):
+    """ Test that proteins read back from a shard store match the original feature files """
+    in_folder, out_folder = tmp_path / "features", tmp_path / "shards"
+    proteins = [p for p, _ in _fake_batch()]
+    _write_features(in_folder, proteins)
+    write_shard_store(str(in_folder), str(out_folder), shard_size=1)
+
+    dataset = TERMShardDataset(str(out_folder), pdb_ids=['BBBB'])
+    assert len(dataset) == 1
+    key, total_term_len, seq_len = dataset[0]
+    assert (total_term_len, seq_len) == (proteins[1]['term_lens'].sum(), 45)
+    loaded = dataset.load(key)
+    for field, value in proteins[1].items():
+        assert np.array_equal(np.asarray(loaded[field]), np.asarray(value)), field
+
+    sampler = TERMLazyBatchSampler(TERMShardDataset(str(out_folder)), batch_size=2, shuffle=False)
+    batch = sampler.package([sampler.dataset[i] for i in range(len(sampler.dataset))])
+    assert sorted(batch['ids']) == ['AAAA', 'BBBB']
+
+    # loading a batch from the I/O thread pool matches loading it serially
+    serial_sampler = TERMLazyBatchSampler(TERMShardDataset(str(out_folder)),
+                                          batch_size=2,
+                                          shuffle=False,
+                                          batch_shuffle=False,
+                                          io_threads=1)
+    sampler.batch_shuffle = False
+    b_idx = [sampler.dataset[i] for i in range(len(sampler.dataset))]
+    batch, serial_batch = sampler.package(b_idx), serial_sampler.package(b_idx)
+    assert batch['ids'] == serial_batch['ids']
+    assert torch.equal(batch['features'], serial_batch['features'])
+
+
+def test_manifest(tmp_path):
+    """ Test that the dataset manifest selects proteins like the feature files would and notices stale entries """
+    proteins = [_fake_protein(name, [seq_len], seed=i) for i, (name, seq_len) in enumerate([('AAAA', 40), ('BBBB', 20),
+                                                                                              ('CCCC', 50)])]
+    _write_features(tmp_path, proteins)
+    build_manifest(str(tmp_path), num_processes=1)
+
+    # split order is kept and short proteins are dropped
+    entries = read_manifest(str(tmp_path), pdb_ids=['CCCC', 'BBBB', 'AAAA'])
+    assert [pdb_id for pdb_id, _, _ in entries] == ['CCCC', 'AAAA']
+    assert entries[0] == ('CCCC', proteins[2]['term_lens'].sum(), 50)
+
+    # rewriting a feature file is picked up on the next read
+    proteins[1]['seq_len'] = 45
+    _write_features(tmp_path, proteins[1:2])
+    os.utime(tmp_path / 'BBBB' / 'BBBB.features', ns=(0, 0))
+    entries = read_manifest(str(tmp_path), num_processes=1)
+    assert [pdb_id for pdb_id, _, _ in entries] == ['AAAA', 'BBBB', 'CCCC']
+    assert DatasetManifest.load(str(tmp_path)).seq_lens.tolist() == [40, 45, 50]
+
+    # deleted feature files are dropped from the manifest
+    os.remove(tmp_path / 'BBBB' / 'BBBB.features')
+    assert [pdb_id for pdb_id, _, _ in read_manifest(str(tmp_path), num_processes=1)] == ['AAAA', 'CCCC']
+    assert DatasetManifest.load(str(tmp_path)).pdb_ids.tolist() == ['AAAA', 'CCCC']
+    assert len(TERMLazyDataset(str(tmp_path), num_processes=1)) == 2
+
+
+def test_incremental_registration(tmp_path):
+    """ Test that proteins registered or removed after loading are picked up by refreshing the lazy dataset """
+    proteins = [_fake_protein(name, [40], seed=i) for i, name in enumerate(['AAAA', 'BBBB', 'CCCC'])]
+    _write_features(tmp_path, proteins)
+    register_proteins(str(tmp_path), ['AAAA', 'BBBB'], num_processes=1)
+
+    dataset = TERMLazyDataset(str(tmp_path), num_processes=1)
+    sampler = TERMLazyBatchSampler(dataset, batch_size=1, shuffle=False)
+    assert len(dataset) == 2
+    assert not dataset.refresh()
+
+    register_proteins(str(tmp_path), ['CCCC'], num_processes=1)
+    os.utime(tmp_path / 'manifest.tsv', ns=(0, 0))  # mtimes may not tick between quick writes
+    assert dataset.refresh()
+    sampler.refresh()
+    assert sorted(os.path.basename(key) for key, _, _ in dataset.dataset) == [
+        'AAAA.features', 'BBBB.features', 'CCCC.features'
+    ]
+    assert len(sampler) == 3
+
+    unregister_proteins(str(tmp_path), ['AAAA'])
+    assert dataset.refresh()
+    assert len(dataset) == 2
+    # a new split is applied even without manifest changes
+    assert dataset.refresh(pdb_ids=['CCCC'])
+    sampler.refresh()
+    assert len(sampler) == 1 and sampler.package(dataset.dataset)['ids'] == ['CCCC']
+
+
+def test_bin_pack():
+    """ Test that bin packing covers every datapoint once and respects every budget """
+    rng = np.random.default_rng(0)
+    seq_lengths = rng.integers(30, 500, size=1000)
+    term_lengths = seq_lengths * rng.integers(2, 6, size=1000)
+    budgets = {'max_term_res': 20000, 'max_seq_tokens': 4000, 'max_seq_pairs': 600000}
+    clusters = _bin_pack(rng.permutation(1000), term_lengths, seq_lengths, bucket_size=200, **budgets)
+
+    assert sorted(idx for batch in clusters for idx in batch) == list(range(1000))
+    for batch in clusters:
+        assert term_lengths[batch].max() * len(batch) <= budgets['max_term_res']
+        assert seq_lengths[batch].max() * len(batch) <= budgets['max_seq_tokens']
+        assert seq_lengths[batch].max()**2 * len(batch) <= budgets['max_seq_pairs']
+    assert _padding_efficiency(clusters, seq_lengths) > 0.9
+
+
+@pytest.mark.parametrize("term_dropout", [None, 'keep_first', 'all'])
+def test_term_matches_cutoff(tmp_path, term_dropout):
+    """ Test that only the top TERM matches are loaded, and that dropout only keeps a prefix of those """
+    proteins = [_fake_protein(name, [40], n_matches=5, seed=i) for i, name in enumerate(['AAAA', 'BBBB'])]
+    _write_features(tmp_path / "features", proteins)
+    write_shard_store(str(tmp_path / "features"), str(tmp_path / "shards"))
+    dataset = TERMShardDataset(str(tmp_path / "shards"))
+    assert dataset.load(dataset[0][0], num_matches=3)['features'].shape[0] == 3
+
+    sampler = TERMLazyBatchSampler(dataset, batch_size=2, shuffle=False, term_matches_cutoff=3,
+                                   term_dropout=term_dropout)
+    batch = sampler.package([dataset[0], dataset[1]])
+    n_kept = batch['features'].shape[1]
+    assert batch['msas'].shape[1] == n_kept
+    if term_dropout is None:
+        assert n_kept == 3
+    else:
+        assert 1 <= n_kept <= 3
+    if term_dropout == 'keep_first':
+        first = np.stack([p['msas'][0] for p in proteins]) if batch['ids'] == ['AAAA', 'BBBB'] else \
+            np.stack([p['msas'][0] for p in proteins[::-1]])
+        assert np.array_equal(batch['msas'][:, 0].numpy(), first)
+
+
+def test_distributed_batch_sampler():
+    """ Test that ranks get disjoint batches covering the dataset, with the same number of steps """
+    rng = np.random.default_rng(0)
+    seq_lens = rng.integers(30, 300, size=101).tolist()
+    dataset = [(f"{i:04d}", 3 * seq_len, seq_len) for i, seq_len in enumerate(seq_lens)]
+    samplers = [
+        DistributedBatchSampler(TERMLazyBatchSampler(dataset, batch_size=None, max_seq_tokens=1000, max_term_res=None,
+                                                     bin_pack=True),
+                                num_replicas=3,
+                                rank=rank,
+                                seed=1) for rank in range(3)
+    ]
+    for epoch in range(2):
+        for sampler in samplers:
+            sampler.set_epoch(epoch)
+        batches = [list(sampler) for sampler in samplers]
+        assert len({len(rank_batches) for rank_batches in batches}) == 1
+        seen = [idx for rank_batches in batches for batch in rank_batches for idx in batch]
+        assert set(seen) == set(range(len(dataset)))
+        # only batches repeated to fill the last step may be seen twice
+        assert len(seen) - len(dataset) <= max(len(batch) for rank_batches in batches for batch in rank_batches) * 2
+    # batches are a deterministic function of the seed and epoch
+    assert batches == [list(sampler) for sampler in samplers]
+
+    # the number of steps follows the batches of each epoch
+    seq_lens = rng.integers(30, 300, size=301).tolist()
+    dataset = [(f"{i:04d}", 3 * seq_len, seq_len) for i, seq_len in enumerate(seq_lens)]
+    sampler = DistributedBatchSampler(TERMLazyBatchSampler(dataset, batch_size=None, max_seq_tokens=1000,
+                                                           max_term_res=None),
+                                      num_replicas=2,
+                                      rank=0)
+    for epoch in range(6):
+        sampler.set_epoch(epoch)
+        assert len(sampler) == len(list(sampler))
+
+    # with fewer batches than ranks, batches are repeated to fill the step, or all dropped
+    for drop_last, num_steps in [(False, 1), (True, 0)]:
+        samplers = [
+            DistributedBatchSampler(TERMLazyBatchSampler([("0000", 90, 30)], batch_size=None, max_seq_tokens=1000,
+                                                         max_term_res=None),
+                                    num_replicas=4,
+                                    rank=rank,
+                                    drop_last=drop_last) for rank in range(4)
+        ]
+        assert [list(sampler) for sampler in samplers] == [[[0]] * num_steps] * 4
+        assert [len(sampler) for sampler in samplers] == [num_steps] * 4
+
+
+def test_shared_memory_dataset(tmp_path):
+    """ Test that the in-memory dataset serves its features from shared memory """
+    proteins = [p for p, _ in _fake_batch()]
+    _write_features(tmp_path, proteins)
+    dataset = TERMDataset(str(tmp_path), pdb_ids=['AAAA', 'BBBB'], num_processes=2)
+    assert all(tensor.is_shared() for tensor in dataset.arena.tensors.values())
+
+    for protein, (data, total_term_len, seq_len) in zip(proteins, dataset):
+        assert (total_term_len, seq_len) == (protein['term_lens'].sum(), protein['seq_len'])
+        for field, value in protein.items():
+            assert np.array_equal(np.asarray(data[field]), np.asarray(value)), field
+
+    sampler = TERMBatchSampler(dataset, batch_size=2, shuffle=False)
+    batch = sampler.package([dataset[i] for i in sampler.clusters[0]])
+    assert batch['X'].shape == (2, 45, 4, 3)
+
+
+def test_cached_dataset(tmp_path, monkeypatch):
+    """ Test that the cache serves repeated loads, keeps within its budget and evicts the least recently used """
+    proteins = [_fake_protein(name, [40], seed=i) for i, name in enumerate(['AAAA', 'BBBB', 'CCCC'])]
+    _write_features(tmp_path / "features", proteins)
+    write_shard_store(str(tmp_path / "features"), str(tmp_path / "shards"))
+    shard_dataset = TERMShardDataset(str(tmp_path / "shards"))
+    entry_bytes = sum(value.nbytes for value in shard_dataset.load(shard_dataset[0][0]).values()
+                      if isinstance(value, np.ndarray))
+    dataset = TERMCachedDataset(shard_dataset, cache_bytes=2 * entry_bytes, cache_dir=str(tmp_path / "cache"))
+
+    keys = [dataset[i][0] for i in range(3)]
+    for key in keys[:2] + keys[:2]:
+        dataset.load(key)
+    loaded = dataset.load(keys[0], num_matches=2)
+    assert np.array_equal(loaded['msas'], proteins[0]['msas'][:2])
+    assert loaded['chain_lens'] == [40]
+    stats = dataset.cache_stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (3, 2, 0)
+
+    # BBBB is the least recently used, so it is evicted to make room for CCCC
+    dataset.load(keys[2])
+    assert dataset.cache_stats()['evictions'] == 1
+    assert dataset.cache_stats()['cached_bytes'] <= 2 * entry_bytes
+    dataset.load(keys[0])
+    assert dataset.cache_stats()['hits'] == 4
+
+    # an entry evicted by another worker while being read is served from the arrays already mapped
+    def evicting_touch(entry_dir):
+        shutil.rmtree(entry_dir)
+        os.utime(entry_dir)
+
+    monkeypatch.setattr(cache, '_touch', evicting_touch)
+    loaded = dataset.load(keys[0])
+    assert np.array_equal(loaded['msas'], proteins[0]['msas'])
+    assert dataset.cache_stats()['hits'] == 5
+
+
+def test_prefetch_iterator():
+    """ Test that prefetching yields every batch in order and surfaces loader errors """
+    proteins = _fake_batch()
+    batches = [_package(proteins[:1]), _package(proteins[1:]), _package(proteins)]
+    prefetched = list(PrefetchIterator(batches, 'cpu', depth=2))
+    assert [batch['ids'] for batch in prefetched] == [['AAAA'], ['BBBB'], ['AAAA', 'BBBB']]
+    assert prefetched[2]['scatter_idx'].tolist() == [0, 1]
+
+    # stopping early does not hang on the background thread
+    for _ in PrefetchIterator(batches, 'cpu', depth=1):
+        break
+
+    def broken_loader():
+        yield batches[0]
+        raise RuntimeError("unreadable batch")
+
+    with pytest.raises(RuntimeError):
+        list(PrefetchIterator(broken_loader(), 'cpu'))
+
+
+def test_stream_dataset(tmp_path, monkeypatch):
+    """ Test that a tar store streams every selected protein once per epoch, within the batch budget """
+    proteins = [_fake_protein(f"P{i:03d}", [30 + 5 * i], seed=i) for i in range(10)]
+    _write_features(tmp_path / "features", proteins)
+    write_tar_store(str(tmp_path / "features"), str(tmp_path / "tar"), shard_size=3)
+
+    dataset = TERMStreamDataset(str(tmp_path / "tar"), pdb_ids=['P002', 'P000', 'P005'], batch_size=1, shuffle=False)
+    batches = list(dataset)
+    assert [batch['ids'] for batch in batches] == [['P000'], ['P002'], ['P005']]
+    assert torch.equal(batches[1]['features'], _package([(proteins[2], proteins[2]['term_lens'].sum())])['features'])
+
+    dataset = TERMStreamDataset(str(tmp_path / "tar"), max_term_res=200, shuffle_buffer=4, sort_window=5)
+    epochs = []
+    for epoch in range(2):
+        dataset.set_epoch(epoch)
+        batches = list(dataset)
+        assert all(len(batch['ids']) == 1 or batch['src_key_mask'].numel() <= 200 for batch in batches)
+        epochs.append([pdb_id for batch in batches for pdb_id in batch['ids']])
+        assert sorted(epochs[-1]) == [protein['pdb'] for protein in proteins]
+    assert epochs[0] != epochs[1]
+
+    # TERM match dropout applies as with batch samplers
+    dataset = TERMStreamDataset(str(tmp_path / "tar"), batch_size=1, shuffle=False, term_dropout='keep_first')
+    torch.manual_seed(0)
+    for batch, protein in zip(dataset, proteins):
+        full = _package([(protein, protein['term_lens'].sum())])
+        assert batch['features'].shape[1] <= full['features'].shape[1]
+        assert torch.equal(batch['features'][:, 0], full['features'][:, 0])
+        assert torch.equal(batch['msas'][:, 0], full['msas'][:, 0])
+
+    # ranks would run unequal numbers of steps, so streaming refuses distributed training
+    monkeypatch.setattr(torch.distributed, "is_initialized", lambda: True)
+    monkeypatch.setattr(torch.distributed, "get_world_size", lambda: 2)
+    with pytest.raises(RuntimeError, match="distributed"):
+        list(dataset)
+
+
+def test_compact_features(tmp_path):
+    """ Test that compact feature dictionaries are smaller and package into the same batches """
+    proteins = [p for p, _ in _fake_batch()]
+    compact = [compact_features(p) for p in proteins]
+    assert compact[0]['msas'].dtype == np.uint8 and compact[0]['focuses'].dtype == np.int16
+    def nbytes(protein):
+        return sum(value.nbytes for value in protein.values() if isinstance(value, np.ndarray))
+
+    assert nbytes(compact[0]) * 2 < nbytes(proteins[0])
+
+    # the near-zero RMSD of dummy TERMs must not round to 0, which marks padding
+    dummy = dict(proteins[0], features=proteins[0]['features'].copy())
+    dummy['features'][0, :, 7] = 1e-10
+    for float_dtype in [np.float32, np.float16]:
+        rmsds = compact_features(dummy, float_dtype=float_dtype)['features'][..., 7]
+        assert (rmsds[0] > 0).all()
+        assert np.array_equal(rmsds[1:] == 0, dummy['features'][1:, :, 7] == 0)
+
+    batch = _package([(p, p['term_lens'].sum()) for p in proteins])
+    compact_batch = _package([(p, p['term_lens'].sum()) for p in compact])
+    for key, value in batch.items():
+        if isinstance(value, torch.Tensor):
+            assert value.dtype == compact_batch[key].dtype, key
+            assert torch.equal(value, compact_batch[key]), key
+
+    # compact shard stores load like any other
+    _write_features(tmp_path / "features", proteins)
+    write_shard_store(str(tmp_path / "features"), str(tmp_path / "shards"), compact='float16')
+    dataset = TERMShardDataset(str(tmp_path / "shards"))
+    loaded = dataset.load(dataset[0][0])
+    assert loaded['features'].dtype == np.float16
+    assert np.allclose(loaded['features'], proteins[0]['features'], atol=1e-2, rtol=1e-2)
+
+
+def test_match_store(tmp_path):
+    """ Test that a match store stores shared matches once and resolves them to the original features """
+    proteins = [p for p, _ in _fake_batch()]
+    # share the first TERM's matches between both proteins, as if mined from the same database
+    shared = slice(0, proteins[0]['term_lens'][0])
+    proteins[1]['msas'][:, shared] = proteins[0]['msas'][:, shared]
+    proteins[1]['features'][:, shared, :7] = proteins[0]['features'][:, shared, :7]
+    for protein in proteins:
+        # RMSD and TERM length are constant within each TERM match
+        term_of_res = np.repeat(np.arange(len(protein['term_lens'])), protein['term_lens'])
+        protein['features'][:, :, 7] = protein['features'][:, term_of_res, 7]
+        protein['features'][:, :, 8] = protein['term_lens'][term_of_res]
+    _write_features(tmp_path / "features", proteins)
+
+    table = write_match_store(str(tmp_path / "features"), str(tmp_path / "matches"), num_processes=1)
+    n_terms = sum(len(protein['term_lens']) for protein in proteins)
+    assert table.num_matches == 3 * n_terms
+    assert table.num_unique == 3 * (n_terms - 1)
+
+    dataset = TERMMatchStoreDataset(str(tmp_path / "matches"), num_processes=1)
+    for key, _, _ in dataset:
+        loaded = dataset.load(key, num_matches=2)
+        protein = proteins[[p['pdb'] for p in proteins].index(loaded['pdb'])]
+        assert np.array_equal(loaded['msas'], protein['msas'][:2])
+        assert np.allclose(loaded['features'], protein['features'][:2])
+
+
+def test_parse_term_data(tmp_path):
+    """ Test that .dat files are parsed in full, truncated to the top matches and in parallel """
+    dat = tmp_path / "test.dat"
+    dat.write_text("ACDE\n"
+                   "0 1 2 3\n"
+                   "999 10 20 0.5\n"
+                   "-60 -40 180 0.25\n"
+                   "999 -60 180 0.75\n"
+                   "-120 130 180 1.5\n"
+                   "* TERM 0\n"
+                   "0 1 2\n"
+                   "ACD 0.1 1 2 3 4 5 6 7 8 9 10 11 12\n"
+                   "WXY 0.2 -1 -2 -3 -4 -5 -6 -7 -8 -9 -10 -11 -12\n"
+                   "GGG 0.3 0 0 0 0 0 0 0 0 0 0 0 0\n"
+                   "* TERM 5\n"
+                   "0 2\n"
+                   "KL 1.5 1 2 3 4 5 6 7 8\n")
+    data = parse_term_data(str(dat))
+    assert data['sequence'] == seq_to_ints("ACDE")
+    assert data['selection'] == [0, 1, 2, 3]
+    assert data['chain_lens'] == [2, 2]
+    assert np.array_equal(data['ppoe'][1], [-60, -40, 180, 0.25])
+    assert [term['idx'] for term in data['terms']] == [0, 5]
+
+    term = data['terms'][0]
+    assert term['focus'] == [0, 1, 2]
+    assert term['contact_idx'] == contact_idx([0, 1, 2])
+    assert np.array_equal(term['labels'], [seq_to_ints(seq) for seq in ["ACD", "WXY", "GGG"]])
+    assert np.array_equal(term['rmsds'], [0.1, 0.2, 0.3])
+    assert np.array_equal(term['ppoe'][1], -np.arange(1, 13).reshape(4, 3))
+    assert data['terms'][1]['ppoe'].shape == (1, 4, 2)
+
+    truncated = parse_term_data(str(dat), max_matches=2)
+    for term, full in zip(truncated['terms'], data['terms']):
+        for key in ['labels', 'rmsds', 'ppoe']:
+            assert np.array_equal(term[key], full[key][:2])
+
+    assert np.array_equal(index_terms(str(dat))[[0, -1]], [dat.read_text().index("* TERM"), dat.stat().st_size])
+    for max_matches, parsed in [(None, data), (2, truncated)]:
+        parallel = parse_term_data(str(dat), max_matches=max_matches, num_processes=2, num_chunks=2)
+        assert [term['idx'] for term in parallel['terms']] == [0, 5]
+        for term, serial in zip(parallel['terms'], parsed['terms']):
+            for key in ['labels', 'rmsds', 'ppoe']:
+                assert np.array_equal(term[key], serial[key])
+
+
+def test_read_backbone(tmp_path):
+    """ Test that PDB backbones are grouped by chain, with OXT standing in for a missing O """
+    def atom(serial, name, resname, chain, res_id, xyz, record='ATOM'):
+        return (f"{record:<6}{serial:5d} {name:<4} {resname:>3} {chain}{res_id:>5}   "
+                f"{xyz[0]:8.3f}{xyz[1]:8.3f}{xyz[2]:8.3f}  1.00  0.00\n")
+
+    residues = [('B', '1', 'ALA', ['N', 'CA', 'C', 'O']), ('A', '7', 'MSE', ['N', 'CA', 'C', 'O']),
+                ('B', '2A', 'GLY', ['N', 'CA', 'C', 'OXT']), ('A', '8', 'LYS', ['N', 'CA', 'C', 'O', 'OXT'])]
+    lines = ["REMARK test\n"]
+    for i, (chain, res_id, resname, names) in enumerate(residues):
+        for j, name in enumerate(names):
+            record = 'HETATM' if resname == 'MSE' else 'ATOM'
+            lines.append(atom(len(lines), f" {name}", resname, chain, res_id, (i, j, -1.5), record=record))
+    lines.append(atom(len(lines), "CA", " CA", 'A', '100', (9, 9, 9), record='HETATM'))
+    lines.append("TER\n")
+    pdb = tmp_path / "test.pdb"
+    pdb.write_text(''.join(lines))
+
+    records = read_pdb_records(str(pdb))
+    assert records['record'][[0, 1, -1]].tolist() == ['REMARK', 'ATOM', 'TER']
+    assert np.isnan(records['xyz'][0]).all()
+
+    backbone = read_backbone(str(pdb))
+    assert backbone['chain_ids'] == ['B', 'A']
+    assert backbone['chain_lens'] == [2, 2]
+    assert backbone['sequence'] == "AGMK"
+    assert backbone['residue_ids'] == [('B', '1'), ('B', '2A'), ('A', '7'), ('A', '8')]
+    assert backbone['coords'].shape == (4, 4, 3)
+    # OXT is only used if there is no O
+    assert np.array_equal(backbone['coords'][1, :, 1], [0, 1, 2, 3])
+    assert np.array_equal(backbone['coords'][3, :, 1], [0, 1, 2, 3])
+    assert np.array_equal(backbone['coords'][2, :, 0], [1, 1, 1, 1])
+
+    # drop the C of GLY
+    pdb.write_text(''.join(lines[:11] + lines[12:]))
+    with pytest.raises(ValueError, match="missing backbone atoms"):
+        read_backbone(str(pdb))
@@ -16,7 +16,8 @@ from torch import nn
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
-from terminator.data.data import (TERMLazyDataset, TERMBatchSampler, TERMDataset, TERMLazyBatchSampler)
+from terminator.data.data import (TERMLazyDataset, TERMBatchSampler, TERMDataset, TERMLazyBatchSampler,
+                                  featurization_plan)
 from terminator.models.TERMinator import TERMinator
 from terminator.utils.model.default_hparams import DEFAULT_MODEL_HPARAMS, DEFAULT_TRAIN_HPARAMS
 from terminator.utils.model.loop_utils import run_epoch
@@ -77,13 +78,15 @@ def _setup_hparams(args):
     return model_hparams, run_hparams
 
 
-def _setup_dataloaders(args, run_hparams):
+def _setup_dataloaders(args, model_hparams, run_hparams):
     """ Setup dataloaders needed for training
 
     Args
     ----
     args : argparse.Namespace
         Parsed arguments
+    model_hparams : dict
+        Fully configured model hparams dictionary (see :code:`terminator/utils/model/default_hparams.py`)
     run_hparams : dict
         Fully configured hparams dictionary (see :code:`terminator/utils/model/default_hparams.py`)
 
@@ -94,6 +97,9 @@ def _setup_dataloaders(args, run_hparams):
     """
     kwargs = {}
     kwargs['num_workers'] = 16
+    # only compute the optional graph features the model will consume
+    featurize = featurization_plan(model_hparams)
+    train_featurize = featurization_plan(model_hparams, training=True)
 
     # set up dataloaders
     train_ids = args.train
@@ -113,7 +119,10 @@ def _setup_dataloaders(args, run_hparams):
                                                    term_matches_cutoff=run_hparams['term_matches_cutoff'],
                                                    max_term_res=run_hparams['max_term_res'],
                                                    max_seq_tokens=run_hparams['max_seq_tokens'],
-                                                   term_dropout=run_hparams['term_dropout'])
+                                                   max_seq_pairs=run_hparams['max_seq_pairs'],
+                                                   bin_pack=run_hparams['bin_pack'],
+                                                   term_dropout=run_hparams['term_dropout'],
+                                                   featurize=train_featurize)
         if 'test_term_matches_cutoff' in run_hparams:
             test_term_matches_cutoff = run_hparams['test_term_matches_cutoff']
         else:
@@ -121,11 +130,13 @@ def _setup_dataloaders(args, run_hparams):
         val_batch_sampler = TERMLazyBatchSampler(val_dataset,
                                                  batch_size=1,
                                                  shuffle=False,
-                                                 term_matches_cutoff=test_term_matches_cutoff)
+                                                 term_matches_cutoff=test_term_matches_cutoff,
+                                                 featurize=featurize)
         test_batch_sampler = TERMLazyBatchSampler(test_dataset,
                                                   batch_size=1,
                                                   shuffle=False,
-                                                  term_matches_cutoff=test_term_matches_cutoff)
+                                                  term_matches_cutoff=test_term_matches_cutoff,
+                                                  featurize=featurize)
     else:
         train_dataset = TERMDataset(args.dataset, pdb_ids=train_ids)
         val_dataset = TERMDataset(args.dataset, pdb_ids=validation_ids)
@@ -137,19 +148,20 @@ def _setup_dataloaders(args, run_hparams):
                                                semi_shuffle=run_hparams['semi_shuffle'],
                                                sort_data=run_hparams['sort_data'],
                                                max_term_res=run_hparams['max_term_res'],
-                                               max_seq_tokens=run_hparams['max_seq_tokens'])
-        val_batch_sampler = TERMBatchSampler(val_dataset, batch_size=1, shuffle=False)
-        test_batch_sampler = TERMBatchSampler(test_dataset, batch_size=1, shuffle=False)
+                                               max_seq_tokens=run_hparams['max_seq_tokens'],
+                                               max_seq_pairs=run_hparams['max_seq_pairs'],
+                                               bin_pack=run_hparams['bin_pack'],
+                                               featurize=train_featurize)
+        val_batch_sampler = TERMBatchSampler(val_dataset, batch_size=1, shuffle=False, featurize=featurize)
+        test_batch_sampler = TERMBatchSampler(test_dataset, batch_size=1, shuffle=False, featurize=featurize)
 
     train_dataloader = DataLoader(train_dataset,
                                   batch_sampler=train_batch_sampler,
                                   collate_fn=train_batch_sampler.package,
-                                  pin_memory=True,
                                   **kwargs)
     val_dataloader = DataLoader(val_dataset,
                                 batch_sampler=val_batch_sampler,
                                 collate_fn=val_batch_sampler.package,
-                                pin_memory=True,
                                 **kwargs)
     test_dataloader = DataLoader(test_dataset,
                                  batch_sampler=test_batch_sampler,
@@ -309,8 +321,8 @@ def test_load_data():
     """ Test creating the dataloaders """
     args = _gen_hparam_args("./data/hparams/coordinator_model_hparams.json",
                             "./data/hparams/coordinator_run_hparams.json")
-    _, run_hparams = _setup_hparams(args)
-    return _setup_dataloaders(args, run_hparams)
+    model_hparams, run_hparams = _setup_hparams(args)
+    return _setup_dataloaders(args, model_hparams, run_hparams)
 
 
 def test_train_terminator():
@@ -319,7 +331,7 @@ def test_train_terminator():
                             "./data/hparams/terminator_run_hparams.json")
     model_hparams, run_hparams = _setup_hparams(args)
     terminator, _ = _setup_model(model_hparams, None, dev="cpu")
-    train_dl, _, _ = _setup_dataloaders(args, run_hparams)
+    train_dl, _, _ = _setup_dataloaders(args, model_hparams, run_hparams)
     loss_fn = construct_loss_fn(run_hparams)
     optimizer = get_std_opt(terminator.parameters(),
                             d_model=model_hparams['energies_hidden_dim'],
@@ -343,7 +355,7 @@ def test_val_terminator():
                             "./data/hparams/terminator_run_hparams.json")
     model_hparams, run_hparams = _setup_hparams(args)
     terminator, _ = _setup_model(model_hparams, None, dev="cpu")
-    _, val_dl, _ = _setup_dataloaders(args, run_hparams)
+    _, val_dl, _ = _setup_dataloaders(args, model_hparams, run_hparams)
     loss_fn = construct_loss_fn(run_hparams)
     epoch_loss, _, _ = run_epoch(terminator,
                                  val_dl,
@@ -359,7 +371,7 @@ def test_inf_terminator():
                             "./data/hparams/terminator_run_hparams.json")
     model_hparams, run_hparams = _setup_hparams(args)
     terminator, _ = _setup_model(model_hparams, None, dev="cpu")
-    _, _, test_dl = _setup_dataloaders(args, run_hparams)
+    _, _, test_dl = _setup_dataloaders(args, model_hparams, run_hparams)
     loss_fn = construct_loss_fn(run_hparams)
     run_epoch(terminator,
               test_dl,
@@ -376,7 +388,7 @@ def test_train_coordinator():
                             "./data/hparams/coordinator_run_hparams.json")
     model_hparams, run_hparams = _setup_hparams(args)
     coordinator, _ = _setup_model(model_hparams, None, dev="cpu")
-    train_dl, _, _ = _setup_dataloaders(args, run_hparams)
+    train_dl, _, _ = _setup_dataloaders(args, model_hparams, run_hparams)
     loss_fn = construct_loss_fn(run_hparams)
     optimizer = get_std_opt(coordinator.parameters(),
                             d_model=model_hparams['energies_hidden_dim'],
@@ -400,7 +412,7 @@ def test_val_coordinator():
                             "./data/hparams/coordinator_run_hparams.json")
     model_hparams, run_hparams = _setup_hparams(args)
     coordinator, _ = _setup_model(model_hparams, None, dev="cpu")
-    _, val_dl, _ = _setup_dataloaders(args, run_hparams)
+    _, val_dl, _ = _setup_dataloaders(args, model_hparams, run_hparams)
     loss_fn = construct_loss_fn(run_hparams)
     epoch_loss, _, _ = run_epoch(coordinator,
                                  val_dl,
@@ -416,7 +428,7 @@ def test_inf_coordinator():
                             "./data/hparams/coordinator_run_hparams.json")
     model_hparams, run_hparams = _setup_hparams(args)
     coordinator, _ = _setup_model(model_hparams, None, dev="cpu")
-    _, _, test_dl = _setup_dataloaders(args, run_hparams)
+    _, _, test_dl = _setup_dataloaders(args, model_hparams, run_hparams)
     loss_fn = construct_loss_fn(run_hparams)
     run_epoch(coordinator,
               test_dl,
@@ -0,0 +1,192 @@
+""" Preprocessing test suite
+
+A collection of tests to ensure that the preprocessing scripts in :code:`scripts/data/preprocessing` work.
+"""
+
+import concurrent.futures
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+from terminator.utils.common import seq_to_ints
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../scripts/data/preprocessing'))
+import packageTensors  # pylint: disable=wrong-import-position
+import taskRunner  # pylint: disable=wrong-import-position
+
+# pylint: disable=unspecified-encoding
+
+
+def _task(folder, name, mode='ok'):
+    """ Task recording each of its attempts in :code:`<folder>/<name>`
+
+    Args
+    ----
+    folder : str
+        Folder to record attempts in
+    name : str
+        Name of the task
+    mode : str
+        :code:`ok` to succeed, :code:`slow` to succeed after a while, :code:`fail` to raise, :code:`flaky` to raise
+        on the first attempt only, or :code:`die` to kill the worker process on the first attempt only
+    """
+    path = os.path.join(folder, name)
+    with open(path, 'a') as fp:
+        fp.write('.')
+    with open(path) as fp:
+        attempts = len(fp.read())
+    if mode == 'fail' or (mode == 'flaky' and attempts == 1):
+        raise RuntimeError(f"{name} failed")
+    if mode == 'die' and attempts == 1:
+        os._exit(1)  # pylint: disable=protected-access
+    if mode == 'slow':
+        time.sleep(0.2)
+
+
+def _attempts(folder, name):
+    """ Number of attempts recorded by :code:`_task` """
+    path = os.path.join(folder, name)
+    if not os.path.exists(path):
+        return 0
+    with open(path) as fp:
+        return len(fp.read())
+
+
+def test_run_tasks_resume(tmp_path):
+    """ Test that tasks are resumed from the job manifest, skipping tasks done or failed unless asked """
+    jobs_path = str(tmp_path / "jobs.jsonl")
+    tasks = {name: (str(tmp_path), name, mode) for name, mode in [('a', 'ok'), ('b', 'fail'), ('c', 'ok')]}
+    records = taskRunner.run_tasks(_task, tasks, jobs_path, num_processes=2)
+    assert {task: record['status'] for task, record in records.items()} == {'a': 'done', 'b': 'failed', 'c': 'done'}
+    assert 'b failed' in records['b']['error']
+    assert taskRunner.read_jobs(jobs_path) == records
+
+    # an interrupted run left c running and d was never started
+    jobs = taskRunner.JobManifest(jobs_path)
+    jobs.update('c', status='running')
+    jobs.close()
+    tasks['d'] = (str(tmp_path), 'd', 'ok')
+    records = taskRunner.run_tasks(_task, tasks, jobs_path, num_processes=2)
+    assert [_attempts(tmp_path, name) for name in 'abcd'] == [1, 1, 2, 1]
+    assert records['b']['status'] == 'failed' and records['d']['status'] == 'done'
+
+    # failed tasks are only retried when asked
+    tasks['b'] = (str(tmp_path), 'b', 'ok')
+    records = taskRunner.run_tasks(_task, tasks, jobs_path, num_processes=2, retry_failed=True)
+    assert [_attempts(tmp_path, name) for name in 'abcd'] == [1, 2, 2, 1]
+    assert all(record['status'] == 'done' for record in records.values())
+    assert records['b']['attempts'] == 2 and records['b']['error'] is None
+
+
+def test_run_tasks_retries(tmp_path):
+    """ Test that failed tasks are retried up to :code:`max_retries` times """
+    tasks = {name: (str(tmp_path), name, mode) for name, mode in [('a', 'flaky'), ('b', 'fail'), ('c', 'ok')]}
+    records = taskRunner.run_tasks(_task, tasks, str(tmp_path / "jobs.jsonl"), max_retries=2)
+    assert [_attempts(tmp_path, name) for name in 'abc'] == [2, 3, 1]
+    assert [records[name]['status'] for name in 'abc'] == ['done', 'failed', 'done']
+    assert records['b']['attempts'] == 3
+
+
+def test_run_tasks_dead_worker(tmp_path, monkeypatch):
+    """ Test that a dying worker fails the tasks in flight and the run goes on with a new pool """
+    executors = []
+    new_executor = taskRunner._executor  # pylint: disable=protected-access
+
+    def executor(*args):
+        executors.append(new_executor(*args))
+        return executors[-1]
+
+    monkeypatch.setattr(taskRunner, '_executor', executor)
+    # hand futures back one at a time, so that the broken futures of the dead pool come after its replacement
+    wait = concurrent.futures.wait
+
+    def wait_one(futures, **kwargs):
+        done, not_done = wait(futures, **kwargs)
+        first = min(done, key=list(futures).index)
+        return {first}, not_done | (done - {first})
+
+    monkeypatch.setattr(concurrent.futures, 'wait', wait_one)
+    tasks = {name: (str(tmp_path), name, 'die' if name == 'b' else 'slow') for name in 'abcdef'}
+    records = taskRunner.run_tasks(_task, tasks, str(tmp_path / "jobs.jsonl"), num_processes=2, max_retries=1)
+    # tasks in flight when the worker died, b included, are failed then retried
+    assert all(record['status'] == 'done' for record in records.values())
+    assert records['b']['attempts'] == 2
+    # broken futures of the dead pool don't replace its replacement
+    assert len(executors) == 2
+
+
+def _write_dterm_files(prefix):
+    """ Write the :code:`.dat` and :code:`.red.pdb` files of a protein of two chains, :code:`AC` and :code:`DE`,
+    whose residue 2 is left out of the selection.
+
+    The :code:`.dat` file holds TERM 0, with focus :code:`0 1 2` and three matches,
+    and TERM 5, with focus :code:`0 2` and a single match.
+    """
+    with open(prefix + '.dat', 'w') as fp:
+        fp.write("ACDE\n"
+                 "0 1 3\n"
+                 "999 10 20 0.5\n"
+                 "-60 -40 180 0.25\n"
+                 "999 -60 180 0.75\n"
+                 "-120 130 180 1.5\n"
+                 "* TERM 0\n"
+                 "0 1 2\n"
+                 "ACD 0.1 1 2 3 4 5 6 7 8 9 10 11 12\n"
+                 "WXY 0.2 -1 -2 -3 -4 -5 -6 -7 -8 -9 -10 -11 -12\n"
+                 "GGG 0.3 0 0 0 0 0 0 0 0 0 0 0 0\n"
+                 "* TERM 5\n"
+                 "0 2\n"
+                 "KL 1.5 1 2 3 4 5 6 7 8\n")
+    lines = []
+    for i, (chain, resname) in enumerate([('A', 'ALA'), ('A', 'CYS'), ('B', 'ASP'), ('B', 'GLU')]):
+        for j, name in enumerate(['N', 'CA', 'C', 'O']):
+            lines.append(f"ATOM  {len(lines) + 1:5d}  {name:<3} {resname} {chain}{i + 1:4d}    "
+                         f"{i:8.3f}{j:8.3f}{0:8.3f}  1.00  0.00\n")
+    with open(prefix + '.red.pdb', 'w') as fp:
+        fp.writelines(lines)
+
+
+def test_dump_training_tensors(tmp_path):
+    """ Test that TERM matches are featurized for the selected residues, with or without dummy TERMs """
+    prefix = str(tmp_path / "TEST")
+    _write_dterm_files(prefix)
+    output = packageTensors.dumpTrainingTensors(prefix, out_path=prefix, cutoff=1)
+    assert output['pdb'] == 'TEST'
+    assert output['coords'].shape == (4, 4, 3)
+    assert output['chain_lens'] == [2, 2]
+    # residue 2 is left out of the selection, so TERM 0 keeps 2 of its residues and TERM 5 keeps 1
+    assert output['focuses'].tolist() == [0, 1, 0]
+    assert output['term_lens'].tolist() == [2, 1]
+    assert output['contact_idxs'].shape == (3, )
+    assert output['msas'].tolist() == [seq_to_ints("ACK")]
+    features = output['features']
+    assert features.shape == (1, 3, 9)
+    # sin and cos of phi, psi and omega, then environment, RMSD and the full length of the TERM
+    assert np.allclose(features[0, 0, :7], np.concatenate([np.sin(np.radians([1, 4, 7])),
+                                                          np.cos(np.radians([1, 4, 7])), [10]]))
+    assert np.allclose(features[0, :, 6], [10, 11, 7])
+    assert np.allclose(features[0, :, 7], [0.1, 0.1, 1.5])
+    assert np.allclose(features[0, :, 8], [3, 3, 2])
+    with open(prefix + '.length') as fp:
+        assert fp.read().split() == ['3', '3']
+
+    # the dummy TERM is included as the first match, with the target's structure
+    include = packageTensors.dumpTrainingTensors(prefix, cutoff=2, save=False, dummy_terms='include')
+    assert include['msas'].tolist() == [[20] * 3, seq_to_ints("ACK")]
+    assert np.allclose(include['features'][1], features[0])
+    assert np.allclose(include['features'][0, :, 6], [0.5, 0.25, 0.5])
+    assert np.allclose(include['features'][0, :, 7:], [[packageTensors.ZERO, 3]] * 2 + [[packageTensors.ZERO, 2]])
+    # the dummy TERM replaces the matches
+    replace = packageTensors.dumpTrainingTensors(prefix, save=False, dummy_terms='replace')
+    assert replace['msas'].tolist() == [[20] * 3]
+    assert np.allclose(replace['features'], include['features'][:1])
+    assert replace['term_lens'].tolist() == [2, 1]
+
+    # TERM 5 has a single match
+    with pytest.raises(ValueError, match=r"TERMs \[5\]"):
+        packageTensors.dumpTrainingTensors(prefix, cutoff=2, save=False)
+    with pytest.raises(ValueError, match=r"TERMs \[5\]"):
+        packageTensors.dumpTrainingTensors(prefix, cutoff=3, save=False, dummy_terms='include')
@@ -0,0 +1,312 @@
+"""Parser for the :code:`.dat` TERM data dumps written by dTERMen.
+
+A :code:`.dat` file holds
+
+.. code-block::
+
+    <target sequence, one letter per residue>
+    <selected residue indices>
+    <phi psi omega env>                    # one line per target residue, phi=999 starts a new chain
+    ...
+    * TERM <idx>
+    <focus residue indices>
+    <match sequence> <rmsd> <4 x term_len values>   # one line per match, best match first
+    ...
+    * TERM <idx>
+    ...
+
+The match values are the :math:`\\phi`, :math:`\\psi`, :math:`\\omega` and environment values of each match residue,
+in that order. The file is memory-mapped and each TERM block is tokenized in bulk into numpy arrays. If only the top
+matches of each TERM are needed, the remaining match lines are skipped without being parsed.
+
+Files of large complexes can reach several GB. :code:`index_terms` pre-scans the byte offset of every TERM block,
+so that :code:`parse_term_data` can spread ranges of TERMs over a process pool and reassemble them in order.
+"""
+import functools
+import io
+import mmap
+import multiprocessing as mp
+import os
+
+import numpy as np
+
+from terminator.utils.common import AA_to_int
+
+TERM_HEADER = b'* TERM'
+
+# residue code of every one-letter amino acid, indexed by its byte. -1 marks invalid bytes
+_AA_CODES = np.full(256, -1, dtype=np.int64)
+for _aa, _code in AA_to_int.items():
+    if len(_aa) == 1:
+        _AA_CODES[ord(_aa)] = _code
+
+
+def contact_idx(focus):
+    """Assign an index per TERM residue based on how close you are to the central element used to create the TERM.
+
+    We set 0 to the central element, increment as you go N->C, decrement as you go C->N.
+    Central element is middle residue for a first order TERM, central contact for second order TERM
+
+    Args
+    ====
+    focus : list of int
+        List of ints representing global indices (e.g. within the protein)
+        for residues in a TERM.
+
+    Returns
+    =======
+    list of int
+        Context indices derived from the focus
+    """
+    l = len(focus)
+    # if all residues are consecutive, first order TERM
+    if focus[-1] - focus[0] + 1 == l:
+        if l % 2 == 1:  # if it's odd we can easily make this
+            return [i - l // 2 for i in range(l)]
+        else:  # if it's even we assign both center elements 0
+            tail_list = [i for i in range(l // 2)]
+            head_list = [-i for i in reversed(tail_list)]
+            return head_list + tail_list
+    else:  # otherwise, second order TERM
+        breakpoint = 0
+        for i in range(1, l):
+            if focus[i] - focus[i - 1] != 1:
+                breakpoint = i
+                break
+        first_chain = focus[:breakpoint]
+        second_chain = focus[breakpoint:]
+        return contact_idx(first_chain) + contact_idx(second_chain)
+
+
+def _encode(chars):
+    """Residue codes of an array of one-letter amino acid bytes"""
+    codes = _AA_CODES[chars]
+    if (codes < 0).any():
+        raise ValueError(f"invalid residues in {bytes(chars[codes < 0])}")
+    return codes
+
+
+def next_term(buf, start=0, end=None):
+    """Offset of the first :code:`* TERM` line at or after :code:`start`, or :code:`end` if there is none
+
+    Args
+    ----
+    buf : bytes or mmap.mmap
+        Contents of a :code:`.dat` file
+    start : int, default=0
+        Offset to search from. Must be at the start of a line.
+    end : int or None, default=None
+        Offset to search until. If :code:`None`, search until the end of :code:`buf`.
+
+    Returns
+    -------
+    int
+    """
+    end = len(buf) if end is None else end
+    if buf[start:start + len(TERM_HEADER)] == TERM_HEADER:
+        return start
+    offset = buf.find(b'\n' + TERM_HEADER, start, end)
+    return end if offset < 0 else offset + 1
+
+
+def parse_header(buf, end):
+    """Parse the target structure data preceding the first TERM of a :code:`.dat` file.
+
+    Args
+    ----
+    buf : bytes or mmap.mmap
+        Contents of a :code:`.dat` file
+    end : int
+        Offset of the first TERM
+
+    Returns
+    -------
+    dict
+        :code:`sequence`, :code:`selection`, :code:`ppoe` and :code:`chain_lens` (see :code:`parse_term_data`)
+    """
+    lines = [line.strip() for line in buf[:end].split(b'\n') if line.strip()]
+    seq = _encode(np.frombuffer(lines[0], dtype=np.uint8)).tolist()
+    selection = [int(i) for i in lines[1].split()]
+    ppoe = np.fromstring(b' '.join(lines[2:]), sep=' ').reshape(len(lines) - 2, -1)
+
+    # phi=999 starts a new chain. the first chain len will always be 0, so drop it
+    starts = np.flatnonzero(ppoe[:, 0] == 999)
+    chain_lens = np.diff(np.concatenate([[0], starts, [len(ppoe)]]))[1:].tolist()
+    assert sum(chain_lens) == len(seq), "sum of chain lens != total seq len"
+    return {'sequence': seq, 'selection': selection, 'ppoe': ppoe, 'chain_lens': chain_lens}
+
+
+def parse_term(buf, start, end, max_matches=None):
+    """Parse one TERM block of a :code:`.dat` file.
+
+    Args
+    ----
+    buf : bytes or mmap.mmap
+        Contents of a :code:`.dat` file
+    start, end : int
+        Offsets of the TERM block, from its :code:`* TERM` line to the start of the next TERM
+    max_matches : int or None, default=None
+        Only parse the top :code:`max_matches` matches. If :code:`None`, parse all matches.
+
+    Returns
+    -------
+    dict
+        TERM data, containing
+
+        - :code:`idx` - the index of the TERM
+        - :code:`focus` - the target residue indices of the TERM, a list of int
+        - :code:`contact_idx` - the contact index of each TERM residue (see :code:`contact_idx`)
+        - :code:`labels` - the residue codes of each match, :code:`n_matches x term_len`
+        - :code:`rmsds` - the RMSD of each match to the TERM, :code:`n_matches`
+        - :code:`ppoe` - the :math:`\\phi, \\psi, \\omega` and environment values of each match residue,
+          :code:`n_matches x 4 x term_len`
+    """
+    header_end = buf.find(b'\n', start, end)
+    focus_end = buf.find(b'\n', header_end + 1, end)
+    focus_end = end if focus_end < 0 else focus_end
+    focus = [int(i) for i in buf[header_end + 1:focus_end].split()]
+    term_len = len(focus)
+
+    # only read up to the end of the last match to parse
+    matches_end = end
+    if max_matches is not None:
+        matches_end = focus_end
+        for _ in range(max_matches):
+            if matches_end >= end:
+                break
+            matches_end = buf.find(b'\n', matches_end + 1, end)
+            matches_end = end if matches_end < 0 else matches_end
+    block = buf[focus_end + 1:matches_end]
+
+    # every match line starts with a sequence of term_len residues
+    text = np.frombuffer(block, dtype=np.uint8)
+    line_ends = np.append(np.flatnonzero(text == ord('\n')), len(text))
+    line_starts = np.append(0, line_ends[:-1] + 1)
+    line_starts = line_starts[line_ends - line_starts > term_len]
+    if (text[line_starts + term_len] != ord(' ')).any():
+        raise ValueError(f"TERM at byte {start}: expected match sequences of length {term_len}")
+    labels = _encode(text[line_starts[:, None] + np.arange(term_len)])
+
+    num_values = 1 + 4 * term_len
+    if len(line_starts) > 0:
+        values = np.loadtxt(io.BytesIO(block), usecols=range(1, 1 + num_values), ndmin=2)
+    else:
+        values = np.zeros((0, num_values))
+    if values.shape[0] != len(line_starts):
+        raise ValueError(f"TERM at byte {start}: expected {num_values} values per match")
+    return {
+        'idx': int(buf[start:header_end].split()[-1]),
+        'focus': focus,
+        'contact_idx': contact_idx(focus),
+        'labels': labels,
+        'rmsds': values[:, 0],
+        'ppoe': values[:, 1:].reshape(len(values), 4, term_len)
+    }
+
+
+def index_terms(filename):
+    """Byte offsets of every TERM block of a :code:`.dat` file.
+
+    Args
+    ----
+    filename : str
+        Path to the :code:`.dat` file
+
+    Returns
+    -------
+    np.ndarray
+        Offsets of the :code:`* TERM` line of each TERM, followed by the size of the file,
+        so that TERM :code:`i` spans :code:`offsets[i]:offsets[i + 1]`
+    """
+    with open(filename, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        offsets = [next_term(buf)]
+        while offsets[-1] < len(buf):
+            offsets.append(next_term(buf, offsets[-1] + 1))
+    return np.array(offsets, dtype=np.int64)
+
+
+def parse_terms(filename, offsets, max_matches=None):
+    """Parse a range of consecutive TERM blocks of a :code:`.dat` file.
+
+    Args
+    ----
+    filename : str
+        Path to the :code:`.dat` file
+    offsets : np.ndarray
+        Byte offsets of the TERMs to parse followed by the end of the last one, as outputted by :code:`index_terms`
+    max_matches : int or None, default=None
+        Only parse the top :code:`max_matches` matches of each TERM. If :code:`None`, parse all matches.
+
+    Returns
+    -------
+    list of dict
+        Data of each TERM (see :code:`parse_term`)
+    """
+    with open(filename, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        return [parse_term(buf, start, end, max_matches) for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _split_offsets(offsets, num_chunks, by_bytes=True):
+    """Split TERM offsets into at most :code:`num_chunks` ranges of consecutive TERMs
+
+    Ranges hold about as many bytes each if :code:`by_bytes`, else about as many TERMs.
+    Consecutive ranges share their boundary offset.
+    """
+    num_terms = len(offsets) - 1
+    if by_bytes:
+        bounds = np.searchsorted(offsets, np.linspace(offsets[0], offsets[-1], num_chunks + 1))
+    else:
+        bounds = np.linspace(0, num_terms, num_chunks + 1).round().astype(int)
+    bounds = np.unique(np.clip(bounds, 0, num_terms))
+    return [offsets[lo:hi + 1] for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+
+def parse_term_data(filename, max_matches=None, num_processes=1, pool=None, num_chunks=None):
+    """Parse all relevant data from a :code:`.dat` TERM data dump.
+
+    Args
+    ----
+    filename : str
+        Path to the :code:`.dat` file
+    max_matches : int or None, default=None
+        Only parse the top :code:`max_matches` matches of each TERM. If :code:`None`, parse all matches.
+    num_processes : int, default=1
+        Number of processes to parse TERMs with. If more than 1, a process pool is started for this file.
+    pool : multiprocessing.pool.Pool, concurrent.futures.Executor or None, default=None
+        Process pool to parse TERMs with, instead of starting one. Must not be used from one of its own workers.
+    num_chunks : int or None, default=None
+        Number of ranges of consecutive TERMs to spread over the processes. Defaults to 4 per process,
+        or 64 for a given :code:`pool`.
+
+    Returns
+    -------
+    dict
+        Dictionary containing information about the dTERMen run, i.e.
+
+        - :code:`sequence` - the target sequence, numerically encoded
+        - :code:`selection` - the selected residue indices
+        - :code:`ppoe` - the :math:`\\phi, \\psi, \\omega` and environment values of each target residue
+        - :code:`chain_lens` - the length of each chain
+        - :code:`terms` - the data of each TERM (see :code:`parse_term`)
+    """
+    filename = os.path.abspath(filename)
+    offsets = index_terms(filename)
+    with open(filename, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        output = parse_header(buf, offsets[0])
+    if pool is None and num_processes <= 1:
+        output['terms'] = parse_terms(filename, offsets, max_matches)
+        return output
+
+    # spread ranges of TERM blocks over the processes, and reassemble them in order
+    if num_chunks is None:
+        num_chunks = 64 if pool is not None else 4 * num_processes
+    # with a match cutoff the work per TERM no longer scales with its size in bytes
+    chunks = _split_offsets(offsets, num_chunks, by_bytes=max_matches is None)
+    parse_func = functools.partial(parse_terms, filename, max_matches=max_matches)
+    if pool is not None:
+        chunk_terms = pool.map(parse_func, chunks)
+    else:
+        with mp.Pool(num_processes) as own_pool:
+            chunk_terms = own_pool.map(parse_func, chunks)
+    output['terms'] = [term for terms in chunk_terms for term in terms]
+    return output
@@ -130,6 +130,13 @@ Parameters
     energies_gvp : bool, default=False
         Use GVP version of GNN Potts Model Encoder instead
 
+    energies_packed : bool, default=False
+        Run the GNN Potts Model Encoder on a packed batch, with the residues of all proteins concatenated
+        instead of padded to the longest protein. The outputted etab is then packed as well, and only
+        padded when dumping outputs. The kNN graph is then built at collate time (see
+        :code:`terminator.data.data.featurization_plan`). Not supported with :code:`energies_gvp` or
+        :code:`nn.DataParallel` across several GPUs.
+
     energies_full_graph : bool, default=True
         [DEPRECIATED] Update both node and edge representations in the GNN Potts Model Encoder.
         GNN Potts Model Encoder always updates node and edge representations now,
@@ -196,6 +203,23 @@ Parameters
         batch by fitting as many datapoints as possible with the total number of
         sequence residues included below `max_seq_tokens`.
 
+    max_seq_pairs : int or None, default=None
+        When :code:`bin_pack=True`, also bound the number of padded residue pairs (:code:`n_batch * L * L`)
+        per batch, which sizes the dense edge tensors built in :code:`aggregate_edges`.
+
+    bin_pack : bool, default=False
+        When :code:`train_batch_size=None`, pack training batches against all of :code:`max_term_res`,
+        :code:`max_seq_tokens` and :code:`max_seq_pairs` that are set, rather than greedily against a single cap.
+        Batches are then of near-equal padded cost, and the padding efficiency is printed every epoch.
+
+    seed : int, default=0
+        Random seed shared across ranks to shuffle and shard training batches under distributed training
+        (see :code:`terminator.data.data.DistributedBatchSampler`)
+
+    prefetch_depth : int, default=2
+        Number of batches to package and move to the device in a background thread while the model computes
+        (see :code:`terminator.utils.model.loop_utils.PrefetchIterator`). Set to 0 to load batches synchronously.
+
     term_dropout : str or None, default=None
         Let `t` be the number of TERM matches in the given datapoint.
         Select a random int `n` from 1 to `t`, and take a random subset `n`
@@ -248,6 +272,7 @@ DEFAULT_MODEL_HPARAMS = {
     'energies_use_mpnn': False,  #
     'energies_output_dim': 20 * 20,  #
     'energies_gvp': False,  #
+    'energies_packed': False,
     'energies_geometric': False,  #
     'energies_full_graph': True,  #
     'res_embed_linear': False,  #
@@ -271,6 +296,10 @@ DEFAULT_TRAIN_HPARAMS = {
     'regularization': 0,
     'max_term_res': 55000,
     'max_seq_tokens': None,
+    'max_seq_pairs': None,
+    'bin_pack': False,
+    'seed': 0,
+    'prefetch_depth': 2,
     'term_dropout': None,
     'loss_config': {
         'nlcpl': 1
@@ -1,7 +1,14 @@
 """ Utilities for running training and evaluation loops """
+import queue
+import threading
+import time
+
 import torch
 from tqdm import tqdm
 
+from terminator.data.batch import TERMBatch
+from terminator.models.layers.utils import is_packed, unpack, unpack_knn_idx
+
 # pylint: disable=no-member
 
 
@@ -10,16 +17,150 @@ def _to_dev(data_dict, dev):
 
     Args
     ----
-    data_dict : dict
+    data_dict : dict or TERMBatch
         Dictionary of input features to TERMinator
     dev : str
         Device to load tensors onto
+
+    Returns
+    -------
+    dict or TERMBatch
+        The batch on :code:`dev`. Dictionaries are updated in place, while
+        a :code:`TERMBatch` is pinned and moved in a single copy (see :code:`TERMBatch.to`).
     """
+    if isinstance(data_dict, TERMBatch):
+        if torch.device(dev).type == 'cuda':
+            # pin here rather than with DataLoader(pin_memory=True),
+            # which turns batches into plain dicts of tensors before pytorch 2
+            data_dict = data_dict.pin_memory()
+        return data_dict.to(dev, non_blocking=True)
     for key, value in data_dict.items():
         if isinstance(value, torch.Tensor):
             data_dict[key] = value.to(dev)
         if key == 'gvp_data':
             data_dict['gvp_data'] = [data.to(dev) for data in data_dict['gvp_data']]
+    return data_dict
+
+
+class PrefetchIterator:
+    """ Iterate over a dataloader while packaging and device-placing upcoming batches in the background.
+
+    A background thread pulls batches from :code:`dataloader` and pushes them to :code:`dev`,
+    keeping up to :code:`depth` ready batches queued, so that a slow batch does not stall the training step.
+    Time spent blocked waiting on data and time spent between batches (i.e. computing) are recorded.
+
+    Attributes
+    ----------
+    dataloader : torch.utils.data.DataLoader
+        Dataloader to iterate over
+    dev : str
+        Device to place batches on
+    depth : int
+        Maximum number of prepared batches held in the queue
+    wait_time : float
+        Seconds spent waiting on the next batch during the last iteration
+    compute_time : float
+        Seconds spent between receiving a batch and requesting the next one during the last iteration
+    """
+    _END = object()
+
+    def __init__(self, dataloader, dev, depth=2):
+        """
+        Args
+        ----
+        dataloader : torch.utils.data.DataLoader
+            Dataloader to iterate over
+        dev : str
+            Device to place batches on
+        depth : int, default=2
+            Maximum number of prepared batches held in the queue
+        """
+        assert depth > 0, "prefetch depth must be positive"
+        self.dataloader = dataloader
+        self.dev = dev
+        self.depth = depth
+        self.wait_time = 0.
+        self.compute_time = 0.
+
+    def _produce(self, batches, stop):
+        """ Prepare batches in the background until the dataloader is exhausted or :code:`stop` is set """
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for data in self.dataloader:
+                if not put(_prepare_batch(data, self.dev)):
+                    return
+        except Exception as e:  # pylint: disable=broad-except
+            # hand the exception to the consumer, which reraises it
+            put(e)
+            return
+        put(self._END)
+
+    def __iter__(self):
+        self.wait_time = 0.
+        self.compute_time = 0.
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                data = batches.get()
+                received = time.perf_counter()
+                self.wait_time += received - start
+                if data is self._END:
+                    return
+                if isinstance(data, Exception):
+                    raise data
+                yield data
+                self.compute_time += time.perf_counter() - received
+        finally:
+            stop.set()
+            producer.join()
+
+    def timing(self):
+        """ Summarize where the time went during the last iteration
+
+        Returns
+        -------
+        dict
+            :code:`wait` and :code:`compute` time in seconds, and the fraction of time spent waiting on data
+        """
+        total = self.wait_time + self.compute_time
+        return {
+            'wait': self.wait_time,
+            'compute': self.compute_time,
+            'wait_frac': self.wait_time / total if total > 0 else 0.
+        }
+
+
+def _prepare_batch(data, dev):
+    """ Get a packaged batch ready to be fed into the model on device :code:`dev`
+
+    Args
+    ----
+    data : dict or TERMBatch
+        Batch produced by the dataloader
+    dev : str
+        Device to load tensors onto
+
+    Returns
+    -------
+    dict or TERMBatch
+        The prepared batch
+    """
+    # a small hack for DataParallel to know which device got which proteins
+    if 'scatter_idx' not in data:
+        data['scatter_idx'] = torch.arange(len(data['seq_lens']))
+    return _to_dev(data, dev)
 
 
 def _ld_item_values(ld):
@@ -104,7 +245,7 @@ def _sum_loss_dicts(total_ld, batch_ld):
     return combined_ld
 
 
-def run_epoch(model, dataloader, loss_fn, optimizer=None, scheduler=None, grad=False, test=False, dev="cuda:0", isDataParallel=False, finetune=False):
+def run_epoch(model, dataloader, loss_fn, optimizer=None, scheduler=None, grad=False, test=False, dev="cuda:0", isDataParallel=False, finetune=False, prefetch_depth=0):
     """ Run :code:`model` on one epoch of :code:`dataloader`
 
     Args
@@ -112,7 +253,8 @@ def run_epoch(model, dataloader, loss_fn, optimizer=None, scheduler=None, grad=F
     model : terminator.model.TERMinator.TERMinator
         An instance of TERMinator
     dataloader : torch.utils.data.DataLoader
-        A torch DataLoader that wraps either terminator.data.data.TERMDataLoader or terminator.data.data.TERMLazyDataLoader
+        A torch DataLoader that wraps either terminator.data.data.TERMDataLoader or terminator.data.data.TERMLazyDataLoader,
+        or streams batches from a terminator.data.stream.TERMStreamDataset
     loss_fn : function
         Loss function with signature :code:`loss_fn(etab, E_idx, data)` and returns :code`loss, batch_count`,
         where
@@ -131,6 +273,9 @@ def run_epoch(model, dataloader, loss_fn, optimizer=None, scheduler=None, grad=F
         Whether or not to save the outputs of the model. Requires :code:`grad=False`.
     dev : str, default="cuda:0"
         What device to compute on
+    prefetch_depth : int, default=0
+        Number of batches to package and place on :code:`dev` ahead of time in a background thread
+        (see :code:`PrefetchIterator`). If 0, batches are prepared synchronously.
 
     Returns
     -------
@@ -185,16 +330,25 @@ def run_epoch(model, dataloader, loss_fn, optimizer=None, scheduler=None, grad=F
     if test:
         dump = []
 
-    progress = tqdm(total=len(dataloader))
-    for data in dataloader:
-        # a small hack for DataParallel to know which device got which proteins
-        data['scatter_idx'] = torch.arange(len(data['seq_lens']))
-        _to_dev(data, dev)
+    batches = dataloader
+    if prefetch_depth > 0:
+        batches = PrefetchIterator(dataloader, dev, depth=prefetch_depth)
+
+    try:
+        num_batches = len(dataloader)
+    except TypeError:
+        # streaming datasets don't know how many batches they hold
+        num_batches = None
+    progress = tqdm(total=num_batches)
+    for data in batches:
+        if prefetch_depth == 0:
+            data = _prepare_batch(data, dev)
         max_seq_len = max(data['seq_lens'].tolist())
         ids = data['ids']
 
         try:
-            etab, E_idx = model(data, max_seq_len)
+            # DataParallel only splits plain dictionaries across devices
+            etab, E_idx = model(dict(data) if isinstance(model, torch.nn.DataParallel) else data, max_seq_len)
             batch_loss_dict = loss_fn(etab, E_idx, data)
             loss = _compute_loss(batch_loss_dict)
         except Exception as e:
@@ -210,6 +364,10 @@ def run_epoch(model, dataloader, loss_fn, optimizer=None, scheduler=None, grad=F
                                             _ld_item_values(batch_loss_dict))
 
         if test:
+            if is_packed(etab, data['seq_lens']):
+                # outputs are dumped padded, whatever the layout the model ran in
+                etab = unpack(etab, data['seq_lens'], max_seq_len)
+                E_idx = unpack_knn_idx(E_idx, data['seq_lens'], max_seq_len)
             n_batch, l, n = etab.shape[:3]
             dump.append({
                 'loss': loss,
@@ -232,6 +390,10 @@ def run_epoch(model, dataloader, loss_fn, optimizer=None, scheduler=None, grad=F
         progress.set_description_str(f'avg loss {avg_loss} {loss_breakdown} | eff 0.{term_mask_eff}, 0.{res_mask_eff}')
 
     progress.close()
+    if prefetch_depth > 0:
+        timing = batches.timing()
+        print(f"data wait {timing['wait']:.1f}s, compute {timing['compute']:.1f}s "
+              f"({timing['wait_frac']:.0%} waiting on data)")
     epoch_loss = _compute_loss(running_loss_dict)
 
     if scheduler is not None:
@@ -6,6 +6,8 @@ must have the signature :code:`loss(etab, E_idx, data)`, where
     - :code:`etab` is the outputted etab from TERMinator
     - :code:`E_idx` is the edge index outputted from TERMinator
     - :code:`data` is the training data dictionary
+If the etab is in the packed layout (see :code:`terminator.models.layers.utils.cu_seqlens`), :code:`data` holds packed
+:code:`seqs` and :code:`x_mask` and the offsets of the proteins under :code:`cu_seqlens`.
 Additionally, the function must return two outputs :code:`loss_contribution, norm_count`, where
     - :code:`loss_contribution` is the computed loss contribution by the function
     - :code:`norm_count` is a normalizing constant associated with the loss (e.g. when averaging across losses in batches,
@@ -17,9 +19,46 @@ import torch
 import torch.nn.functional as F
 import random
 
+from terminator.models.layers.utils import cu_seqlens, is_packed, pack
+
 # pylint: disable=no-member
 
-NOT_LOSS_FNS = ["_get_loss_fn", "construct_loss_fn"]
+NOT_LOSS_FNS = ["_get_loss_fn", "construct_loss_fn", "_pack_data", "_protein_sums", "_protein_norms"]
+
+
+def _pack_data(data):
+    """ Copy of :code:`data` with the per-residue entries used by losses in the packed layout """
+    packed = dict(data)
+    packed['seqs'] = pack(data['seqs'], data['seq_lens'])
+    packed['x_mask'] = pack(data['x_mask'], data['seq_lens'])
+    packed['cu_seqlens'] = cu_seqlens(data['seq_lens'])
+    return packed
+
+
+def _protein_sums(values, data):
+    """ Sum per-residue values over the residues of each protein
+
+    Args
+    ----
+    values : torch.Tensor
+        Per-residue values, padded or packed
+        Shape: n_batch x n_res
+
+    Returns
+    -------
+    torch.Tensor
+        Shape: n_batch
+    """
+    if 'cu_seqlens' not in data:
+        return values.sum(dim=1)
+    seq_lens = torch.as_tensor(data['seq_lens'], device=values.device)
+    protein_idx = torch.repeat_interleave(torch.arange(len(seq_lens), device=values.device), seq_lens)
+    return values.new_zeros(len(seq_lens)).index_add(0, protein_idx, values[0])
+
+
+def _protein_norms(etab, data):
+    """ L2 norm of the etab of each protein, for padded or packed etabs """
+    return torch.sqrt(_protein_sums(etab.square().sum(dim=(2, 3)), data))
 
 
 def nlpl(etab, E_idx, data):
@@ -252,7 +291,7 @@ def etab_norm_penalty(etab, E_idx, data):
     seq_lens = data['seq_lens']
     # etab_norm = torch.linalg.norm(etab.view([-1]))
     # return etab_norm / seq_lens.sum(), int(seq_lens.sum())
-    etab_norm = torch.mean(torch.linalg.norm(etab, dim=(1,2,3)) / seq_lens)
+    etab_norm = torch.mean(_protein_norms(etab, data) / seq_lens)
     return etab_norm, int(seq_lens.sum())
 
 
@@ -262,7 +301,7 @@ def mindren_etab_norm_penalty(etab, E_idx, data):
     seq_lens = data['seq_lens']
     # etab_norm = torch.linalg.norm(etab.view([-1]))
     # return etab_norm / seq_lens.sum(), int(seq_lens.sum())
-    etab_norm = torch.mean(torch.linalg.norm(etab, dim=(1,2,3)) / seq_lens)
+    etab_norm = torch.mean(_protein_norms(etab, data) / seq_lens)
     return etab_norm, int(seq_lens.sum())
 
 
@@ -272,7 +311,7 @@ def etab_l1_norm_penalty(etab, E_idx, data):
     seq_lens = data['seq_lens']
     # etab_norm = torch.linalg.norm(etab.view([-1]))
     # return etab_norm / seq_lens.sum(), int(seq_lens.sum())
-    etab_norm = torch.mean(torch.sum(torch.abs(etab), dim=(1,2,3)) / seq_lens)
+    etab_norm = torch.mean(_protein_sums(torch.abs(etab).sum(dim=(2, 3)), data) / seq_lens)
     return etab_norm, int(seq_lens.sum())
 
 
@@ -291,7 +330,7 @@ def pair_self_energy_ratio(etab, E_idx, data):
     self_nrgs_avg = self_nrgs[self_nrgs != 0].square().mean().sqrt()
     pair_nrgs_avg = pair_etab[pair_etab != 0].square().mean().sqrt()
 
-    return pair_nrgs_avg / self_nrgs_avg, n_batch
+    return pair_nrgs_avg / self_nrgs_avg, len(data['seq_lens'])
 
 
 def sortcery_loss(etab, E_idx, data):
@@ -404,6 +443,8 @@ def construct_loss_fn(hparams):
 
     def _loss_fn(etab, E_idx, data):
         """ The returned loss function """
+        if is_packed(etab, data['seq_lens']):
+            data = _pack_data(data)
         loss_dict = {}
         for loss_fn_name, scaling_factor in loss_config.items():
             subloss_fn = _get_loss_fn(loss_fn_name)
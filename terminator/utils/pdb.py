@@ -0,0 +1,176 @@
+"""Fixed-width PDB parser shared by the preprocessing and postprocessing scripts.
+
+The lines of the file are laid out as a :code:`n_lines x 80` character matrix, so that every PDB column
+is a numpy slice of that matrix rather than a per-line string slice. :code:`read_pdb_records` returns these
+columns, and :code:`read_backbone` groups them into the backbone coordinates, sequence, chains and residue ids
+of a structure in one pass.
+"""
+import numpy as np
+
+from terminator.utils.common import AA_to_int, int_to_AA
+
+LINE_WIDTH = 80
+ATOM_RECORDS = ('ATOM', 'HETATM')
+BACKBONE_ATOMS = ('N', 'CA', 'C', 'O')
+# modified residues, mapped to the residue they are modelled as
+MODIFIED_RESIDUES = {
+    'MSE': 'MET',  # seleno-met
+    'SEP': 'SER',  # phospho-ser
+    'TPO': 'THR',  # phospho-thr
+    'PTR': 'TYR',  # phospho-tyr
+    'CSO': 'CYS',  # hydroxy-cys
+    'SEC': 'CYS',  # seleno-cys
+}
+
+
+def _column(chars, start, end, strip=True):
+    """Strings of the columns :code:`start:end` of a character matrix"""
+    field = np.ascontiguousarray(chars[:, start:end]).view(f'S{end - start}')[:, 0]
+    return (np.char.strip(field) if strip else field).astype(str)
+
+
+def read_pdb_records(filename):
+    """Read the fixed-width columns of every line of a PDB file.
+
+    Lines are numbered as in the file, blank lines included.
+
+    Args
+    ----
+    filename : str
+        Path to the PDB file
+
+    Returns
+    -------
+    dict
+        Columns of each line, as numpy arrays of length :code:`n_lines`
+
+        - :code:`record` - the record type, e.g. :code:`'ATOM'` or :code:`'TER'`
+        - :code:`name` - the atom name
+        - :code:`resname` - the residue name
+        - :code:`chain` - the chain id
+        - :code:`res_id` - the residue number and insertion code
+        - :code:`xyz` - the coordinates of each :code:`ATOM` and :code:`HETATM` line,
+          :code:`n_lines x 3`, with NaN for other lines
+
+        as well as :code:`lines`, the list of lines of the file as bytes, including their line endings.
+    """
+    with open(filename, 'rb') as fp:
+        lines = fp.read().splitlines(keepends=True)
+
+    # lay lines out as rows of the full line width, padding them with spaces in place of their line endings
+    chars = np.array(lines, dtype=f'S{LINE_WIDTH}').view(np.uint8).reshape(len(lines), LINE_WIDTH).copy()
+    chars[(chars == 0) | (chars == ord('\r')) | (chars == ord('\n'))] = ord(' ')
+
+    record = _column(chars, 0, 6)
+    is_atom = np.isin(record, ATOM_RECORDS)
+    xyz = np.full((len(chars), 3), np.nan)
+    xyz[is_atom] = np.ascontiguousarray(chars[is_atom, 30:54]).view('S8').astype(np.float64)
+    return {
+        'lines': lines,
+        'record': record,
+        # columns 13:16 exclude the element column of atom names, so that e.g. calcium ions aren't read as CA
+        'name': _column(chars, 13, 16),
+        'resname': _column(chars, 17, 20),
+        'chain': _column(chars, 21, 22, strip=False),
+        'res_id': _column(chars, 22, 27),
+        'xyz': xyz,
+    }
+
+
+def residue_index(chain, res_id):
+    """Group atoms into residues, numbered in order of first appearance.
+
+    Args
+    ----
+    chain : np.ndarray
+        Chain id of each atom
+    res_id : np.ndarray
+        Residue number and insertion code of each atom
+
+    Returns
+    -------
+    first_atoms : np.ndarray
+        Index of the first atom of each residue
+    residue_of_atom : np.ndarray
+        Index of the residue of each atom
+    """
+    keys = np.char.add(np.char.add(chain.astype(str), ':'), res_id.astype(str))
+    _, first_atoms, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first_atoms)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first_atoms[order], rank[inverse.reshape(-1)]
+
+
+def read_backbone(filename):
+    """Read the backbone of a structure from a PDB file, e.g. a :code:`.red.pdb` file.
+
+    Residues are grouped by chain, in the order chains first appear in the file, and ordered within chains
+    as they first appear. The terminal OXT atom is used as O for residues without an O atom.
+    Modified residues in :code:`MODIFIED_RESIDUES` are read as the residue they are modelled as.
+
+    Args
+    ----
+    filename : str
+        Path to the PDB file
+
+    Returns
+    -------
+    dict
+        Backbone of the structure, containing
+
+        - :code:`coords` - the coordinates of the N, CA, C and O atoms of each residue, :code:`n_res x 4 x 3`
+        - :code:`sequence` - the one-letter sequence of all chains concatenated
+        - :code:`chain_ids` - the id of each chain
+        - :code:`chain_lens` - the number of residues of each chain
+        - :code:`residue_ids` - the :code:`(chain, res_id)` of each residue, with :code:`res_id` the
+          residue number and insertion code
+
+    Raises
+    ------
+    ValueError
+        If a residue is missing backbone atoms, or is not an amino acid
+    """
+    records = read_pdb_records(filename)
+    is_atom = np.isin(records['record'], ATOM_RECORDS) & np.isin(records['name'], BACKBONE_ATOMS + ('OXT', ))
+    chain, res_id = records['chain'][is_atom], records['res_id'][is_atom]
+    first_atoms, residue_of_atom = residue_index(chain, res_id)
+
+    # group residues by chain, keeping their order within chains
+    chain_ids, chain_first, chain_of_res = np.unique(chain[first_atoms], return_index=True, return_inverse=True)
+    chain_order = np.argsort(chain_first)
+    chain_rank = np.empty_like(chain_order)
+    chain_rank[chain_order] = np.arange(len(chain_order))
+    chain_of_res = chain_rank[chain_of_res.reshape(-1)]
+    chain_ids = chain_ids[chain_order]
+    order = np.argsort(chain_of_res, kind='stable')
+    position = np.empty_like(order)
+    position[order] = np.arange(len(order))
+    residue_of_atom = position[residue_of_atom]
+    first_atoms = first_atoms[order]
+
+    # place each atom at its backbone slot. OXT goes first so that O overrides it,
+    # and atoms are written last to first so that the first of duplicate atoms is kept
+    name = records['name'][is_atom]
+    xyz = records['xyz'][is_atom]
+    coords = np.full((len(first_atoms), len(BACKBONE_ATOMS), 3), np.nan)
+    for slot, atom in [(3, 'OXT')] + list(enumerate(BACKBONE_ATOMS)):
+        atoms = np.flatnonzero(name == atom)[::-1]
+        coords[residue_of_atom[atoms], slot] = xyz[atoms]
+    residue_ids = list(zip(chain[first_atoms].tolist(), res_id[first_atoms].tolist()))
+    missing = np.isnan(coords).any(axis=(1, 2))
+    if missing.any():
+        raise ValueError(f"{filename}: residues {[residue_ids[i] for i in np.flatnonzero(missing)]} "
+                         "are missing backbone atoms")
+
+    resnames = [MODIFIED_RESIDUES.get(resname, resname) for resname in records['resname'][is_atom][first_atoms]]
+    unknown = sorted({resname for resname in resnames if resname not in AA_to_int})
+    if unknown:
+        raise ValueError(f"{filename}: unknown residues {unknown}")
+    return {
+        'coords': coords,
+        'sequence': ''.join(int_to_AA[AA_to_int[resname]] for resname in resnames),
+        'chain_ids': chain_ids.tolist(),
+        'chain_lens': np.bincount(chain_of_res, minlength=len(chain_ids)).tolist(),
+        'residue_ids': residue_ids,
+    }